@@ -0,0 +1,49 @@
+"""Per-step cost of looking up a command's arguments, before and after caching the parsed signatures.
+
+Run from the repository root:  python benchmarks/bench_command_dispatch.py
+"""
+import pathlib
+import sys
+import timeit
+from inspect import signature
+from types import UnionType
+from typing import get_args
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from pipeline_backend.commands import Commands
+from pipeline_backend.variables import WorkVariable
+
+ITERATIONS = 20000
+
+
+def parse_signature_every_time(command_name: str) -> list:
+    """What get_command_input_variables did on every step before the descriptors existed."""
+    sig = signature(Commands.commands[command_name])
+    parms = []
+    for arg_name in list(sig.parameters.keys())[1:]:
+        match(sig.parameters[arg_name].annotation):
+            case args_union if isinstance(args_union, UnionType):
+                parms.append((arg_name, get_args(args_union)))
+            case x if issubclass(x, WorkVariable):
+                parms.append((arg_name, x))
+    return parms
+
+
+def main() -> None:
+    # A spread of commands with few and many arguments
+    names = ["log", "set_variable_value", "math_add", "goto_if_equal", "yield_for_seconds"]
+    print(f"{'command':<24}{'signature() us/step':>22}{'descriptor us/step':>22}{'speedup':>10}")
+    for name in names:
+        uncached = timeit.timeit(lambda name=name: parse_signature_every_time(name), number=ITERATIONS)
+        cached = timeit.timeit(lambda name=name: Commands.get_command_descriptor(name).arguments, number=ITERATIONS)
+        print(f"{name:<24}{uncached / ITERATIONS * 1e6:>22.2f}{cached / ITERATIONS * 1e6:>22.3f}{uncached / cached:>9.0f}x")
+
+    uncached = timeit.timeit(lambda: {n: parse_signature_every_time(n) for n in Commands.commands}, number=200)
+    cached = timeit.timeit(Commands.json_savable_all_commands_with_args, number=200)
+    print(f"\njson_savable_all_commands_with_args ({len(Commands.commands)} commands): "
+          f"{uncached / 200 * 1e3:.2f} ms -> {cached / 200 * 1e3:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
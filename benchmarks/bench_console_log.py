@@ -0,0 +1,58 @@
+"""Cost of Instance.log_line, with the log kept as a bounded deque of lines against the old
+append to a string and re-split the whole log to trim it on every call.
+
+Run from the repository root:  python benchmarks/bench_console_log.py
+"""
+import pathlib
+import sys
+import timeit
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from pipeline_backend.instances import CONSOLE_LOG_MAX_LINES
+from pipeline_backend.manager import PipelineManager
+from pipeline_backend.workflows import Workflow
+
+CALLS = 100000
+
+
+class StringLog:
+    """Stands in for the console log before it was a deque - log_line and trim_console_log as they were."""
+
+    def __init__(self) -> None:
+        self.console_log = ""
+
+    def log_line(self, line: str) -> None:
+        self.console_log += line+"\n"
+        lines = self.console_log.split("\n")
+        if len(lines) > CONSOLE_LOG_MAX_LINES + 1:
+            self.console_log = "\n".join(lines[-(CONSOLE_LOG_MAX_LINES+1):])
+
+
+def progress_line(i: int) -> str:
+    """About what the download commands log while a transfer runs."""
+    return f"Downloaded {i * 65536} of 4294967296 bytes ({i / 655.36:.1f}%) from https://example.com/some/large/file.mkv"
+
+
+def main() -> None:
+    mgr = PipelineManager()
+    wf = Workflow(mgr.ctx)
+    wf.uuid = "bench"
+    mgr.ctx.workflows[wf.uuid] = wf
+    inst = wf.spawn_instance()
+    old = StringLog()
+    lines = [progress_line(i) for i in range(CALLS)]
+
+    string_log = timeit.timeit(lambda: [old.log_line(line) for line in lines], number=1)
+    deque_log = timeit.timeit(lambda: [inst.log_line(line) for line in lines], number=1)
+    render = timeit.timeit(lambda: inst.console_log, number=1)
+    assert inst.console_log == old.console_log
+
+    print(f"{CALLS} log_line calls, keeping the last {CONSOLE_LOG_MAX_LINES} lines")
+    print(f"  string re-split on every call : {string_log:6.3f} s")
+    print(f"  bounded deque of lines        : {deque_log:6.3f} s")
+    print(f"  rendering the text once       : {render * 1e6:6.1f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Time restore_state() on a large generated state file, with the registry lookup of WorkVariable types
+against the old linear scan of WorkVariable.__subclasses__().
+
+Run from the repository root:  python benchmarks/bench_restore_state.py [size in MB, default 50]
+"""
+import json
+import pathlib
+import sys
+import tempfile
+import time
+import timeit
+from unittest.mock import patch
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from pipeline_backend.manager import PipelineManager
+from pipeline_backend.variables import WorkVariable
+
+LOOKUPS = 100000
+
+
+def string(value: str) -> dict:
+    return {"value": value, "typename": "String"}
+
+
+def make_instance(uuid: str, entries: int) -> dict:
+    feed = [
+        {"value": {"title": string(f"Entry {i}"), "link": string(f"https://example.com/{uuid}/{i}")}, "typename": "Dictionary"}
+        for i in range(entries)
+    ]
+    return {
+        "uuid": uuid,
+        "workflow_uuid": "wf-bench",
+        "state": "Running",
+        "processing_step": ["start", 0],
+        "next_processing_time": "2026-10-18T00:00:00",
+        "console_log": "",
+        "variables": {
+            "feed": {"value": feed, "typename": "VariableList"},
+            "seen": {"value": 3, "typename": "Integer"},
+        },
+    }
+
+
+def write_state_file(target: pathlib.Path, size_mb: int) -> None:
+    instances = {}
+    data = {
+        "workflows": {"wf-bench": {
+            "name": "Bench", "state": "Paused", "uuid": "wf-bench", "user_notes": "",
+            "constants": {}, "setup_variables": {}, "procedures": {"start": []},
+        }},
+        "instances": instances,
+        "variables": {},
+    }
+    per_instance = len(json.dumps(make_instance("00000000", 100), indent=4))
+    for n in range(size_mb * 1024 * 1024 // per_instance):
+        uuid = f"{n:08d}"
+        instances[uuid] = make_instance(uuid, 100)
+    target.write_text(json.dumps(data, indent=4))
+
+
+def linear_class_from_name(typename: str) -> type:
+    """How class_from_name worked before the registry, widened to the whole class tree to be comparable."""
+    pending = list(WorkVariable.__subclasses__())
+    while pending:
+        cls = pending.pop(0)
+        if cls.__name__ == typename:
+            return cls
+        pending.extend(cls.__subclasses__())
+    raise TypeError(f"Unable to find a WorkVariable type to cast into with the name {typename}")
+
+
+def time_restore(state_file: pathlib.Path) -> tuple[float, int]:
+    mgr = PipelineManager()
+    start = time.perf_counter()
+    mgr.restore_state(str(state_file))
+    return time.perf_counter() - start, len(mgr.ctx.instances)
+
+
+def main() -> None:
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    with tempfile.TemporaryDirectory() as tmp:
+        state_file = pathlib.Path(tmp) / "state.json"
+        write_state_file(state_file, size_mb)
+        actual_mb = state_file.stat().st_size / 1024 / 1024
+
+        with patch.object(WorkVariable, "class_from_name", staticmethod(linear_class_from_name)):
+            scanning, count = time_restore(state_file)
+        registry, _ = time_restore(state_file)
+
+    # The lookup on its own, for the name found deepest in the class tree
+    deepest = max(WorkVariable.type_names(), key=lambda name: len(WorkVariable.class_from_name(name).__mro__))
+    scan_lookup = timeit.timeit(lambda: linear_class_from_name(deepest), number=LOOKUPS) / LOOKUPS
+    registry_lookup = timeit.timeit(lambda: WorkVariable.class_from_name(deepest), number=LOOKUPS) / LOOKUPS
+
+    print(f"restore_state() of a {actual_mb:.0f} MB state file ({count} instances)")
+    print(f"  linear scan of the subclasses : {scanning:6.2f} s")
+    print(f"  type registry                 : {registry:6.2f} s")
+    print(f"class_from_name({deepest!r})")
+    print(f"  linear scan of the subclasses : {scan_lookup * 1e6:6.2f} us")
+    print(f"  type registry                 : {registry_lookup * 1e6:6.2f} us")
+
+
+if __name__ == "__main__":
+    main()
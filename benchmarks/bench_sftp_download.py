@@ -0,0 +1,145 @@
+"""Throughput of the SFTP downloads over a link with a long round trip, for a few channel windows,
+block sizes, request depths and numbers of files at a time, to pick the defaults in
+builtin_addons/ssh.
+
+A local asyncssh server stands in for the seedbox, reached through a proxy that holds back
+every chunk by half the round trip each way, so that requests in flight overlap as they
+would over the real link.
+
+Run from the repository root:  python benchmarks/bench_sftp_download.py
+"""
+import asyncio
+import os
+import pathlib
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+import asyncssh
+
+from builtin_addons.ssh import CHANNEL_WINDOW_SIZE
+from builtin_addons.ssh.transfers import TransferSettings, download_files
+from pipeline_backend.instances import Instance
+from pipeline_backend.manager import PipelineManager
+
+ROUND_TRIP_SECONDS = 0.05
+FILES = 8
+FILE_SIZE = 8 * 1024 * 1024
+
+# What asyncssh opens a channel with unless told otherwise
+DEFAULT_WINDOW_SIZE = 2 * 1024 * 1024
+
+# (channel window, block size, max requests, parallel files)
+CASES = [
+    (DEFAULT_WINDOW_SIZE, 16 * 1024, 16, 1),
+    (DEFAULT_WINDOW_SIZE, 256 * 1024, 16, 1),
+    (DEFAULT_WINDOW_SIZE, 256 * 1024, 64, 4),
+    (CHANNEL_WINDOW_SIZE, 256 * 1024, 16, 1),
+    (CHANNEL_WINDOW_SIZE, 256 * 1024, 64, 1),
+    (CHANNEL_WINDOW_SIZE, 256 * 1024, 128, 1),
+    (CHANNEL_WINDOW_SIZE, 1024 * 1024, 64, 1),
+    (CHANNEL_WINDOW_SIZE, 256 * 1024, 16, 4),
+    (CHANNEL_WINDOW_SIZE, 256 * 1024, 64, 4),
+    (CHANNEL_WINDOW_SIZE, 256 * 1024, 64, 8),
+]
+
+
+class AnyPasswordServer(asyncssh.SSHServer):
+    def begin_auth(self, username):
+        return True
+
+    def password_auth_supported(self):
+        return True
+
+    def validate_password(self, username, password):
+        return True
+
+
+async def delayed_copy(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, delay: float) -> None:
+    """Copy reader to writer, each chunk arriving delay seconds after it was sent."""
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def deliver():
+        while True:
+            due, data = await queue.get()
+            if data is None:
+                writer.close()
+                return
+            await asyncio.sleep(max(0.0, due - loop.time()))
+            writer.write(data)
+            await writer.drain()
+
+    delivery = asyncio.create_task(deliver())
+    while data := await reader.read(256 * 1024):
+        queue.put_nowait((loop.time() + delay, data))
+    queue.put_nowait((0.0, None))
+    await delivery
+
+
+async def start_latency_proxy(target_port: int) -> asyncio.Server:
+    async def handle(client_reader, client_writer):
+        server_reader, server_writer = await asyncio.open_connection("127.0.0.1", target_port)
+        try:
+            await asyncio.gather(
+                delayed_copy(client_reader, server_writer, ROUND_TRIP_SECONDS / 2),
+                delayed_copy(server_reader, client_writer, ROUND_TRIP_SECONDS / 2),
+                return_exceptions=True,
+            )
+        except asyncio.CancelledError:
+            # Still winding down when the benchmark finished
+            pass
+
+    return await asyncio.start_server(handle, "127.0.0.1", 0)
+
+
+async def run_case(instance: Instance, port: int, remote: str, local: str, window: int, settings: TransferSettings) -> float:
+    async with asyncssh.connect("127.0.0.1", port=port, username="bench", password="bench", known_hosts=None, window=window) as connection:
+        async with connection.start_sftp_client() as sftp:
+            relpaths = sorted(await sftp.listdir(remote))
+            relpaths = [name for name in relpaths if name not in (".", "..")]
+            start = time.perf_counter()
+            await download_files(instance, sftp, remote, local, relpaths, settings)
+            return time.perf_counter() - start
+
+
+async def main_async() -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        remote = os.path.join(tmp, "remote")
+        os.mkdir(remote)
+        for i in range(FILES):
+            with open(os.path.join(remote, f"file{i}.bin"), "wb") as f:
+                f.write(os.urandom(FILE_SIZE))
+
+        server = await asyncssh.listen(
+            "127.0.0.1", 0,
+            server_host_keys=[asyncssh.generate_private_key("ssh-ed25519")],
+            server_factory=AnyPasswordServer,
+            sftp_factory=True,
+        )
+        proxy = await start_latency_proxy(server.sockets[0].getsockname()[1])
+        proxy_port = proxy.sockets[0].getsockname()[1]
+
+        instance = Instance(PipelineManager().ctx)
+        total = FILES * FILE_SIZE
+        print(f"{FILES} files of {FILE_SIZE // (1024 * 1024)} MiB, {ROUND_TRIP_SECONDS * 1000:.0f} ms round trip")
+        print(f"{'window':>8} {'block size':>12} {'max requests':>13} {'parallel files':>15} {'seconds':>9} {'MiB/s':>8}")
+        for case, (window, block_size, max_requests, parallel_files) in enumerate(CASES):
+            local = os.path.join(tmp, f"local-{case}")
+            os.mkdir(local)
+            elapsed = await run_case(instance, proxy_port, remote, local, window, TransferSettings(block_size, max_requests, parallel_files))
+            print(f"{window // (1024 * 1024):>6} M {block_size // 1024:>10} K {max_requests:>13} {parallel_files:>15} {elapsed:>9.2f} {total / elapsed / (1024 * 1024):>8.1f}")
+
+        proxy.close()
+        server.close()
+        await server.wait_closed()
+
+
+def main() -> None:
+    asyncio.run(main_async())
+
+
+if __name__ == "__main__":
+    main()
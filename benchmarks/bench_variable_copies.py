@@ -0,0 +1,63 @@
+"""What it costs to look up and pass a large variable, now that WorkVariable copies are copy-on-write.
+
+Run from the repository root:  python benchmarks/bench_variable_copies.py
+"""
+import pathlib
+import sys
+import timeit
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from pipeline_backend.manager import PipelineManager
+from pipeline_backend.variables import Dictionary, String, VariableList
+from pipeline_backend.workflows import Workflow
+
+ENTRIES = 5000
+ITERATIONS = 2000
+
+
+def make_feed() -> VariableList:
+    """Roughly what an RSS fetch leaves behind - a list of small Dictionaries."""
+    return VariableList([
+        Dictionary({"title": String(f"Entry {i}"), "link": String(f"https://example.com/{i}")})
+        for i in range(ENTRIES)
+    ])
+
+
+def eager_deepcopy(var):
+    """A full copy of the kind every lookup made before values were shared."""
+    copied = var.__class__.__new__(var.__class__)
+    value = var.read_value()
+    if isinstance(value, list):
+        copied.value = [eager_deepcopy(item) for item in value]
+    elif isinstance(value, dict):
+        copied.value = {key: eager_deepcopy(item) for key, item in value.items()}
+    else:
+        copied.value = value
+    return copied
+
+
+def main() -> None:
+    mgr = PipelineManager()
+    wf = Workflow(mgr.ctx)
+    wf.uuid = "bench"
+    mgr.ctx.workflows[wf.uuid] = wf
+    inst = wf.spawn_instance()
+    inst["feed"] = make_feed()
+
+    eager = timeit.timeit(lambda: eager_deepcopy(inst.variables["feed"]), number=20) / 20
+    lookup = timeit.timeit(lambda: inst["feed"], number=ITERATIONS) / ITERATIONS
+    path_lookup = timeit.timeit(lambda: inst["feed.4999"], number=ITERATIONS) / ITERATIONS
+    store = timeit.timeit(lambda: inst.__setitem__("copy", inst["feed"]), number=ITERATIONS) / ITERATIONS
+    first_write = timeit.timeit(lambda: inst["feed"].value.append(String("x")), number=200) / 200
+
+    print(f"{ENTRIES} entry VariableList of Dictionaries")
+    print(f"  eager recursive copy (old lookup cost)   : {eager * 1e3:10.3f} ms")
+    print(f"  instance['feed']                         : {lookup * 1e6:10.2f} us")
+    print(f"  instance['feed.4999']                    : {path_lookup * 1e6:10.2f} us")
+    print(f"  instance['copy'] = instance['feed']      : {store * 1e6:10.2f} us")
+    print(f"  first write to a looked up copy          : {first_write * 1e3:10.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
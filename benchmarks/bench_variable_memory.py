@@ -0,0 +1,63 @@
+"""Bytes per feed entry held as WorkVariables, slotted versus the old __dict__ per object layout.
+
+Run from the repository root:  python benchmarks/bench_variable_memory.py
+"""
+import pathlib
+import sys
+import tracemalloc
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from pipeline_backend.variables import Dictionary, String, VariableList
+
+ENTRIES = 10000
+
+
+class UnslottedVariable:
+    """Stands in for a WorkVariable before it was slotted - just a value in a per-object __dict__."""
+
+    def __init__(self, value) -> None:
+        self.value = value
+
+
+def feed_entry_values(i: int) -> dict[str, str]:
+    """The fields the RSS addon keeps for each entry."""
+    return {
+        "title": f"Some Show - Episode {i}",
+        "link": f"https://example.com/feed/item/{i}",
+        "guid": f"urn:uuid:00000000-0000-0000-0000-{i:012d}",
+        "published": "Sat, 17 Oct 2026 12:00:00 +0000",
+        "description": f"Episode {i} of the show",
+    }
+
+
+def build_slotted(values: list[dict[str, str]]):
+    return VariableList([Dictionary({key: String(value) for key, value in entry.items()}) for entry in values])
+
+
+def build_unslotted(values: list[dict[str, str]]):
+    return UnslottedVariable([UnslottedVariable({key: UnslottedVariable(value) for key, value in entry.items()}) for entry in values])
+
+
+def bytes_per_entry(build, values: list[dict[str, str]]) -> float:
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    payload = build(values)
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del payload
+    return (after - before) / len(values)
+
+
+def main() -> None:
+    # Built up front so the strings themselves are not counted, only the variables holding them
+    values = [feed_entry_values(i) for i in range(ENTRIES)]
+    unslotted = bytes_per_entry(build_unslotted, values)
+    slotted = bytes_per_entry(build_slotted, values)
+    print(f"{ENTRIES} feed entries of {len(values[0])} String fields in a VariableList of Dictionaries")
+    print(f"  __dict__ per variable : {unslotted:8.0f} bytes per entry")
+    print(f"  slotted variables     : {slotted:8.0f} bytes per entry ({1 - slotted / unslotted:.0%} smaller)")
+
+
+if __name__ == "__main__":
+    main()
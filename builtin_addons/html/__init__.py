@@ -19,6 +19,7 @@ from pipeline_backend.event_callbacks import (
 )
 from pipeline_backend.instances import Instance
 from pipeline_backend.manager import pipelineManager
+from pipeline_backend.plans import WorkflowCompileError, compile_workflow
 from pipeline_backend.variables import WorkVariable
 from pipeline_backend.workflows import RunStates, Workflow, ProcessingStep
 
@@ -175,7 +176,7 @@ secrets_store = VariableStore(
 # ---------------------------------------------------------------------------
 
 def _var_type_names() -> list[str]:
-    return [cls.__name__ for cls in WorkVariable.__subclasses__()]
+    return WorkVariable.type_names()
 
 
 # ---------------------------------------------------------------------------
@@ -799,13 +800,31 @@ async def save_workflow(request: Request, uuid: str):
     form = await request.form()
     draft.name = (form.get("name") or "").strip() or "Untitled"
     draft.user_notes = form.get("user_notes") or ""
+    try:
+        draft.max_running_instances = max(0, int(form.get("max_running_instances") or 0))
+    except ValueError:
+        ctx = _design_context(uuid, draft)
+        content = templates.get_template("workflow_design.html").render(**ctx)
+        return HTMLResponse(content + _toast_oob("Max running instances must be a whole number."))
 
     # Preserve runtime state
     draft.state = saved.state
 
+    # A workflow with a step that can never run is not saved, so its instances keep the working version.
+    # Compiled afresh as the draft's step lists are edited in place.
+    try:
+        compile_workflow(draft)
+    except WorkflowCompileError as e:
+        ctx = _design_context(uuid, draft)
+        content = templates.get_template("workflow_design.html").render(**ctx)
+        return HTMLResponse(content + _toast_oob(f"Unable to save: {e}"))
+    draft.compile_error = None
+
     # Flush draft → saved
     pipelineManager.ctx.workflows[uuid] = deepcopy(draft)
-    pipelineManager.ctx.workflows[uuid].ctx = pipelineManager.ctx  # reattach — deepcopy detaches ctx
+    if saved.compile_error:
+        # Its instances were held back while the saved version did not compile
+        pipelineManager.ctx.due_queue.push_all(pipelineManager.ctx.workflows[uuid].get_instances())
     # Reset draft to freshly saved state
     workflow_drafts[uuid] = deepcopy(pipelineManager.ctx.workflows[uuid])
 
@@ -908,6 +927,7 @@ async def spawn_instance(request: Request, uuid: str):
 @router.post("/workflow/{uuid}/instances/{iuuid}/delete", response_class=HTMLResponse)
 async def delete_instance(uuid: str, iuuid: str):
     pipelineManager.ctx.instances.pop(iuuid, None)
+    pipelineManager.ctx.instance_logs.discard(iuuid)
     pipelineManager.save_state()
     wf = pipelineManager.ctx.workflows.get(uuid)
     if not wf:
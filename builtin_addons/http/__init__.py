@@ -98,4 +98,5 @@ async def http_download_file(instance: Instance, requestInfo: Dictionary, url: S
   requestInfo: Dictionary with optional cookie/Cookie, referer/Referer, username/password, or headers Dictionary.
   url: HTTP/HTTPS URL to download.
   localpath: Local path where the file will be saved."""
-    return await asyncio.to_thread(_download_file, instance, requestInfo, url.value, localpath.value)
+    async with instance.ctx.host_limits.acquire(url.value):
+        return await asyncio.to_thread(_download_file, instance, requestInfo, url.value, localpath.value)
@@ -1,34 +1,55 @@
 from pipeline_backend import *
-import asyncio
+from concurrent.futures.process import BrokenProcessPool
+import http.client
+import urllib.request
 import feedparser
-import traceback
 
-from pipeline_backend.commands_builtin import yield_for_seconds
+from pipeline_backend.cpu_pool import cpu_bound
 
 # RSS Spec https://www.rssboard.org/rss-specification#requiredChannelElements
 
-@Commands.register_command(category="RSS Feed")
+# The parts of each entry we keep
+ENTRY_FIELDS = ("title", "link", "summary", "id", "published")
+
+# A feed that has not come back by now is not going to, so give up and try again later
+FETCH_TIMEOUT_SECONDS = 120
+# Network errors (OSError covers timeouts, refused connections and HTTP error statuses), a
+# response cut short, and a CPU pool worker that died are all likely only transitory, so keep
+# trying for as long as it takes
+FETCH_RETRY_POLICY = RetryPolicy(max_attempts=0, backoff_seconds=60, max_backoff_seconds=3600,
+                                 retry_on=(OSError, http.client.HTTPException, BrokenProcessPool))
+
+def _download_feed(url: str) -> bytes:
+    """Fetch the feed as it is, on a blocking command thread."""
+    request = urllib.request.Request(url, headers={"User-Agent": "WebAutotender/1.0"})
+    with urllib.request.urlopen(request, timeout=FETCH_TIMEOUT_SECONDS) as response:
+        return response.read()
+
+@cpu_bound
+def _parse_feed_entries(feed: bytes) -> list[dict[str,str]]:
+    """Parse the feed, which is where the time goes once it is fetched, in a worker process. Hands back just the fields we keep as plain strings."""
+    parser = feedparser.parse(feed)
+    return [{field: str(entry[field]) for field in ENTRY_FIELDS if field in entry} for entry in parser.entries]
+
+@Commands.register_command(category="RSS Feed", timeout_seconds=FETCH_TIMEOUT_SECONDS, retry_policy=FETCH_RETRY_POLICY)
 async def rssfeed_get_entries(instance:Instance,feed_url:URL,output_list_name:VariablePath) -> CommandReturnStatus:
-    """Fetch all entries from an RSS feed and store them as a VariableList of Dictionaries, oldest-first. Yields and retries after 60 seconds on network errors.
+    """Fetch all entries from an RSS feed and store them as a VariableList of Dictionaries, oldest-first. On network errors it tries again after a minute, backing off to an hour while they carry on.
   feed_url: URL of the RSS feed to fetch.
   output_list_name: Name of the variable to store the VariableList of entry Dictionaries in. Each entry may have keys: title, link, summary, id, published. Entries are reversed on the assumption the feed is newest-first, and only truly sorted when they carry a published date."""
     # gets all the items in an rssfeed at the given url and saves it to a variable, the first item being the oldest, the last being the newest
 
-    try:
-        parser = await asyncio.get_event_loop().run_in_executor(None, lambda: feedparser.parse(feed_url.value))
-    except Exception as e:
-        instance.log_line(traceback.format_exc())
-        # Try again later, it is likely only a transitory problem
-        yield_for_seconds(instance,Integer(60))
-        return CommandReturnStatus.Yield | CommandReturnStatus.Keep_Position
+    # Only the parsing goes to the CPU pool, as a worker waiting on a slow server would hold up the parsing of everything else
+    async with instance.ctx.host_limits.acquire(feed_url.value):
+        feed = await run_blocking(_download_feed, feed_url.value)
+    feed_entries = await _parse_feed_entries(feed)
 
-    if len(parser.entries) == 0:
+    if len(feed_entries) == 0:
         instance[output_list_name] = VariableList()
         return CommandReturnStatus.Success
 
     # parse out entries in the feed for the information we want
     entries = VariableList()
-    for entry in parser.entries:
+    for entry in feed_entries:
         parsed_entry :dict[str,WorkVariable] = {}
         if "title" in entry:
             parsed_entry["title"] = String(entry["title"])
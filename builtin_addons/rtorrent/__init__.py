@@ -1,14 +1,33 @@
 from pipeline_backend import *
 from pipeline_backend.commands_builtin import *
 from pipeline_backend.commands_builtin import yield_for_seconds
+from pipeline_backend.cpu_pool import cpu_bound
+from pipeline_backend.event_callbacks import eventsCallbackManager, EventCallbacksManager
 
 import asyncio
+from functools import partial
 import hashlib
 import http.client
 import urllib.parse
 import xmlrpc.client
 import urllib.request
 
+from .poller import StatusPoller
+
+# How long a command may take talking to rTorrent before it is cancelled and tried again later.
+# Adding a torrent also fetches the .torrent file and waits for rTorrent to list it, so it gets longer
+RPC_COMMAND_TIMEOUT_SECONDS = 120
+ADD_TORRENT_TIMEOUT_SECONDS = 300
+
+# When the server cannot be reached the commands back off and try again. The waits already
+# poll for as long as it takes, so they keep at it, where the rest give up after a few tries
+RPC_RETRY_POLICY = RetryPolicy(max_attempts=5, backoff_seconds=30, max_backoff_seconds=1800, retry_on=(OSError,))
+WAIT_RETRY_POLICY = RetryPolicy(max_attempts=0, backoff_seconds=30, max_backoff_seconds=1800, retry_on=(OSError,))
+
+# The waits are woken by their server's StatusPoller once the torrent is ready, so checking
+# again on their own is only a fallback, in case the poller was stopped or restarted meanwhile
+WAIT_RECHECK_SECONDS = 300
+
 _server_locks: dict[str, asyncio.Lock] = {}
 
 def _get_server_lock(url: str) -> asyncio.Lock:
@@ -22,6 +41,21 @@ async def _run_for_server(url: str, func):
         return await asyncio.to_thread(func)
 
 
+async def _run_rpc(ctx, url: str, func):
+    async with ctx.host_limits.acquire(url):
+        return await _run_for_server(url, func)
+
+
+# One per pipeline, server and account, shared by every instance of the pipeline waiting on a torrent there
+status_pollers: dict[tuple[PipelineContext, str, str, str], StatusPoller] = {}
+
+async def _stop_pollers(event, uuid="", data=""):
+    for poller in status_pollers.values():
+        poller.stop()
+
+eventsCallbackManager.register_callback(EventCallbacksManager.Events.ClosingDown, _stop_pollers)
+
+
 class _TimeoutTransport(xmlrpc.client.SafeTransport):
     def __init__(self, timeout:int, **kwargs):
         super().__init__(**kwargs)
@@ -47,6 +81,7 @@ def _bencode_find_end(data: bytes, start: int) -> int:
         return colon + 1 + length
     raise ValueError(f"Invalid bencode byte {c!r} at position {start}")
 
+@cpu_bound
 def _infohash_from_torrent_bytes(data: bytes) -> str:
     """Compute the infohash of a .torrent file from its raw bytes."""
     info_key = b"4:info"
@@ -119,7 +154,21 @@ class Server:
         return self.serverInfo.value['URL'].value
 
     async def run_rpc(self, func):
-        return await _run_for_server(self.url, func)
+        return await _run_rpc(self.instance.ctx, self.url, func)
+
+    def status_poller(self) -> StatusPoller:
+        """The poller for this server and account, set to the "poll interval seconds" in the serverInfo if there is one."""
+        ctx = self.instance.ctx
+        key = (ctx, self.url, self.serverInfo.value['username'].value, hashlib.sha256(self.serverInfo.value['password'].value.encode()).hexdigest())
+        if key not in status_pollers:
+            status_pollers[key] = StatusPoller(self.connection, partial(_run_rpc, ctx, self.url), ctx.notify_of_something_happening)
+        poller = status_pollers[key]
+        if "poll interval seconds" in self.serverInfo.value:
+            try:
+                poller.interval = max(1.0, float(self.serverInfo.value["poll interval seconds"].value))
+            except (TypeError, ValueError):
+                self.instance.log_line("Ignoring 'poll interval seconds' in the serverInfo, as it is not a number")
+        return poller
     
     async def get_total_torrents_list(self)->list["Torrent"]:
         infohashes = await self.run_rpc(self.connection.download_list)
@@ -137,8 +186,9 @@ class Server:
         else:
             # workaround for whatbox getting banned from downloading from nyaa.si:
             # download the torrent file here and push the raw bytes to rtorrent
-            torrent_bytes = await asyncio.to_thread(lambda: urllib.request.urlopen(url).read())
-            infohash = _infohash_from_torrent_bytes(torrent_bytes)
+            async with self.instance.ctx.host_limits.acquire(url):
+                torrent_bytes = await asyncio.to_thread(lambda: urllib.request.urlopen(url).read())
+            infohash = await _infohash_from_torrent_bytes(torrent_bytes)
             await self.run_rpc(lambda: self.connection.load.raw_start("", torrent_bytes))
         while infohash not in await self.run_rpc(self.connection.download_list):
             await asyncio.sleep(1)
@@ -217,7 +267,7 @@ class Torrent:
             self.server.connection.d.erase(self.infohash)
         await self.server.run_rpc(delete)
 
-@Commands.register_command(category="rTorrent")
+@Commands.register_command(category="rTorrent", timeout_seconds=ADD_TORRENT_TIMEOUT_SECONDS, retry_policy=RPC_RETRY_POLICY)
 async def rtorrent_add_torrent_to_server(instance:Instance,serverInfo:Dictionary,url:String,outputHashName:VariablePath)->CommandReturnStatus:
     """Add a torrent URL or magnet link to an rTorrent server and store the resulting infohash.
   serverInfo: Dictionary with keys URL, username, and password for the rTorrent XMLRPC endpoint.
@@ -228,44 +278,37 @@ async def rtorrent_add_torrent_to_server(instance:Instance,serverInfo:Dictionary
     instance[outputHashName] = String(torrent.infohash)
     return CommandReturnStatus.Success
 
-@Commands.register_command(category="rTorrent")
-async def rtorrent_wait_until_complete(instance:Instance,serverInfo:Dictionary,infohash:String)->CommandReturnStatus:
-    """Yield and re-check every 30 seconds until a torrent finishes downloading. Seed ratios and limits on the server do not prevent it from counting as complete.
-  serverInfo: Dictionary with keys URL, username, and password for the rTorrent XMLRPC endpoint.
-  infohash: The infohash string of the torrent to wait on."""
-    server = Server(instance,serverInfo)
-    torrent = Torrent(server,infohash.value)
-    try:
-        complete = await torrent.is_complete()
-    except OSError as e:
-        instance.log_line(f"Connection error checking torrent completion, will retry: {e}")
-        yield_for_seconds(instance,Integer(30))
-        return CommandReturnStatus.Yield|CommandReturnStatus.Keep_Position
-    if complete:
+async def _wait_on_status(instance: Instance, serverInfo: Dictionary, infohash: String, condition) -> CommandReturnStatus:
+    poller = Server(instance,serverInfo).status_poller()
+    # Whatever this instance left waiting last time has woken it or been overtaken by this run
+    poller.stop_waiting(instance)
+    status = await poller.status(infohash.value)
+    if status is None:
+        instance.log_line(f"Unable to find the torrent '{infohash.value}' on the server")
+        return CommandReturnStatus.Error
+    if condition(status):
         return CommandReturnStatus.Success
-    yield_for_seconds(instance,Integer(30))
+    poller.wake_when(instance, infohash.value, condition)
+    yield_for_seconds(instance,Integer(WAIT_RECHECK_SECONDS))
     return CommandReturnStatus.Yield|CommandReturnStatus.Keep_Position
 
-@Commands.register_command(category="rTorrent")
+@Commands.register_command(category="rTorrent", timeout_seconds=RPC_COMMAND_TIMEOUT_SECONDS, retry_policy=WAIT_RETRY_POLICY)
+async def rtorrent_wait_until_complete(instance:Instance,serverInfo:Dictionary,infohash:String)->CommandReturnStatus:
+    """Yield until a torrent finishes downloading, woken by the poller that checks every torrent on the server at once every 30 seconds. Seed ratios and limits on the server do not prevent it from counting as complete.
+  serverInfo: Dictionary with keys URL, username, and password for the rTorrent XMLRPC endpoint. Optionally "poll interval seconds" to poll the server more or less often.
+  infohash: The infohash string of the torrent to wait on."""
+    return await _wait_on_status(instance, serverInfo, infohash, lambda status: status.complete)
+
+@Commands.register_command(category="rTorrent", timeout_seconds=RPC_COMMAND_TIMEOUT_SECONDS, retry_policy=WAIT_RETRY_POLICY)
 async def rtorrent_wait_until_ratio(instance:Instance,serverInfo:Dictionary,infohash:String,ratio:Float)->CommandReturnStatus:
-    """Yield and re-check every 5 minutes until a torrent's seed ratio reaches the target. Retries after 30 seconds instead if the server cannot be reached.
-  serverInfo: Dictionary with keys URL, username, and password for the rTorrent XMLRPC endpoint.
+    """Yield until a torrent's seed ratio reaches the target, woken by the poller that checks every torrent on the server at once every 30 seconds. If the server cannot be reached it tries again after 30 seconds, backing off while it stays down.
+  serverInfo: Dictionary with keys URL, username, and password for the rTorrent XMLRPC endpoint. Optionally "poll interval seconds" to poll the server more or less often.
   infohash: The infohash string of the torrent to wait on.
   ratio: The minimum seed ratio to wait for (e.g. 1.0 for 1:1)."""
-    server = Server(instance,serverInfo)
-    torrent = Torrent(server,infohash.value)
-    try:
-        current_ratio = await torrent.get_ratio()
-    except OSError as e:
-        instance.log_line(f"Connection error checking torrent ratio, will retry: {e}")
-        yield_for_seconds(instance,Integer(30))
-        return CommandReturnStatus.Yield|CommandReturnStatus.Keep_Position
-    if current_ratio >= ratio.value:
-        return CommandReturnStatus.Success
-    yield_for_seconds(instance,Integer(300))
-    return CommandReturnStatus.Yield|CommandReturnStatus.Keep_Position
+    target = ratio.value
+    return await _wait_on_status(instance, serverInfo, infohash, lambda status: status.ratio >= target)
 
-@Commands.register_command(category="rTorrent")
+@Commands.register_command(category="rTorrent", timeout_seconds=RPC_COMMAND_TIMEOUT_SECONDS, retry_policy=RPC_RETRY_POLICY)
 async def rtorrent_set_torrent_label(instance:Instance,serverInfo:Dictionary,infohash:String,label:String)->CommandReturnStatus:
     """Set the custom label (custom1) on a torrent in rTorrent.
   serverInfo: Dictionary with keys URL, username, and password for the rTorrent XMLRPC endpoint.
@@ -276,7 +319,7 @@ async def rtorrent_set_torrent_label(instance:Instance,serverInfo:Dictionary,inf
     await torrent.set_label(label.value)
     return CommandReturnStatus.Success
 
-@Commands.register_command(category="rTorrent")
+@Commands.register_command(category="rTorrent", timeout_seconds=RPC_COMMAND_TIMEOUT_SECONDS, retry_policy=RPC_RETRY_POLICY)
 async def rtorrent_get_torrent_name(instance:Instance,serverInfo:Dictionary,infohash:String,varnameOut:VariablePath)->CommandReturnStatus:
     """Retrieve the display name of a torrent and store it in a variable.
   serverInfo: Dictionary with keys URL, username, and password for the rTorrent XMLRPC endpoint.
@@ -288,7 +331,7 @@ async def rtorrent_get_torrent_name(instance:Instance,serverInfo:Dictionary,info
     instance[varnameOut] = String(name)
     return CommandReturnStatus.Success
 
-@Commands.register_command(category="rTorrent")
+@Commands.register_command(category="rTorrent", timeout_seconds=RPC_COMMAND_TIMEOUT_SECONDS, retry_policy=RPC_RETRY_POLICY)
 async def rtorrent_get_torrents_path(instance:Instance,serverInfo:Dictionary,infohash:String,varnameOut:VariablePath)->CommandReturnStatus:
     """Retrieve the base download path of a torrent (where its files are saved) and store it in a variable.
   serverInfo: Dictionary with keys URL, username, and password for the rTorrent XMLRPC endpoint.
@@ -301,7 +344,7 @@ async def rtorrent_get_torrents_path(instance:Instance,serverInfo:Dictionary,inf
     return CommandReturnStatus.Success
 
 
-@Commands.register_command(category="rTorrent")
+@Commands.register_command(category="rTorrent", timeout_seconds=RPC_COMMAND_TIMEOUT_SECONDS, retry_policy=RPC_RETRY_POLICY)
 async def rtorrent_get_torrent_download_url(instance:Instance,serverInfo:Dictionary,infohash:String,downloadBaseUrl:String,varnameOut:VariablePath)->CommandReturnStatus:
     """Build a ruTorrent-style HTTPS download URL for a single-file torrent and store it in a variable.
   serverInfo: Dictionary with keys URL, username, and password for the rTorrent XMLRPC endpoint.
@@ -317,7 +360,7 @@ async def rtorrent_get_torrent_download_url(instance:Instance,serverInfo:Diction
     instance[varnameOut] = String(_rutorrent_download_url(downloadBaseUrl.value, filepaths[0]))
     return CommandReturnStatus.Success
 
-@Commands.register_command(category="rTorrent")
+@Commands.register_command(category="rTorrent", timeout_seconds=RPC_COMMAND_TIMEOUT_SECONDS, retry_policy=RPC_RETRY_POLICY)
 async def rtorrent_delete_torrent_but_not_files(instance:Instance,serverInfo:Dictionary,infohash:String)->CommandReturnStatus:
     """Remove a torrent from rTorrent without deleting the downloaded files on the server.
   serverInfo: Dictionary with keys URL, username, and password for the rTorrent XMLRPC endpoint.
@@ -0,0 +1,153 @@
+import asyncio
+import time
+from collections.abc import Awaitable, Callable
+from datetime import datetime
+
+from pipeline_backend.instances import Instance
+
+# =====================================================================================
+# Torrent Status Polling
+# =====================================================================================
+# The wait commands used to each ask rTorrent about their own torrent every time they ran,
+# which with hundreds of torrents waiting on one server is hundreds of round trips for what a
+# single d.multicall2 returns for every torrent at once. Instead there is one StatusPoller per
+# server and account, which fetches the status of every torrent each interval seconds and
+# keeps it for the wait commands to read.
+#
+# A wait that is not yet satisfied leaves a condition with the poller, which wakes the instance
+# as soon as a poll finds it met rather than leaving it asleep until its next check. A poller
+# that nothing has read from for POLLER_IDLE_SECONDS stops, and starts again when next asked.
+
+POLL_INTERVAL_SECONDS = 30
+POLLER_IDLE_SECONDS = 600
+
+# The fields of each torrent that are fetched, in the order d.multicall2 returns them
+MULTICALL_FIELDS = ("d.hash=", "d.complete=", "d.ratio=", "d.name=", "d.base_path=")
+
+
+class TorrentStatus:
+    complete: bool
+    ratio: float
+    name: str
+    base_path: str
+
+    def __init__(self, complete: bool, ratio: float, name: str, base_path: str) -> None:
+        self.complete = complete
+        self.ratio = ratio
+        self.name = name
+        self.base_path = base_path
+
+    @classmethod
+    def from_multicall(cls, row: list) -> tuple[str, "TorrentStatus"]:
+        infohash, complete, raw_ratio, name, base_path = row
+        # rTorrent gives the ratio multiplied by a thousand
+        return infohash.upper(), cls(int(complete) == 1, float(raw_ratio) / 1000.0, name, base_path)
+
+
+def _statuses_from_rows(rows: list) -> dict[str, TorrentStatus]:
+    statuses = {}
+    for row in rows:
+        try:
+            infohash, status = TorrentStatus.from_multicall(row)
+        except (ValueError, TypeError, AttributeError) as e:
+            # Left out, rather than one torrent rTorrent reports oddly costing the statuses of all the rest
+            print(f"Skipping a torrent status from rTorrent that could not be read - {row!r}: {e}")
+            continue
+        statuses[infohash] = status
+    return statuses
+
+
+class StatusPoller:
+    interval: float
+    # When the statuses were last fetched, as time.monotonic(). None before the first poll
+    polled_at: float | None
+    # The error of the latest poll, which whoever reads the statuses gets raised for them
+    error: BaseException | None
+
+    def __init__(self, connection, run_rpc: Callable[[Callable], Awaitable], notify: Callable[[], Awaitable], interval: float = POLL_INTERVAL_SECONDS) -> None:
+        self.connection = connection
+        self.run_rpc = run_rpc
+        self.notify = notify
+        self.interval = interval
+        self.polled_at = None
+        self.error = None
+        self.polls = 0
+        self._statuses: dict[str, TorrentStatus] = {}
+        # By the uuid of the waiting instance, the torrent it waits on and what it waits for
+        self._waiters: dict[str, tuple[Instance, str, Callable[[TorrentStatus], bool]]] = {}
+        self._last_read = time.monotonic()
+        self._polling: asyncio.Future | None = None
+        self._task: asyncio.Task | None = None
+
+    def is_running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self) -> None:
+        if not self.is_running():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self) -> None:
+        while time.monotonic() - self._last_read < POLLER_IDLE_SECONDS or self._waiters:
+            await self.refresh()
+            await asyncio.sleep(self.interval)
+
+    async def refresh(self) -> None:
+        """Fetch the statuses now, or wait on the fetch already under way."""
+        if self._polling is None:
+            self._polling = asyncio.ensure_future(self._poll())
+        # Shielded so that one reader being cancelled does not cancel the poll for the rest
+        await asyncio.shield(self._polling)
+
+    async def _poll(self) -> None:
+        try:
+            rows = await self.run_rpc(lambda: self.connection.d.multicall2("", "main", *MULTICALL_FIELDS))
+            statuses = _statuses_from_rows(rows)
+        except Exception as e:
+            self.error = e
+            return
+        finally:
+            self._polling = None
+        self.error = None
+        self.polls += 1
+        self.polled_at = time.monotonic()
+        self._statuses = statuses
+        await self._wake_waiters()
+
+    async def _wake_waiters(self) -> None:
+        woken = False
+        for uuid, (instance, infohash, condition) in list(self._waiters.items()):
+            if instance.ctx.instances.get(uuid) is not instance:
+                del self._waiters[uuid]
+                continue
+            status = self._statuses.get(infohash)
+            # A torrent that has gone from the server wakes its instance too, for the command to report
+            if status is None or condition(status):
+                del self._waiters[uuid]
+                instance.next_processing_time = datetime.now()
+                woken = True
+        if woken:
+            await self.notify()
+
+    async def status(self, infohash: str) -> TorrentStatus | None:
+        """The latest status of infohash, fetching it afresh if the server has not listed it yet. None if the server does not have it."""
+        self._last_read = time.monotonic()
+        self.start()
+        infohash = infohash.upper()
+        if self.polled_at is None or self.error is not None or infohash not in self._statuses:
+            # Before the first poll, after a failed one, or added since the latest
+            await self.refresh()
+        if self.error is not None:
+            raise self.error
+        return self._statuses.get(infohash)
+
+    def wake_when(self, instance: Instance, infohash: str, condition: Callable[[TorrentStatus], bool]) -> None:
+        """Wake instance as soon as a poll finds condition true of the torrent's status."""
+        self._waiters[instance.uuid] = (instance, infohash.upper(), condition)
+
+    def stop_waiting(self, instance: Instance) -> None:
+        self._waiters.pop(instance.uuid, None)
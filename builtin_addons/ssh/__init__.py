@@ -5,9 +5,14 @@ import shlex
 
 from pipeline_backend import *
 from pipeline_backend.commands_builtin import *
+from pipeline_backend.event_callbacks import eventsCallbackManager, EventCallbacksManager
 import asyncssh
 from datetime import datetime
 
+from .pool import SSHConnectionPool, pool_key
+from .transfers import (DownloadProgress, MirrorManifest, TransferSettings, changed_files, download_file, download_files, make_local_folders,
+                        mark_mirrored, part_path, walk_remote_tree)
+
 """
 We assume that the account information that we need is passed in as a Dictionary.
 This should have the following variables inside of it:
@@ -17,6 +22,26 @@ This should have the following variables inside of it:
     - password is a raw password, ssh key is the contents of a private key file (PEM format), and the filepath is a tring filepath to look read the key from
 """
 
+# Listing and deleting are quick unless the connection has hung, so they get cancelled and tried
+# again later. Downloads take as long as they take and have no timeout.
+METADATA_TIMEOUT_SECONDS = 120
+# A recursive delete walks the whole tree one request at a time
+DELETE_FOLDER_TIMEOUT_SECONDS = 600
+# Covers the downloads too, which would otherwise wait on a server that never answers forever
+CONNECT_TIMEOUT_SECONDS = 30
+# How much a channel may have in flight before the server waits on the client to say it has
+# room for more. asyncssh's own 2 MiB held every download over a 50 ms round trip to about
+# 11 MiB/s in benchmarks/bench_sftp_download.py, however many requests were outstanding
+CHANNEL_WINDOW_SIZE = 16 * 1024 * 1024
+
+# Every instance shares the one pool, so a workflow of several SSH steps connects once
+connection_pool = SSHConnectionPool()
+
+async def _close_pool(event, uuid="", data=""):
+    connection_pool.close_all()
+
+eventsCallbackManager.register_callback(EventCallbacksManager.Events.ClosingDown, _close_pool)
+
 @asynccontextmanager
 async def open_ssh_pipe(instance: Instance, serverInfo: Dictionary):
     valid = True
@@ -33,30 +58,44 @@ async def open_ssh_pipe(instance: Instance, serverInfo: Dictionary):
         yield None
         return
 
+    # The lease holds one of the host's slots for as long as the command has it
+    async with instance.ctx.host_limits.acquire(serverInfo.value["URL"].value):
+        async with connection_pool.lease(_pool_key(serverInfo), partial(_connect, serverInfo)) as pooled:
+            yield pooled
+
+def _pool_key(serverInfo: Dictionary):
+    for credential in ("ssh key filepath", "ssh key", "password"):
+        if credential in serverInfo.value:
+            return pool_key(serverInfo.value["URL"].value, serverInfo.value["username"].value, f"{credential}:{serverInfo.value[credential].value}")
+
+async def _connect(serverInfo: Dictionary) -> asyncssh.SSHClientConnection:
     # prioritize using an ssh key if both that and a password has been specified
     if "ssh key filepath" in serverInfo.value:
         connection = await asyncssh.connect(
             serverInfo.value["URL"].value,
             username=serverInfo.value["username"].value,
-            client_keys=[serverInfo.value["ssh key filepath"].value]
+            client_keys=[serverInfo.value["ssh key filepath"].value],
+            connect_timeout=CONNECT_TIMEOUT_SECONDS,
+            window=CHANNEL_WINDOW_SIZE,
         )
     elif "ssh key" in serverInfo.value:
         keyfile = parse_ssh_private_key(serverInfo.value["ssh key"].value)
         connection = await asyncssh.connect(
             serverInfo.value["URL"].value,
             username=serverInfo.value["username"].value,
-            client_keys=[keyfile]
+            client_keys=[keyfile],
+            connect_timeout=CONNECT_TIMEOUT_SECONDS,
+            window=CHANNEL_WINDOW_SIZE,
         )
     else:
         connection = await asyncssh.connect(
             serverInfo.value["URL"].value,
             username=serverInfo.value["username"].value,
             password=serverInfo.value["password"].value,
+            connect_timeout=CONNECT_TIMEOUT_SECONDS,
+            window=CHANNEL_WINDOW_SIZE,
         )
-    try:
-        yield connection
-    finally:
-        connection.close()
+    return connection
 
 def parse_ssh_private_key(key:str)->asyncssh.SSHKey:
     # Due to the nature of the web interface input, it strips all the newlines.
@@ -96,15 +135,15 @@ def file_download_progress_callback(instance:Instance,print_thresholds:dict,sour
         entry["last_time"] = now
         entry["last_bytes"] = bytesdone
 
-@Commands.register_command(category="SSH/SFTP")
+@Commands.register_command(category="SSH/SFTP", timeout_seconds=METADATA_TIMEOUT_SECONDS)
 async def sftp_delete_file(instance: Instance, serverInfo: Dictionary, remotepath: String) -> CommandReturnStatus:
     """Delete a single file on a remote server over SFTP. Errors if the path does not exist or is a directory.
   serverInfo: Dictionary with keys URL, username, and one of password / ssh key / ssh key filepath.
   remotepath: Absolute path to the file on the remote server to delete."""
-    async with open_ssh_pipe(instance, serverInfo) as connection:
-        if not connection:
+    async with open_ssh_pipe(instance, serverInfo) as pipe:
+        if not pipe:
             return CommandReturnStatus.Error
-        sftp: asyncssh.SFTPClient = await connection.start_sftp_client()
+        sftp: asyncssh.SFTPClient = await pipe.sftp_client()
         try:
             await sftp.remove(remotepath.value)
         except asyncssh.SFTPError as e:
@@ -112,15 +151,15 @@ async def sftp_delete_file(instance: Instance, serverInfo: Dictionary, remotepat
             return CommandReturnStatus.Error
     return CommandReturnStatus.Success
 
-@Commands.register_command(category="SSH/SFTP")
+@Commands.register_command(category="SSH/SFTP", timeout_seconds=DELETE_FOLDER_TIMEOUT_SECONDS)
 async def sftp_delete_folder(instance: Instance, serverInfo: Dictionary, remotepath: String) -> CommandReturnStatus:
     """Recursively delete a folder and all its contents on a remote server over SFTP.
   serverInfo: Dictionary with keys URL, username, and one of password / ssh key / ssh key filepath.
   remotepath: Absolute path to the folder on the remote server to delete."""
-    async with open_ssh_pipe(instance, serverInfo) as connection:
-        if not connection:
+    async with open_ssh_pipe(instance, serverInfo) as pipe:
+        if not pipe:
             return CommandReturnStatus.Error
-        sftp: asyncssh.SFTPClient = await connection.start_sftp_client()
+        sftp: asyncssh.SFTPClient = await pipe.sftp_client()
         try:
             await sftp.rmtree(remotepath.value)
         except asyncssh.SFTPError as e:
@@ -128,30 +167,31 @@ async def sftp_delete_folder(instance: Instance, serverInfo: Dictionary, remotep
             return CommandReturnStatus.Error
     return CommandReturnStatus.Success
 
-@Commands.register_command(category="SSH/SFTP")
+@Commands.register_command(category="SSH/SFTP", timeout_seconds=METADATA_TIMEOUT_SECONDS)
 async def sftp_list_directory(instance: Instance, serverInfo: Dictionary, directory: String, outputVarname: VariablePath) -> CommandReturnStatus:
     """List the contents of a remote directory over SFTP and store the names as a StringList.
   serverInfo: Dictionary with keys URL, username, and one of password / ssh key / ssh key filepath.
   directory: Absolute path to the remote directory to list.
   outputVarname: Name of the variable to store the StringList of entry names in."""
-    async with open_ssh_pipe(instance, serverInfo) as connection:
-        if not connection:
+    async with open_ssh_pipe(instance, serverInfo) as pipe:
+        if not pipe:
             return CommandReturnStatus.Error
-        sftp:asyncssh.SFTPClient = await connection.start_sftp_client()
+        sftp:asyncssh.SFTPClient = await pipe.sftp_client()
         entries = await sftp.listdir(directory.value)
         instance[outputVarname] = StringList(entries)
     return CommandReturnStatus.Success
 
 @Commands.register_command(category="SSH/SFTP")
 async def sftp_download_file(instance: Instance, serverInfo: Dictionary, remotepath: String, localpath: String) -> CommandReturnStatus:
-    """Download a single file from a remote server using SFTP, with progress logging.
-  serverInfo: Dictionary with keys URL, username, and one of password / ssh key / ssh key filepath.
+    """Download a single file from a remote server using SFTP, with progress logging. An interrupted download carries on from where it got to.
+  serverInfo: Dictionary with keys URL, username, and one of password / ssh key / ssh key filepath. Optionally "sftp block size" and "sftp max requests" to tune the transfer, and "resume check bytes".
   remotepath: Absolute path to the file on the remote server.
   localpath: Local path where the file will be saved."""
-    async with open_ssh_pipe(instance, serverInfo) as connection:
-        if not connection:
+    settings = TransferSettings.from_server_info(instance, serverInfo)
+    async with open_ssh_pipe(instance, serverInfo) as pipe:
+        if not pipe:
             return CommandReturnStatus.Error
-        sftp:asyncssh.SFTPClient = await connection.start_sftp_client()
+        sftp:asyncssh.SFTPClient = await pipe.sftp_client()
         if not await sftp.exists(remotepath.value):
             instance.log_line(f"Unable to find remote file '{remotepath.value}'")
             return CommandReturnStatus.Error
@@ -161,14 +201,79 @@ async def sftp_download_file(instance: Instance, serverInfo: Dictionary, remotep
         instance.log_line(f"    {human_readable_filesize(filesize)}")
 
         starting_time = datetime.now()
-        await sftp.get(
-            remotepath.value,
-            localpath.value,
-            recurse=False,
-            progress_handler=partial(file_download_progress_callback,instance,dict()),
-        )
+        await download_file(instance, sftp, remotepath.value, localpath.value, settings, partial(file_download_progress_callback,instance,dict()))
         ending_time = datetime.now()
-        bytespersecond = filesize//(ending_time - starting_time).total_seconds()
+        bytespersecond = filesize//max((ending_time - starting_time).total_seconds(), 0.001)
+        instance.log_line(f"    {human_readable_filesize(bytespersecond)}/s")
+    return CommandReturnStatus.Success
+
+@Commands.register_command(category="SSH/SFTP")
+async def sftp_download_folder(instance: Instance, serverInfo: Dictionary, remotepath: String, localpath: String) -> CommandReturnStatus:
+    """Recursively download the contents of a remote folder using SFTP, several files at a time, logging the progress of them all together.
+  serverInfo: Dictionary with keys URL, username, and one of password / ssh key / ssh key filepath. Optionally "sftp block size", "sftp max requests" and "sftp parallel files" to tune the transfer, and "resume check bytes".
+  remotepath: Absolute path to the remote folder to download.
+  localpath: Local folder the contents will be placed in, created if need be."""
+    settings = TransferSettings.from_server_info(instance, serverInfo)
+    async with open_ssh_pipe(instance, serverInfo) as pipe:
+        if not pipe:
+            return CommandReturnStatus.Error
+        sftp:asyncssh.SFTPClient = await pipe.sftp_client()
+        if not await sftp.isdir(remotepath.value):
+            instance.log_line(f"Unable to find remote folder '{remotepath.value}'")
+            return CommandReturnStatus.Error
+        folders, files = await walk_remote_tree(sftp, remotepath.value)
+        totalsize = sum(attrs.size or 0 for _, attrs in files)
+
+        instance.log_line(f"Downloading '{remotepath.value}'\nto '{localpath.value}'")
+        instance.log_line(f"    {len(files)} files, {human_readable_filesize(totalsize)}")
+
+        await run_blocking(make_local_folders, localpath.value, folders)
+        progress = DownloadProgress(partial(file_download_progress_callback,instance,dict()), remotepath.value, localpath.value, totalsize)
+        starting_time = datetime.now()
+        await download_files(instance, sftp, remotepath.value, localpath.value, [relpath for relpath, _ in files], settings, progress.file_progress)
+        ending_time = datetime.now()
+        bytespersecond = totalsize//max((ending_time - starting_time).total_seconds(), 0.001)
+        instance.log_line(f"    {human_readable_filesize(bytespersecond)}/s")
+    return CommandReturnStatus.Success
+
+@Commands.register_command(category="SSH/SFTP")
+async def sftp_mirror_folder(instance: Instance, serverInfo: Dictionary, remotepath: String, localpath: String, manifestpath: String) -> CommandReturnStatus:
+    """Bring a local folder up to date with a remote one over SFTP, downloading only the files that are new or have changed size or modification time. Nothing is deleted locally.
+  serverInfo: Dictionary with keys URL, username, and one of password / ssh key / ssh key filepath. Optionally "sftp block size", "sftp max requests" and "sftp parallel files" to tune the transfer, and "resume check bytes".
+  remotepath: Absolute path to the remote folder to mirror.
+  localpath: Local folder to mirror it into, created if need be.
+  manifestpath: Local path of a manifest of what has been mirrored, so files moved out of localpath are not downloaded again. Leave empty to compare against the files in localpath instead."""
+    settings = TransferSettings.from_server_info(instance, serverInfo)
+    manifest = await run_blocking(MirrorManifest.load, manifestpath.value) if manifestpath.value else None
+    async with open_ssh_pipe(instance, serverInfo) as pipe:
+        if not pipe:
+            return CommandReturnStatus.Error
+        sftp:asyncssh.SFTPClient = await pipe.sftp_client()
+        if not await sftp.isdir(remotepath.value):
+            instance.log_line(f"Unable to find remote folder '{remotepath.value}'")
+            return CommandReturnStatus.Error
+        folders, files = await walk_remote_tree(sftp, remotepath.value)
+        changed = await run_blocking(changed_files, files, localpath.value, manifest)
+        totalsize = sum(attrs.size or 0 for _, attrs in changed)
+
+        instance.log_line(f"Mirroring '{remotepath.value}'\nto '{localpath.value}'")
+        instance.log_line(f"    {len(changed)} of {len(files)} files are new or changed, {human_readable_filesize(totalsize)}")
+        if not changed:
+            return CommandReturnStatus.Success
+
+        await run_blocking(make_local_folders, localpath.value, folders)
+        attributes = dict(changed)
+        progress = DownloadProgress(partial(file_download_progress_callback,instance,dict()), remotepath.value, localpath.value, totalsize)
+        starting_time = datetime.now()
+        try:
+            await download_files(instance, sftp, remotepath.value, localpath.value, list(attributes), settings, progress.file_progress,
+                                 lambda relpath: mark_mirrored(localpath.value, relpath, attributes[relpath], manifest))
+        finally:
+            # Whatever did make it across is not downloaded again next time
+            if manifest is not None:
+                await run_blocking(manifest.save)
+        ending_time = datetime.now()
+        bytespersecond = totalsize//max((ending_time - starting_time).total_seconds(), 0.001)
         instance.log_line(f"    {human_readable_filesize(bytespersecond)}/s")
     return CommandReturnStatus.Success
 
@@ -178,11 +283,11 @@ async def scp_download_folder(instance: Instance, serverInfo: Dictionary, remote
   serverInfo: Dictionary with keys URL, username, and one of password / ssh key / ssh key filepath.
   remotepath: Absolute path to the remote folder to download.
   localpath: Local path where the folder contents will be placed."""
-    async with open_ssh_pipe(instance, serverInfo) as connection:
-        if not connection:
+    async with open_ssh_pipe(instance, serverInfo) as pipe:
+        if not pipe:
             return CommandReturnStatus.Error
         await asyncssh.scp(
-            (connection, shlex.quote(remotepath.value)),
+            (pipe.connection, shlex.quote(remotepath.value)),
             localpath.value,
             recurse=True,
             progress_handler=partial(file_download_progress_callback,instance,dict()),
@@ -191,24 +296,39 @@ async def scp_download_folder(instance: Instance, serverInfo: Dictionary, remote
 
 @Commands.register_command(category="SSH/SFTP")
 async def scp_download_file(instance: Instance, serverInfo: Dictionary, remotepath: String, localpath: String) -> CommandReturnStatus:
-    """Download a single file from a remote server using SCP, with progress logging and final speed summary.
+    """Download a single file from a remote server using SCP, with progress logging and final speed summary. An interrupted download carries on from where it got to over SFTP.
   serverInfo: Dictionary with keys URL, username, and one of password / ssh key / ssh key filepath.
   remotepath: Absolute path to the file on the remote server.
   localpath: Local path where the file will be saved."""
-    async with open_ssh_pipe(instance, serverInfo) as connection:
-        if not connection:
+    async with open_ssh_pipe(instance, serverInfo) as pipe:
+        if not pipe:
             return CommandReturnStatus.Error
         instance.log_line(f"Downloading '{remotepath.value}'\nto '{localpath.value}'")
         starting_time = datetime.now()
-        await asyncssh.scp(
-            (connection, shlex.quote(remotepath.value)),
-            localpath.value,
-            recurse=False,
-            progress_handler=partial(file_download_progress_callback,instance,dict()),
-        )
+        partpath = part_path(localpath.value)
+        resumed = False
+        if await run_blocking(os.path.exists, partpath):
+            # SCP can only ever start from the beginning of a file, but any server recent enough to
+            # have OpenSSH's scp run over SFTP will let the rest of it be read from there
+            try:
+                sftp: asyncssh.SFTPClient = await pipe.sftp_client()
+            except asyncssh.Error as e:
+                instance.log_line(f"    Unable to resume without SFTP, so starting again: {e}")
+            else:
+                await download_file(instance, sftp, remotepath.value, localpath.value, TransferSettings.from_server_info(instance, serverInfo),
+                                    partial(file_download_progress_callback,instance,dict()))
+                resumed = True
+        if not resumed:
+            await asyncssh.scp(
+                (pipe.connection, shlex.quote(remotepath.value)),
+                partpath,
+                recurse=False,
+                progress_handler=partial(file_download_progress_callback,instance,dict()),
+            )
+            await run_blocking(os.replace, partpath, localpath.value)
         ending_time = datetime.now()
-        filesize = os.path.getsize(localpath.value)
-        bytespersecond = filesize // (ending_time - starting_time).total_seconds()
+        filesize = await run_blocking(os.path.getsize, localpath.value)
+        bytespersecond = filesize // max((ending_time - starting_time).total_seconds(), 0.001)
         instance.log_line(f"    {human_readable_filesize(bytespersecond)}/s")
     return CommandReturnStatus.Success
 
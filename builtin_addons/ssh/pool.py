@@ -0,0 +1,190 @@
+import asyncio
+import hashlib
+import time
+from collections.abc import Awaitable, Callable
+from contextlib import asynccontextmanager
+
+import asyncssh
+
+# =====================================================================================
+# SSH Connection Pool
+# =====================================================================================
+# Connecting is a TCP handshake, a key exchange and an authentication, which over a long link
+# to a seedbox costs more than a directory listing does. So rather than connecting for every
+# command, connections are leased from a pool shared by every instance and handed back
+# afterwards for the next command to the same server and account.
+#
+# A connection is leased to one command at a time, with its SFTP client started the first
+# time one is asked for and kept for as long as the connection. One left idle for
+# POOL_IDLE_SECONDS is closed, and one that has sat idle for POOL_HEALTH_CHECK_SECONDS is
+# checked before being handed out again, since the server or a NAT box in between may have
+# dropped it without saying. At most POOL_MAX_CONNECTIONS_PER_KEY connections are open to
+# the same server and account at once, and a lease waits for one to be handed back beyond that.
+#
+# A command that fails on anything other than an SFTPError (file not found and the like) may
+# have left the connection in a bad way, so it is closed rather than handed back. close_all()
+# closes what is idle and whatever was leased out before it as that is handed back, while
+# the pool carries on as usual for anything leased afterwards.
+
+POOL_IDLE_SECONDS = 60.0
+POOL_HEALTH_CHECK_SECONDS = 15.0
+POOL_HEALTH_CHECK_TIMEOUT_SECONDS = 10.0
+POOL_MAX_CONNECTIONS_PER_KEY = 4
+
+PoolKey = tuple[str, str, str]
+
+
+def pool_key(url: str, username: str, credential: str) -> PoolKey:
+    """What a connection can be reused for. The credential is hashed so it is not kept around in the clear."""
+    return (url, username, hashlib.sha256(credential.encode()).hexdigest())
+
+
+class PooledConnection:
+    connection: asyncssh.SSHClientConnection
+    # When it was last handed back, as time.monotonic()
+    last_used: float
+    # The pool's generation when it was opened, so it is closed when handed back after a close_all()
+    generation: int
+
+    def __init__(self, connection: asyncssh.SSHClientConnection, generation: int = 0) -> None:
+        self.connection = connection
+        self.last_used = time.monotonic()
+        self.generation = generation
+        self._sftp: asyncssh.SFTPClient | None = None
+        self._idle_handle: asyncio.TimerHandle | None = None
+
+    async def sftp_client(self) -> asyncssh.SFTPClient:
+        """The SFTP client of the connection, started the first time it is asked for."""
+        if self._sftp is None:
+            self._sftp = await self.connection.start_sftp_client()
+        return self._sftp
+
+    def is_closed(self) -> bool:
+        return self.connection.is_closed()
+
+    async def is_healthy(self) -> bool:
+        if self.is_closed():
+            return False
+        try:
+            sftp = await asyncio.wait_for(self.sftp_client(), POOL_HEALTH_CHECK_TIMEOUT_SECONDS)
+            await asyncio.wait_for(sftp.realpath("."), POOL_HEALTH_CHECK_TIMEOUT_SECONDS)
+        except (OSError, asyncssh.Error, asyncio.TimeoutError):
+            return False
+        return True
+
+    def close(self) -> None:
+        if self._idle_handle:
+            self._idle_handle.cancel()
+            self._idle_handle = None
+        if self._sftp is not None:
+            self._sftp.exit()
+            self._sftp = None
+        self.connection.close()
+
+
+class SSHConnectionPool:
+    idle_seconds: float
+    health_check_seconds: float
+    max_connections_per_key: int
+
+    def __init__(self, idle_seconds: float = POOL_IDLE_SECONDS, health_check_seconds: float = POOL_HEALTH_CHECK_SECONDS,
+                 max_connections_per_key: int = POOL_MAX_CONNECTIONS_PER_KEY) -> None:
+        self.idle_seconds = idle_seconds
+        self.health_check_seconds = health_check_seconds
+        self.max_connections_per_key = max_connections_per_key
+        self._idle: dict[PoolKey, list[PooledConnection]] = {}
+        # Connections open per key, leased out or idle
+        self._open: dict[PoolKey, int] = {}
+        # Replaced every time a connection is handed back or closed, so a lease waiting on the old one wakes up
+        self._handed_back = asyncio.Event()
+        # Bumped by close_all(), which leaves the pool usable again afterwards
+        self._generation = 0
+        # How many leases were served by a connection that was already open, and how many had to connect
+        self.reused = 0
+        self.connected = 0
+
+    def idle_count(self, key: PoolKey) -> int:
+        return len(self._idle.get(key, ()))
+
+    def open_count(self, key: PoolKey) -> int:
+        return self._open.get(key, 0)
+
+    @asynccontextmanager
+    async def lease(self, key: PoolKey, connect: Callable[[], Awaitable[asyncssh.SSHClientConnection]]):
+        """Lend out a connection for key, reusing an idle one if it is still good and otherwise opening one with connect()."""
+        pooled = await self._take(key, connect)
+        try:
+            yield pooled
+        except asyncssh.SFTPError:
+            self._give_back(key, pooled)
+            raise
+        except BaseException:
+            self._discard(key, pooled)
+            raise
+        else:
+            self._give_back(key, pooled)
+
+    async def _take(self, key: PoolKey, connect: Callable[[], Awaitable[asyncssh.SSHClientConnection]]) -> PooledConnection:
+        while True:
+            while self._idle.get(key):
+                pooled = self._idle[key].pop()
+                if pooled._idle_handle:
+                    pooled._idle_handle.cancel()
+                    pooled._idle_handle = None
+                if time.monotonic() - pooled.last_used < self.health_check_seconds and not pooled.is_closed():
+                    self.reused += 1
+                    return pooled
+                if await pooled.is_healthy():
+                    self.reused += 1
+                    return pooled
+                self._discard(key, pooled)
+            if self.open_count(key) < self.max_connections_per_key:
+                break
+            await self._handed_back.wait()
+
+        # Counted before connecting so that others waiting on the same key do not all connect at once
+        self._open[key] = self.open_count(key) + 1
+        try:
+            connection = await connect()
+        except BaseException:
+            self._forget(key)
+            raise
+        self.connected += 1
+        return PooledConnection(connection, self._generation)
+
+    def _give_back(self, key: PoolKey, pooled: PooledConnection) -> None:
+        if pooled.generation != self._generation or pooled.is_closed():
+            self._discard(key, pooled)
+            return
+        pooled.last_used = time.monotonic()
+        self._idle.setdefault(key, []).append(pooled)
+        pooled._idle_handle = asyncio.get_running_loop().call_later(self.idle_seconds, self._close_idle, key, pooled)
+        self._notify()
+
+    def _close_idle(self, key: PoolKey, pooled: PooledConnection) -> None:
+        if pooled in self._idle.get(key, ()):
+            self._idle[key].remove(pooled)
+            self._discard(key, pooled)
+
+    def _discard(self, key: PoolKey, pooled: PooledConnection) -> None:
+        pooled.close()
+        self._forget(key)
+
+    def _forget(self, key: PoolKey) -> None:
+        self._open[key] = self.open_count(key) - 1
+        if not self._open[key]:
+            del self._open[key]
+            self._idle.pop(key, None)
+        self._notify()
+
+    def _notify(self) -> None:
+        handed_back, self._handed_back = self._handed_back, asyncio.Event()
+        handed_back.set()
+
+    def close_all(self) -> None:
+        """Close every idle connection. Those leased out are closed as they are handed back."""
+        self._generation += 1
+        for key, idle in list(self._idle.items()):
+            for pooled in list(idle):
+                idle.remove(pooled)
+                self._discard(key, pooled)
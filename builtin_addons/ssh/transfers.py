@@ -0,0 +1,311 @@
+import asyncio
+import json
+import os
+import posixpath
+from collections import deque
+from collections.abc import Awaitable, Callable
+from functools import partial
+
+import asyncssh
+
+from pipeline_backend.instances import Instance
+from pipeline_backend.persistence import atomic_write_json
+from pipeline_backend.procedure_runner import run_blocking
+from pipeline_backend.variables import Dictionary
+
+# =====================================================================================
+# SFTP Transfers
+# =====================================================================================
+# SFTP reads a file one block per request, so over a long link to a seedbox the throughput of
+# a single file is capped at how much is in flight (block size times outstanding requests)
+# per round trip, whatever the bandwidth. Downloads keep SFTP_MAX_REQUESTS reads of
+# SFTP_BLOCK_SIZE outstanding per file, and a folder is downloaded SFTP_PARALLEL_FILES files at
+# a time over the one connection, which also hides the per-file open and close round trips of
+# a folder full of small files. None of it gets past the channel window though, which is why
+# connections are opened with a CHANNEL_WINDOW_SIZE well above asyncssh's default.
+#
+# The defaults come from benchmarks/bench_sftp_download.py. A server can be tuned on its own by
+# adding "sftp block size", "sftp max requests" and "sftp parallel files" to its serverInfo.
+#
+# A download is written to the local path with PART_SUFFIX on the end and only renamed into
+# place once it is all there, so an interrupted one is never mistaken for the finished file.
+# The next attempt carries on from the end of that partial file, provided it is no longer than
+# the remote file and its last RESUME_CHECK_BYTES match the remote file's bytes at the same
+# offset. Anything else and it starts again from the beginning. "resume check bytes" in the
+# serverInfo overrides how much is checked, and 0 trusts the partial file on its size alone.
+#
+# A remote tree is listed with up to SCAN_MAX_REQUESTS folders being read at once, each started
+# as soon as the listing of its parent comes back, rather than one round trip per folder.
+# Mirroring compares what that finds against the local tree (or a manifest of what was
+# mirrored before) on size and modification time, and downloads only what is new or changed.
+# A server that sends no modification time leaves the size alone to compare on.
+#
+# The local file work (reads, writes, renames and the like) goes through run_blocking(), so a
+# slow disk holds up the download rather than the event loop.
+
+SFTP_BLOCK_SIZE = 256 * 1024
+SFTP_MAX_REQUESTS = 64
+SFTP_PARALLEL_FILES = 4
+PART_SUFFIX = ".part"
+RESUME_CHECK_BYTES = 1024 * 1024
+SCAN_MAX_REQUESTS = 16
+
+# (source, destination, bytes done, bytes total), as asyncssh hands to a progress_handler
+ProgressHandler = Callable[[bytes, bytes, int, int], None]
+
+
+class TransferSettings:
+    block_size: int
+    max_requests: int
+    parallel_files: int
+    resume_check_bytes: int
+
+    def __init__(self, block_size: int = SFTP_BLOCK_SIZE, max_requests: int = SFTP_MAX_REQUESTS, parallel_files: int = SFTP_PARALLEL_FILES,
+                 resume_check_bytes: int = RESUME_CHECK_BYTES) -> None:
+        self.block_size = block_size
+        self.max_requests = max_requests
+        self.parallel_files = parallel_files
+        self.resume_check_bytes = resume_check_bytes
+
+    @classmethod
+    def from_server_info(cls, instance: Instance, serverInfo: Dictionary) -> "TransferSettings":
+        """The defaults, overridden by whichever of the tuning keys serverInfo has."""
+        settings = cls()
+        # (key, attribute, smallest it may be)
+        for key, attribute, minimum in (("sftp block size", "block_size", 1), ("sftp max requests", "max_requests", 1),
+                                        ("sftp parallel files", "parallel_files", 1), ("resume check bytes", "resume_check_bytes", 0)):
+            if key not in serverInfo.value:
+                continue
+            try:
+                value = int(serverInfo.value[key].value)
+            except (TypeError, ValueError):
+                value = -1
+            if value < minimum:
+                instance.log_line(f"Ignoring '{key}' in the serverInfo, as it is not a whole number of at least {minimum}")
+                continue
+            setattr(settings, attribute, value)
+        return settings
+
+
+class DownloadProgress:
+    """Adds up the progress of every file in a download, so it is reported as one transfer at the throughput of them all together."""
+
+    def __init__(self, report: ProgressHandler, source: str, destination: str, total_bytes: int) -> None:
+        self.report = report
+        self.source = source.encode()
+        self.destination = destination.encode()
+        self.total_bytes = total_bytes
+        self.bytes_done = 0
+        self._file_bytes: dict[bytes, int] = {}
+
+    def file_progress(self, sourcepath: bytes, destpath: bytes, bytesdone: int, bytestotal: int) -> None:
+        self.bytes_done += bytesdone - self._file_bytes.get(destpath, 0)
+        self._file_bytes[destpath] = bytesdone
+        self.report(self.source, self.destination, self.bytes_done, self.total_bytes)
+
+
+async def walk_remote_tree(sftp: asyncssh.SFTPClient, root: str, max_requests: int = SCAN_MAX_REQUESTS) -> tuple[list[str], list[tuple[str, asyncssh.SFTPAttrs]]]:
+    """The folders and the regular files under root, as sorted paths relative to it."""
+    folders: list[str] = []
+    files: list[tuple[str, asyncssh.SFTPAttrs]] = []
+    waiting = deque([""])
+    # The folder each listing in flight is for
+    listing: dict[asyncio.Future, str] = {}
+    try:
+        while waiting or listing:
+            while waiting and len(listing) < max_requests:
+                relpath = waiting.popleft()
+                listing[asyncio.ensure_future(sftp.readdir(posixpath.join(root, relpath) if relpath else root))] = relpath
+            done, _ = await asyncio.wait(listing, return_when=asyncio.FIRST_COMPLETED)
+            for read in done:
+                relpath = listing.pop(read)
+                for entry in read.result():
+                    name = entry.filename
+                    if name in (".", ".."):
+                        continue
+                    entry_relpath = posixpath.join(relpath, name) if relpath else name
+                    if entry.attrs.type == asyncssh.FILEXFER_TYPE_DIRECTORY:
+                        folders.append(entry_relpath)
+                        waiting.append(entry_relpath)
+                    elif entry.attrs.type == asyncssh.FILEXFER_TYPE_REGULAR:
+                        files.append((entry_relpath, entry.attrs))
+    finally:
+        for read in listing:
+            read.cancel()
+        await asyncio.gather(*listing, return_exceptions=True)
+    folders.sort()
+    files.sort(key=lambda file: file[0])
+    return folders, files
+
+
+def part_path(localpath: str) -> str:
+    """Where a download to localpath is written until it is complete."""
+    return localpath + PART_SUFFIX
+
+
+async def resume_offset(instance: Instance, partpath: str, remote_size: int, check_bytes: int, read_remote: Callable[[int, int], Awaitable[bytes]]) -> int:
+    """How much of the partial download at partpath can be kept, reading the remote file's bytes from start to end with read_remote to check its tail."""
+    try:
+        local_size = await run_blocking(os.path.getsize, partpath)
+    except FileNotFoundError:
+        return 0
+    if local_size > remote_size:
+        instance.log_line("    The partial download is larger than the remote file, so starting again")
+        return 0
+    if check_bytes and local_size:
+        start = max(0, local_size - check_bytes)
+        local_tail = await run_blocking(_read_local_range, partpath, start)
+        if await read_remote(start, local_size) != local_tail:
+            instance.log_line("    The end of the partial download does not match the remote file, so starting again")
+            return 0
+    return local_size
+
+
+def _read_local_range(path: str, start: int) -> bytes:
+    with open(path, "rb") as f:
+        f.seek(start)
+        return f.read()
+
+
+async def _read_range(remote_file: asyncssh.SFTPClientFile, start: int, end: int) -> bytes:
+    return await remote_file.read(end - start, start)
+
+
+async def _copy_range(remote_file: asyncssh.SFTPClientFile, local_file, offset: int, end: int, block_size: int, max_requests: int, report: Callable[[int], None]) -> None:
+    """Append the remote file's bytes from offset to end to local_file, keeping max_requests reads of block_size in flight."""
+    # (offset, size, read) in the order they are written out
+    pending: deque[tuple[int, int, asyncio.Future]] = deque()
+    next_offset = offset
+    try:
+        while pending or next_offset < end:
+            while next_offset < end and len(pending) < max_requests:
+                size = min(block_size, end - next_offset)
+                pending.append((next_offset, size, asyncio.ensure_future(remote_file.read(size, next_offset))))
+                next_offset += size
+            read_offset, size, read = pending.popleft()
+            data = await read
+            while len(data) < size:
+                # The server may send less than was asked for, which is followed up before anything after it is written
+                more = await remote_file.read(size - len(data), read_offset + len(data))
+                if not more:
+                    raise asyncssh.SFTPEOFError("The remote file got shorter while it was being downloaded")
+                data += more
+            await run_blocking(local_file.write, data)
+            report(read_offset + size)
+    finally:
+        for _, _, read in pending:
+            read.cancel()
+        await asyncio.gather(*(read for _, _, read in pending), return_exceptions=True)
+
+
+async def download_file(instance: Instance, sftp: asyncssh.SFTPClient, remotepath: str, localpath: str, settings: TransferSettings, progress_handler: ProgressHandler | None = None) -> None:
+    """Download remotepath to localpath by way of a partial file, carrying on from wherever an earlier attempt got to."""
+    block_size = settings.block_size
+    if sftp.limits.max_read_len:
+        # Asking for more than the server will send in one go only costs a second request for the rest
+        block_size = min(block_size, sftp.limits.max_read_len)
+    partpath = part_path(localpath)
+    async with sftp.open(remotepath, "rb", block_size=block_size) as remote_file:
+        remote_size = (await remote_file.stat()).size
+        offset = await resume_offset(instance, partpath, remote_size, settings.resume_check_bytes, partial(_read_range, remote_file))
+        if offset:
+            instance.log_line(f"    Resuming '{localpath}' from byte {offset:,} of {remote_size:,}")
+
+        def report(bytesdone: int) -> None:
+            if progress_handler:
+                progress_handler(remotepath.encode(), localpath.encode(), bytesdone, remote_size)
+
+        local_file = await run_blocking(open, partpath, "ab" if offset else "wb")
+        try:
+            await _copy_range(remote_file, local_file, offset, remote_size, block_size, settings.max_requests, report)
+        finally:
+            await run_blocking(local_file.close)
+    await run_blocking(os.replace, partpath, localpath)
+
+
+async def download_files(instance: Instance, sftp: asyncssh.SFTPClient, remoteroot: str, localroot: str, relpaths: list[str], settings: TransferSettings,
+                         progress_handler: ProgressHandler | None = None, file_done: Callable[[str], Awaitable[None]] | None = None) -> None:
+    """Download each of relpaths under remoteroot to the same place under localroot, settings.parallel_files at a time, calling file_done with each relpath as it finishes."""
+    pending = iter(relpaths)
+
+    async def worker():
+        # Every worker pulls from the one iterator, so a file is only started once there is room for it
+        for relpath in pending:
+            localpath = os.path.join(localroot, *relpath.split("/"))
+            await download_file(instance, sftp, posixpath.join(remoteroot, relpath), localpath, settings, progress_handler)
+            if file_done:
+                await file_done(relpath)
+
+    workers = [asyncio.create_task(worker()) for _ in range(min(settings.parallel_files, len(relpaths)))]
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        # Should one fail or the command be cancelled, the rest are stopped before the connection is handed back
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+
+class MirrorManifest:
+    """The size and modification time of every file mirrored so far, kept as JSON so they count as mirrored even once moved out of the local folder. The time is None for a server that did not send one."""
+    path: str
+    files: dict[str, tuple[int, int | None]]
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.files = {}
+
+    @classmethod
+    def load(cls, path: str) -> "MirrorManifest":
+        manifest = cls(path)
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return manifest
+        except (OSError, ValueError) as e:
+            print(f"Unable to read the mirror manifest '{path}', so treating every file as new: {e}")
+            return manifest
+        manifest.files = {relpath: (entry["size"], entry["mtime"]) for relpath, entry in data.get("files", {}).items()}
+        return manifest
+
+    def save(self) -> None:
+        atomic_write_json(self.path, {"files": {relpath: {"size": size, "mtime": mtime} for relpath, (size, mtime) in self.files.items()}})
+
+
+def _local_size_and_mtime(localpath: str) -> tuple[int, int] | None:
+    try:
+        stat = os.stat(localpath)
+    except FileNotFoundError:
+        return None
+    return (stat.st_size, int(stat.st_mtime))
+
+
+def changed_files(files: list[tuple[str, asyncssh.SFTPAttrs]], localroot: str, manifest: MirrorManifest | None = None) -> list[tuple[str, asyncssh.SFTPAttrs]]:
+    """Those of files whose size or modification time differ from the manifest, or from the copy under localroot when there is no manifest. Stats the local files, so run it with run_blocking()."""
+    changed = []
+    for relpath, attrs in files:
+        if manifest is not None:
+            mirrored = manifest.files.get(relpath)
+        else:
+            mirrored = _local_size_and_mtime(os.path.join(localroot, *relpath.split("/")))
+        if mirrored is not None and attrs.mtime is None:
+            # Nothing to compare the time with, so only the size counts - mark_mirrored() keeps None as the time for these
+            mirrored = (mirrored[0], None)
+        if mirrored != (attrs.size, attrs.mtime):
+            changed.append((relpath, attrs))
+    return changed
+
+
+async def mark_mirrored(localroot: str, relpath: str, attrs: asyncssh.SFTPAttrs, manifest: MirrorManifest | None = None) -> None:
+    """Give the downloaded copy of relpath the remote file's modification time, so it compares as unchanged next time."""
+    if attrs.mtime is not None:
+        await run_blocking(os.utime, os.path.join(localroot, *relpath.split("/")), (attrs.atime or attrs.mtime, attrs.mtime))
+    if manifest is not None:
+        manifest.files[relpath] = (attrs.size, attrs.mtime)
+
+
+def make_local_folders(localroot: str, folders: list[str]) -> None:
+    """Create localroot and each of folders under it, for run_blocking()."""
+    for folder in [""] + folders:
+        os.makedirs(os.path.join(localroot, *folder.split("/")), exist_ok=True)
@@ -1,11 +1,19 @@
 from pipeline_backend import *
 from pipeline_backend.commands_builtin import *
+from pipeline_backend.cpu_pool import cpu_bound
 try:
     import regex as re
 except:
     # Personally I really like having the \K flag available so lets just force it to be available
     raise Exception("Unable to import regex module. This is an expanded regex support module for python. The package may be simply called python-regex in your package manager.")
 
+# Searching less than this is quicker to just do than to hand over to another process
+REGEX_POOL_MIN_CHARS = 100_000
+
+@cpu_bound
+def _regex_find_all(regexPatern: String, inputString: String) -> StringList:
+    return StringList(re.findall(regexPatern.value, inputString.value))
+
 @Commands.register_command(category="Strings")
 async def str_regex_firstMatch(instance: Instance, regexPatern:String, inputString:String, outputVarname: VariablePath) -> CommandReturnStatus:
     """Find the first regex match in a string using extended regex syntax (supports \\K and other extras). Errors if no match is found.
@@ -31,8 +39,10 @@ async def str_regex_matchAll(instance: Instance, regexPatern: String, inputStrin
         # would quietly leave a StringList holding tuples instead of strings
         instance.log_line(f"Error: The pattern '{regexPatern.value}' has {pattern.groups} capture groups but at most one is allowed. Make the ones you do not want back non-capturing with (?:...)")
         return CommandReturnStatus.Error
-    matches = pattern.findall(inputString.value)
-    instance[outputVarname] = StringList(matches)
+    if len(inputString.value) < REGEX_POOL_MIN_CHARS:
+        instance[outputVarname] = StringList(pattern.findall(inputString.value))
+    else:
+        instance[outputVarname] = await _regex_find_all(regexPatern, inputString)
     return CommandReturnStatus.Success
 
 @Commands.register_command(category="Strings")
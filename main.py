@@ -4,10 +4,15 @@ from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException
 from pipeline_backend import *
 import pipeline_backend.event_callbacks
+import pipeline_backend.instance_logs
+import pipeline_backend.metrics
 
 @asynccontextmanager
 async def lifespan(app:FastAPI):
     print("Starting Pipeline")
+    # Addons register their commands on import, and those need to exist before the
+    # restored workflows are compiled
+    addon_modules = pipelineManager.import_addons()
     pipelineManager.restore_state()
     pipelineManager.restore_secrets()
     await pipelineManager.start()
@@ -16,8 +21,16 @@ async def lifespan(app:FastAPI):
         pipeline_backend.event_callbacks.router,
         prefix="/api"
         )
+    app.include_router(
+        pipeline_backend.instance_logs.router,
+        prefix="/api"
+        )
+    app.include_router(
+        pipeline_backend.metrics.router,
+        prefix="/api"
+        )
 
-    for module in pipelineManager.import_addons():
+    for module in addon_modules:
         if hasattr(module,"router"):
             app.include_router(module.router)
 
@@ -0,0 +1,109 @@
+from collections.abc import Callable, Hashable
+from copy import deepcopy
+
+# =====================================================================================
+# Change Tracking
+# =====================================================================================
+# The persistence layer only wants to write the workflows, instances and globals that changed
+# since the last save. Rather than diffing everything, the objects report themselves here as
+# they change. The registries in PipelineContext report additions and removals, and Instance
+# and Workflow report changes to their own saved attributes.
+#
+# Only changes made through the objects themselves are seen. Editing a value in place (eg
+# appending to the list inside a StringList stored on an instance) is not, which is why
+# commands get copies and write results back with instance[name] = value.
+
+
+class ChangeTracker:
+    """The keys of each state section that changed since the last take()."""
+    workflows: set[str]
+    instances: set[str]
+    variables: set[str]
+
+    def __init__(self) -> None:
+        self.workflows = set()
+        self.instances = set()
+        self.variables = set()
+
+    def __bool__(self) -> bool:
+        return bool(self.workflows or self.instances or self.variables)
+
+    def mark_workflow(self, uuid: str) -> None:
+        self.workflows.add(uuid)
+
+    def mark_instance(self, uuid: str) -> None:
+        self.instances.add(uuid)
+
+    def mark_variable(self, name: str) -> None:
+        self.variables.add(name)
+
+    def take(self) -> dict[str, set[str]]:
+        """Hand over everything marked so far and start again from nothing."""
+        taken = {"workflows": self.workflows, "instances": self.instances, "variables": self.variables}
+        self.workflows = set()
+        self.instances = set()
+        self.variables = set()
+        return taken
+
+    def restore(self, taken: dict[str, set[str]]) -> None:
+        """Put back what take() handed over, for when writing it out failed."""
+        self.workflows |= taken["workflows"]
+        self.instances |= taken["instances"]
+        self.variables |= taken["variables"]
+
+
+class TrackedDict(dict):
+    """A dict that calls on_change(key) whenever a key is added, replaced or removed."""
+
+    def __init__(self, on_change: Callable[[Hashable], None], initial: dict | None = None) -> None:
+        super().__init__(initial or {})
+        self._on_change = on_change
+
+    def __setitem__(self, key, value) -> None:
+        super().__setitem__(key, value)
+        self._on_change(key)
+
+    def __delitem__(self, key) -> None:
+        super().__delitem__(key)
+        self._on_change(key)
+
+    # A copy is detached from whatever owns this dict, so it comes out as a plain dict
+    def __copy__(self) -> dict:
+        return dict(self)
+
+    def __deepcopy__(self, memo) -> dict:
+        return deepcopy(dict(self), memo)
+
+    def __reduce__(self):
+        return (dict, (dict(self),))
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def pop(self, key, *default):
+        had_key = key in self
+        value = super().pop(key, *default)
+        if had_key:
+            self._on_change(key)
+        return value
+
+    def popitem(self):
+        key, value = super().popitem()
+        self._on_change(key)
+        return key, value
+
+    def clear(self) -> None:
+        keys = list(self)
+        super().clear()
+        for key in keys:
+            self._on_change(key)
+
+    def update(self, *args, **kwargs) -> None:
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
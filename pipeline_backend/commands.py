@@ -1,9 +1,11 @@
+from copy import deepcopy
 from enum import Flag,auto
 from types import UnionType
 from typing import Callable,get_args
-from inspect import signature
+from inspect import iscoroutinefunction, signature
 from .variables import *
 from .instances import *
+from .retries import RetryPolicy, register_exception
 
 # This is the place that registers and validates commands that can be called in procedures.
 
@@ -18,9 +20,88 @@ class CommandReturnStatus(Flag):
     # Special case of telling the procedure runner to not modify the current proceesing step
     Keep_Position = auto()
 
+class CommandStats:
+    """Time a command has held up the event loop or a blocking command thread - running, if it is sync, or in run_blocking() calls if it is async."""
+    calls: int
+    total_seconds: float
+    max_seconds: float
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def record(self, seconds: float) -> None:
+        self.calls += 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+    def json_savable(self) -> dict:
+        return {"calls": self.calls, "total_seconds": self.total_seconds, "max_seconds": self.max_seconds}
+
+
+class CommandDescriptor:
+    """What the runner and the UI need to know about a registered command, worked out once when it is registered."""
+    name: str
+    fn: Callable
+    category: str
+    # In-order argument names and the type(s) they accept, not counting the leading Instance
+    arguments: list[tuple[str, type[WorkVariable]|tuple[type[WorkVariable]]]]
+    is_coroutine: bool
+    doc: str | None
+    # Arguments that name a procedure of the workflow, so a literal one can be checked before running
+    procedure_arguments: tuple[str, ...]
+    # How long the runner lets a run of an async command take before cancelling it. None for no limit
+    timeout_seconds: float | None
+    # When to try again after the command raises, unless the step has a policy of its own. None for the runner's default
+    retry_policy: RetryPolicy | None
+    stats: CommandStats
+
+    def __init__(self, fn: Callable, category: str, procedure_arguments: tuple[str, ...] = (), timeout_seconds: float | None = None, retry_policy: RetryPolicy | None = None) -> None:
+        self.name = fn.__name__
+        self.fn = fn
+        self.category = category
+        self.procedure_arguments = procedure_arguments
+        self.is_coroutine = iscoroutinefunction(fn)
+        self.timeout_seconds = timeout_seconds
+        self.retry_policy = retry_policy
+        self.stats = CommandStats()
+        self.doc = fn.__doc__
+        sig = signature(fn)
+        argument_names = list(sig.parameters.keys())[1:] # sig.parameters nor its keys are directly iterable or slicable, so need to make it a list
+        self.arguments = []
+        for arg_name in argument_names:
+            match(sig.parameters[arg_name].annotation):
+                case args_union if isinstance(args_union,UnionType):
+                    self.arguments.append(
+                        (arg_name,get_args(args_union))
+                    )
+                case x if issubclass(x,WorkVariable):
+                    self.arguments.append(
+                        (arg_name,x)
+                    )
+        self._json_savable = None
+
+    def json_savable(self) -> dict:
+        # Built on first use, as the UI asks for it over and over but the runner never does
+        if self._json_savable is None:
+            args_str = {}
+            for arg_name, arg_types in self.arguments:
+                if type(arg_types) == tuple:
+                    args_str[arg_name] = [vt.__name__ for vt in arg_types]
+                else:
+                    args_str[arg_name] = arg_types.__name__
+            self._json_savable = {"arguments": args_str, "doc": self.doc}
+        return deepcopy(self._json_savable)
+
+
 class Commands:
     commands:dict[str,Callable] = {}
     categories:dict[str,str] = {}
+    # Parsed signatures so running a step never has to call inspect.signature
+    descriptors:dict[str,CommandDescriptor] = {}
+    # Bumped on every registration, so compiled workflows know when to look their commands up again
+    generation:int = 0
 
     @classmethod
     def get_commands_grouped(cls) -> dict[str, list[str]]:
@@ -30,31 +111,28 @@ class Commands:
             grouped.setdefault(cls.categories[name], []).append(name)
         return grouped
 
+    @classmethod
+    def get_command_descriptor(cls, command_name: str) -> CommandDescriptor:
+        if not command_name in cls.descriptors:
+            raise KeyError(f"Unable to find {command_name} in the list of available commands")
+        return cls.descriptors[command_name]
+
     @classmethod
     def get_command_input_variables(cls, command_name: str) -> list[tuple[str, type[WorkVariable]|tuple[type[WorkVariable]]]]:
         """Returns a in-order list of argument name and their type."""
         # Note to future me - do not change this from a list to a dict to reduce the type complexity. The list maintains order, the dict keys do not maintain order
         # This was used in the ProcedureRunner to build an args list to pass to the command function, which is order dependent
-        if not command_name in cls.commands:
+        if not command_name in cls.descriptors:
             raise NameError(f"Unable to find a command with the name {command_name}")
-        sig = signature(cls.commands[command_name])
-        argument_names = list(sig.parameters.keys())[1:] # sig.parameters nor its keys are directly iterable or slicable, so need to make it a list
-        parms = []
-        for arg_name in argument_names:
-            match(sig.parameters[arg_name].annotation):
-                case args_union if isinstance(args_union,UnionType):
-                    parms.append(
-                        (arg_name,get_args(args_union))
-                    )
-                case x if issubclass(x,WorkVariable):
-                    parms.append(
-                        (arg_name,x)
-                    )
-        return parms
+        return list(cls.descriptors[command_name].arguments)
 
     @classmethod
-    def register_command(cls, *, category:str) -> Callable:
-        """Decorator factory to register a command. Usage: @Commands.register_command(category="Name")."""
+    def register_command(cls, *, category:str, procedure_arguments:tuple[str, ...]=(), timeout_seconds:float|None=None, retry_policy:RetryPolicy|None=None) -> Callable:
+        """Decorator factory to register a command. Usage: @Commands.register_command(category="Name").
+        procedure_arguments names the String arguments that are the name of a procedure to jump to.
+        A command with a slow filesystem or other blocking call should be async and hand just that call to run_blocking().
+        timeout_seconds is how long an async command may run before it is cancelled, which a ProcessingStep can override.
+        retry_policy is when to try the command again after it raises, which a ProcessingStep can also override."""
         def decorator(fn: Callable) -> Callable:
             sig = signature(fn)
             function_arguments = list(sig.parameters.keys())
@@ -78,8 +156,21 @@ class Commands:
             if not sig.return_annotation == CommandReturnStatus:
                 raise TypeError("Commands for processing must return a CommandReturnStatus")
 
+            for arg_name in procedure_arguments:
+                if arg_name not in function_arguments[1:]:
+                    raise TypeError(f"procedure_arguments names {arg_name}, which is not an argument of {fn.__name__}")
+            # A thread cannot be cancelled, so there would be no stopping a sync command that ran over
+            if timeout_seconds is not None and not iscoroutinefunction(fn):
+                raise TypeError(f"Only async commands can have a timeout, and {fn.__name__} is not a coroutine")
+
+            # Whatever the command retries on can be named by the retry policy of a step too
+            for exception in retry_policy.retry_on if retry_policy else ():
+                register_exception(exception)
+
             cls.commands[fn.__name__] = fn
             cls.categories[fn.__name__] = category
+            cls.descriptors[fn.__name__] = CommandDescriptor(fn, category, tuple(procedure_arguments), timeout_seconds, retry_policy)
+            cls.generation += 1
             return fn
 
         return decorator
@@ -92,9 +183,7 @@ class Commands:
 
     @classmethod
     def get_command_doc_string(cls, command_name: str) -> str | None:
-        if not command_name in cls.commands:
-            raise KeyError(f"Unable to find {command_name} in the list of available commands")
-        return cls.commands[command_name].__doc__
+        return cls.get_command_descriptor(command_name).doc
 
     @classmethod
     def json_savable_all_commands_with_args(cls) -> dict:
@@ -105,16 +194,7 @@ class Commands:
     
     @classmethod
     def json_savable_command_information(cls,command_name:str) -> dict:
-        args = cls.get_command_input_variables(command_name)
-        args_str = {}
-        for arg in args:
-            arg_name = arg[0]
-            arg_types = arg[1]
-            if type(arg_types) == tuple:
-                args_str[arg_name] = [vt.__name__ for vt in arg_types]
-            else:
-                args_str[arg_name] = arg_types.__name__
-        return {"arguments": args_str, "doc": cls.get_command_doc_string(command_name)}
+        return cls.get_command_descriptor(command_name).json_savable()
 
     @classmethod
     def json_savable_all_command_names(cls) -> list:
@@ -36,6 +36,7 @@ def delete_this_instance(instance: Instance) -> CommandReturnStatus:
         instance.log_line(f"Error: Unable to delete an instance that is not registered in the pipeline context.")
         return CommandReturnStatus.Error
     del instance.ctx.instances[instance.uuid]
+    instance.ctx.instance_logs.discard(instance.uuid)
     return CommandReturnStatus.Yield
 
 @Commands.register_command(category="Core")
@@ -112,7 +113,7 @@ def error(instance: Instance, msg: String) -> CommandReturnStatus:
 # conditionals and branches
 # ====================================================================
 
-@Commands.register_command(category="Core")
+@Commands.register_command(category="Core", procedure_arguments=("procedure_name",))
 def jump_to_procedure(instance: Instance, procedure_name: String) -> CommandReturnStatus:
     """Unconditionally jump to the start of another procedure in this workflow.
   procedure_name: Name of the procedure to jump to."""
@@ -123,7 +124,7 @@ def jump_to_procedure(instance: Instance, procedure_name: String) -> CommandRetu
     instance.processing_step = (procedure_name.value,0)
     return CommandReturnStatus.Success | CommandReturnStatus.Keep_Position
 
-@Commands.register_command(category="Core")
+@Commands.register_command(category="Core", procedure_arguments=("procedure_name",))
 def goto_if(instance: Instance, procedure_name: String, condition: Boolean) -> CommandReturnStatus:
     """Jump to a procedure if a Boolean condition is true. Continues to the next step if false.
   procedure_name: Name of the procedure to jump to when condition is true.
@@ -132,7 +133,7 @@ def goto_if(instance: Instance, procedure_name: String, condition: Boolean) -> C
         return jump_to_procedure(instance, procedure_name)
     return CommandReturnStatus.Success
 
-@Commands.register_command(category="Core")
+@Commands.register_command(category="Core", procedure_arguments=("procedure_name",))
 def goto_if_equal(instance: Instance, procedure_name: String, value1:WorkVariable, value2:WorkVariable) -> CommandReturnStatus:
     """Jump to a procedure if two values are equal. Compares by type then by string representation.
   procedure_name: Name of the procedure to jump to when values are equal.
@@ -152,7 +153,7 @@ def goto_if_equal(instance: Instance, procedure_name: String, value1:WorkVariabl
     return CommandReturnStatus.Success
 
 
-@Commands.register_command(category="Core")
+@Commands.register_command(category="Core", procedure_arguments=("procedure_name",))
 def goto_if_not_equal(instance: Instance, procedure_name: String, value1: WorkVariable, value2: WorkVariable) -> CommandReturnStatus:
     """Jump to a procedure if two values are not equal. Compares by type then by string representation.
   procedure_name: Name of the procedure to jump to when values are not equal.
@@ -170,7 +171,7 @@ def goto_if_not_equal(instance: Instance, procedure_name: String, value1: WorkVa
 
     return CommandReturnStatus.Success
 
-@Commands.register_command(category="Core")
+@Commands.register_command(category="Core", procedure_arguments=("procedure_name",))
 def goto_if_first_larger(instance: Instance, procedure_name: String, value1: Integer|Float, value2: Integer|Float) -> CommandReturnStatus:
     """Jump to a procedure if value1 is strictly greater than value2.
   procedure_name: Name of the procedure to jump to.
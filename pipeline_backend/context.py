@@ -1,20 +1,51 @@
 from __future__ import annotations
+from collections.abc import Awaitable, Callable
 from typing import TYPE_CHECKING
+from .changes import ChangeTracker, TrackedDict
+from .host_limits import HostLimits
+from .instance_logs import InstanceLogs
+from .scheduler import DueQueue, InstanceRegistry
 
 if TYPE_CHECKING:
     from .workflows import Workflow
-    from .instances import Instance
     from .variables import WorkVariable
 
 
+async def _nothing_to_notify() -> None:
+    pass
+
+
 class PipelineContext:
     workflows: dict[str, Workflow]
-    instances: dict[str, Instance]
+    instances: InstanceRegistry
+    # Every registered instance ordered by when it is next due - see scheduler.py
+    due_queue: DueQueue
     variables: dict[str, WorkVariable]
     secrets: dict[str, WorkVariable]
+    # What needs saving since the state was last written - see changes.py
+    changes: ChangeTracker
+    # Full history of each instance's log, beyond what console_log keeps - see instance_logs.py
+    instance_logs: InstanceLogs
+    # Rate and concurrency limits for each remote host the addons talk to - see host_limits.py
+    host_limits: HostLimits
+    # Wakes the scheduler of the pipeline, for an addon that makes an instance due from outside of
+    # a command. Set by the PipelineManager the context belongs to
+    notify_of_something_happening: Callable[[], Awaitable[None]]
 
     def __init__(self) -> None:
-        self.workflows = {}
-        self.instances = {}
-        self.variables = {}
+        self.changes = ChangeTracker()
+        self.workflows = TrackedDict(self.changes.mark_workflow)
+        self.instances = InstanceRegistry(self.changes.mark_instance)
+        self.due_queue = self.instances.due_queue
+        self.variables = TrackedDict(self.changes.mark_variable)
+        # Secrets live in their own file and are saved as a whole
         self.secrets = {}
+        self.instance_logs = InstanceLogs()
+        self.host_limits = HostLimits(self.variables)
+        self.notify_of_something_happening = _nothing_to_notify
+
+    def __deepcopy__(self, memo: dict) -> PipelineContext:
+        # A copied workflow or instance (the editor's drafts) still belongs to the same pipeline.
+        # Copying the context would copy every instance along with it, and the log tails and host
+        # limits hold on to the event loop, which cannot be copied at all
+        return self
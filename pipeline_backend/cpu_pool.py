@@ -0,0 +1,118 @@
+import asyncio
+import functools
+import importlib
+import multiprocessing
+import os
+import sys
+from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from .variables import WorkVariable
+
+# =====================================================================================
+# CPU Bound Work
+# =====================================================================================
+# A command works on its Instance, and that cannot be handed to another process. What can be
+# is the pure part of it - a module level function that takes and returns plain values and
+# WorkVariables. Decorating that with @cpu_bound makes calling it a coroutine that runs it in a
+# pool of worker processes, so a burst of heavy parsing is spread over the cores instead of
+# taking turns on the GIL with the event loop.
+#
+# WorkVariables cross over as their json_savable() form and anything else as is, so it has to
+# pickle. The workers do not fork from this process, which by the time the pool starts has the
+# blocking command and save threads running, and forking it could leave a worker stuck on a lock
+# one of them held. They come from a fork server instead (or are spawned where there is none),
+# and import the module of each function they are handed by name. Addons live in a synthetic
+# package that cannot be imported like that, so the workers are told where each addon loaded so
+# far is, and import it from there the first time one of its functions comes along. With
+# WEBAUTOTENDER_CPU_BOUND_PROCESSES at 0 the function runs in a thread instead.
+
+CPU_BOUND_PROCESSES = int(os.environ.get("WEBAUTOTENDER_CPU_BOUND_PROCESSES", os.cpu_count() or 1))
+_cpu_pool_executor: ProcessPoolExecutor | None = None
+# In a worker, the __init__.py of each addon by its module name
+_addon_locations: dict[str, str] = {}
+
+
+def _worker_context() -> multiprocessing.context.BaseContext:
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("spawn")
+    context = multiprocessing.get_context("forkserver")
+    # Imported once in the fork server rather than in every worker
+    context.set_forkserver_preload(["pipeline_backend"])
+    return context
+
+
+def _init_worker(addon_locations: dict[str, str]) -> None:
+    _addon_locations.update(addon_locations)
+
+
+def _import_in_worker(module_name: str):
+    addon = ".".join(module_name.split(".")[:2])
+    if addon in _addon_locations and addon not in sys.modules:
+        # Imported here since the manager imports this module
+        from .manager import load_addon_module
+        load_addon_module(addon, _addon_locations[addon])
+    return importlib.import_module(module_name)
+
+
+def cpu_pool_executor() -> ProcessPoolExecutor | None:
+    """The pool of worker processes, or None when cpu_bound functions run in a thread."""
+    global _cpu_pool_executor
+    if CPU_BOUND_PROCESSES <= 0:
+        return None
+    if _cpu_pool_executor is None:
+        from .manager import loaded_addon_locations
+        _cpu_pool_executor = ProcessPoolExecutor(
+            max_workers=CPU_BOUND_PROCESSES, mp_context=_worker_context(),
+            initializer=_init_worker, initargs=(loaded_addon_locations(),))
+    return _cpu_pool_executor
+
+
+def shutdown_cpu_pool() -> None:
+    global _cpu_pool_executor
+    if _cpu_pool_executor is not None:
+        _cpu_pool_executor.shutdown(wait=False, cancel_futures=True)
+        _cpu_pool_executor = None
+
+
+def _encode(value) -> tuple[str, object]:
+    if isinstance(value, WorkVariable):
+        return ("WorkVariable", value.json_savable())
+    return ("raw", value)
+
+
+def _decode(payload: tuple[str, object]):
+    kind, value = payload
+    if kind == "WorkVariable":
+        var = WorkVariable()
+        var.json_loadable(value)
+        return var
+    return value
+
+
+def _call_in_worker(module_name: str, qualname: str, payload: list[tuple[str, object]]) -> tuple[str, object]:
+    target = _import_in_worker(module_name)
+    for name in qualname.split("."):
+        target = getattr(target, name)
+    # What is found by name is the @cpu_bound wrapper, so unwrap it to get at the function itself
+    return _encode(target.__wrapped__(*[_decode(arg) for arg in payload]))
+
+
+def cpu_bound(fn: Callable) -> Callable:
+    """Make a pure module level function a coroutine that runs in the CPU pool."""
+    @functools.wraps(fn)
+    async def run_in_pool(*args):
+        global _cpu_pool_executor
+        executor = cpu_pool_executor()
+        if executor is None:
+            return await asyncio.to_thread(fn, *args)
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(
+                executor, _call_in_worker, fn.__module__, fn.__qualname__, [_encode(arg) for arg in args])
+        except BrokenProcessPool:
+            # A worker died (killed or out of memory), which takes the whole pool with it. Start afresh next time
+            if _cpu_pool_executor is executor:
+                _cpu_pool_executor = None
+            raise
+        return _decode(result)
+    return run_in_pool
@@ -3,6 +3,7 @@ from asyncio import Queue
 from fastapi import APIRouter,Request
 from enum import Enum,auto
 from typing import Callable
+from . import metrics
 
 class EventCallbacksManager:
     class Events(Enum):
@@ -30,6 +31,7 @@ class EventCallbacksManager:
             if e in self.subscribers and callback in self.subscribers[e]:
                 self.subscribers[e].remove(callback)
     async def signal_event(self,event:Events, uuid:str="", data:str=""):
+        metrics.events_signalled_counter.inc(event=event.name)
         if not event in self.subscribers:
             return
         for callback in list(self.subscribers[event]):
@@ -43,6 +45,8 @@ router = APIRouter(tags=["utils"])
 class ServerSideSignalsQueue:
     message_queue : Queue
     client : Request
+    # Every stream with a client connected, for the queue depth metrics
+    connected : set["ServerSideSignalsQueue"] = set()
     def __init__(self,client:Request):
         self.message_queue = Queue()
         self.client = client
@@ -52,6 +56,7 @@ class ServerSideSignalsQueue:
             'data':uuid
         })
     async def message_generator(self):
+        ServerSideSignalsQueue.connected.add(self)
         try:
             while True:
                 msg = await self.message_queue.get()
@@ -64,6 +69,16 @@ class ServerSideSignalsQueue:
             # Also runs when the generator is cancelled, which is how a client that
             # disconnects while idle gets unsubscribed instead of leaking its queue.
             eventsCallbackManager.unsubscribe_callback(self.add_new_message)
+            ServerSideSignalsQueue.connected.discard(self)
+
+    @staticmethod
+    def update_metrics():
+        depths = [sse.message_queue.qsize() for sse in ServerSideSignalsQueue.connected]
+        metrics.sse_subscribers_gauge.set(len(depths))
+        metrics.sse_queued_messages_gauge.set(sum(depths))
+        metrics.sse_max_queue_depth_gauge.set(max(depths, default=0))
+
+metrics.metrics.add_collector(ServerSideSignalsQueue.update_metrics)
 
 @router.get('/events_stream')
 async def events_stream_registry(request:Request):
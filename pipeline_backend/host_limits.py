@@ -0,0 +1,141 @@
+from __future__ import annotations
+import asyncio
+import time
+import urllib.parse
+from collections.abc import Callable
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .variables import WorkVariable
+
+# =====================================================================================
+# Per Host Limits
+# =====================================================================================
+# Every addon that talks to a remote server goes through ctx.host_limits.acquire(url) for as
+# long as it is talking to it, so a burst of instances coming due together cannot hammer one
+# host into banning us. Each host gets a token bucket that spaces out new requests, and a cap
+# on how many are in flight at once.
+#
+# The limits are set by a global Dictionary named host_limits, keyed on host name with a
+# "default" entry for every host not listed:
+#   host_limits = {
+#       "default":  {"max_in_flight": 8},
+#       "nyaa.si":  {"requests_per_second": 0.5, "burst": 2, "max_in_flight": 2},
+#   }
+# Anything left out is unlimited. The global is read on every acquire, so edits take effect
+# straight away.
+
+HOST_LIMITS_VARIABLE = "host_limits"
+DEFAULT_HOST = "default"
+
+
+class HostLimitConfig:
+    # Requests started per second on average, 0 for no limit
+    requests_per_second: float
+    # How many requests can start back to back before the rate applies
+    burst: int
+    # Requests that can be in progress at once, 0 for no limit
+    max_in_flight: int
+
+    def __init__(self, requests_per_second: float = 0.0, burst: int = 1, max_in_flight: int = 0) -> None:
+        self.requests_per_second = requests_per_second
+        self.burst = max(1, burst)
+        self.max_in_flight = max_in_flight
+
+    @staticmethod
+    def from_variable(var: WorkVariable | None) -> HostLimitConfig:
+        """Read the limits out of one entry of the host_limits global. Anything missing or unreadable is left unlimited."""
+        config = HostLimitConfig()
+        if var is None or not isinstance(var.value, dict):
+            return config
+        for name, convert in (("requests_per_second", float), ("burst", int), ("max_in_flight", int)):
+            if name in var.value:
+                try:
+                    setattr(config, name, convert(var.value[name].value))
+                except (TypeError, ValueError):
+                    print(f"Ignoring the host limit {name} = {var.value[name].value!r}, it is not a number")
+        config.burst = max(1, config.burst)
+        return config
+
+
+class HostLimiter:
+    """The token bucket and in flight count for one host."""
+    host: str
+
+    def __init__(self, host: str) -> None:
+        self.host = host
+        self.in_flight = 0
+        self._tokens: float | None = None
+        self._refilled_at = time.monotonic()
+        self._slot_freed = asyncio.Condition()
+
+    async def _take_token(self, config: HostLimitConfig) -> None:
+        if config.requests_per_second <= 0:
+            return
+        while True:
+            now = time.monotonic()
+            tokens = config.burst if self._tokens is None else self._tokens
+            tokens = min(config.burst, tokens + (now - self._refilled_at) * config.requests_per_second)
+            self._refilled_at = now
+            if tokens >= 1:
+                self._tokens = tokens - 1
+                return
+            self._tokens = tokens
+            await asyncio.sleep((1 - tokens) / config.requests_per_second)
+
+    def _has_free_slot(self, config: HostLimitConfig) -> bool:
+        return not config.max_in_flight or self.in_flight < config.max_in_flight
+
+    @asynccontextmanager
+    async def acquire(self, current_config: Callable[[], HostLimitConfig]):
+        # The config is looked up again on every wakeup so an edited limit applies to those already waiting
+        async with self._slot_freed:
+            await self._slot_freed.wait_for(lambda: self._has_free_slot(current_config()))
+            self.in_flight += 1
+        try:
+            await self._take_token(current_config())
+            yield
+        finally:
+            async with self._slot_freed:
+                self.in_flight -= 1
+                # The limit may have been raised since, so let every waiter check again
+                self._slot_freed.notify_all()
+
+
+def host_of(url: str) -> str:
+    """The host name a limit applies to. Takes full URLs as well as the bare host names the SSH addon uses."""
+    if "://" not in url:
+        url = "//" + url
+    try:
+        host = urllib.parse.urlsplit(url).hostname
+    except ValueError:
+        host = None
+    return host or url.lstrip("/").lower()
+
+
+class HostLimits:
+    """Every HostLimiter of a pipeline, configured from its host_limits global."""
+    variables: dict[str, WorkVariable]
+
+    def __init__(self, variables: dict[str, WorkVariable]) -> None:
+        self.variables = variables
+        self._limiters: dict[str, HostLimiter] = {}
+
+    def config_for(self, host: str) -> HostLimitConfig:
+        limits = self.variables.get(HOST_LIMITS_VARIABLE)
+        if limits is None or not isinstance(limits.value, dict):
+            return HostLimitConfig()
+        return HostLimitConfig.from_variable(limits.value.get(host, limits.value.get(DEFAULT_HOST)))
+
+    def limiter_for(self, host: str) -> HostLimiter:
+        if host not in self._limiters:
+            self._limiters[host] = HostLimiter(host)
+        return self._limiters[host]
+
+    @asynccontextmanager
+    async def acquire(self, url: str):
+        """Hold one of the host's in flight slots for the duration, waiting for it and for the rate limit first."""
+        host = host_of(url)
+        async with self.limiter_for(host).acquire(lambda: self.config_for(host)):
+            yield
@@ -0,0 +1,242 @@
+import asyncio
+import os
+import pathlib
+from datetime import datetime
+from fastapi import APIRouter, HTTPException, Request
+from sse_starlette.sse import EventSourceResponse
+
+# =====================================================================================
+# Instance Log Files
+# =====================================================================================
+# Instance.console_log only keeps the last CONSOLE_LOG_MAX_LINES lines, which is all the
+# state file should carry. When WEBAUTOTENDER_INSTANCE_LOG_DIR is set every logged line is
+# also appended to <dir>/<instance uuid>.log so the full history is there for a post-mortem.
+#
+# Lines are buffered in memory and written out when the instance yields (or the buffer grows
+# past INSTANCE_LOG_BUFFER_BYTES), so a chatty download loop is not one write per line. The
+# writing happens in a thread, like the state saves, and whatever is logged while a write is
+# under way goes out together in the next one.
+# Once a file passes INSTANCE_LOG_MAX_BYTES it is rotated to <uuid>.log.1, .2, ... keeping
+# INSTANCE_LOG_BACKUPS of them.
+#
+# Readers address the log by byte offset, and the offset keeps counting up across rotations
+# for as long as the process runs. An offset that has been rotated away, or that is from a
+# previous run, starts over from the beginning of the current file.
+
+INSTANCE_LOG_DIR = os.environ.get("WEBAUTOTENDER_INSTANCE_LOG_DIR", "")
+INSTANCE_LOG_MAX_BYTES = int(os.environ.get("WEBAUTOTENDER_INSTANCE_LOG_MAX_BYTES", 1024 * 1024))
+INSTANCE_LOG_BACKUPS = 3
+INSTANCE_LOG_BUFFER_BYTES = 64 * 1024
+
+# The most a single read (or SSE event) hands back, so a long history streams in pieces
+INSTANCE_LOG_READ_BYTES = 64 * 1024
+# How long a tail waits for new lines before checking whether the client went away
+INSTANCE_LOG_TAIL_POLL_SECONDS = 15.0
+
+
+class InstanceLogFile:
+    path: pathlib.Path
+
+    def __init__(self, path: pathlib.Path) -> None:
+        self.path = path
+        self._pending: list[str] = []
+        self._pending_bytes = 0
+        # Bytes that were rotated out of the current file since the process started
+        self._rotated_bytes = 0
+        # Replaced on every flush, so a tail waiting on the old one wakes up
+        self._flushed = asyncio.Event()
+        # Writing out what was pending in a thread, if it is
+        self._writing: asyncio.Task | None = None
+        # Set by discard(), for the files to be deleted once any write under way is done
+        self._deleting = False
+
+    def write(self, lines: list[str]) -> None:
+        timestamp = datetime.now().isoformat(sep=" ", timespec="seconds")
+        for line in lines:
+            entry = f"{timestamp} {line}\n"
+            self._pending.append(entry)
+            self._pending_bytes += len(entry)
+        if self._pending_bytes >= INSTANCE_LOG_BUFFER_BYTES:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write out the pending lines, in a thread when there is an event loop to wait on it."""
+        if self._writing is not None or not (self._pending or self._deleting):
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._write_out(self._take_pending(), self._deleting)
+            self._wake_tails()
+            return
+        self._writing = loop.create_task(self._write_in_thread())
+
+    def discard(self) -> None:
+        """Drop the pending lines and delete the file along with its rotated backups."""
+        self._pending.clear()
+        self._pending_bytes = 0
+        self._deleting = True
+        self.flush()
+
+    async def wait_for_writes(self) -> None:
+        if self._writing is not None:
+            await self._writing
+
+    async def _write_in_thread(self) -> None:
+        try:
+            while self._pending or self._deleting:
+                deleting = self._deleting
+                await asyncio.to_thread(self._write_out, self._take_pending(), deleting)
+                self._wake_tails()
+                if deleting:
+                    return
+        finally:
+            self._writing = None
+
+    def _take_pending(self) -> bytes:
+        data = "".join(self._pending).encode()
+        self._pending = []
+        self._pending_bytes = 0
+        return data
+
+    def _write_out(self, data: bytes, deleting: bool) -> None:
+        try:
+            if deleting:
+                for n in range(INSTANCE_LOG_BACKUPS, 0, -1):
+                    self.path.with_name(f"{self.path.name}.{n}").unlink(missing_ok=True)
+                self.path.unlink(missing_ok=True)
+                return
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "ab") as f:
+                f.write(data)
+                size = f.tell()
+            if size >= INSTANCE_LOG_MAX_BYTES:
+                self._rotate(size)
+        except OSError as e:
+            print(f"Unable to write the instance log {self.path}: {e}")
+
+    def _wake_tails(self) -> None:
+        flushed, self._flushed = self._flushed, asyncio.Event()
+        flushed.set()
+
+    def _rotate(self, size: int) -> None:
+        for n in range(INSTANCE_LOG_BACKUPS, 0, -1):
+            older = self.path.with_name(f"{self.path.name}.{n}")
+            newer = self.path.with_name(f"{self.path.name}.{n-1}") if n > 1 else self.path
+            if newer.exists():
+                os.replace(newer, older)
+        self._rotated_bytes += size
+
+    def end_offset(self) -> int:
+        """The offset just past the last line written out."""
+        try:
+            return self._rotated_bytes + self.path.stat().st_size
+        except FileNotFoundError:
+            return self._rotated_bytes
+
+    def read(self, offset: int, max_bytes: int = INSTANCE_LOG_READ_BYTES) -> tuple[str, int]:
+        """Up to max_bytes of whole lines from offset onwards, and the offset to carry on reading from."""
+        position = offset - self._rotated_bytes
+        try:
+            with open(self.path, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                if position < 0 or position > size:
+                    position = 0
+                f.seek(position)
+                data = f.read(max_bytes)
+        except FileNotFoundError:
+            return "", self._rotated_bytes
+        # Stop at the end of a line so a multi byte character is never split between reads
+        if len(data) == max_bytes and b"\n" in data:
+            data = data[:data.rindex(b"\n")+1]
+        return data.decode(errors="replace"), self._rotated_bytes + position + len(data)
+
+    async def wait_for_flush(self, timeout: float) -> None:
+        try:
+            await asyncio.wait_for(self._flushed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+class InstanceLogs:
+    """The log files of every instance, or nothing at all when no directory is configured."""
+    directory: pathlib.Path | None
+
+    def __init__(self, directory: str | os.PathLike = INSTANCE_LOG_DIR) -> None:
+        self.directory = pathlib.Path(directory) if directory else None
+        self._files: dict[str, InstanceLogFile] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.directory is not None
+
+    def get(self, uuid: str) -> InstanceLogFile | None:
+        """The log file of the instance. None when logging to files is off or the uuid could not be a file name."""
+        if self.directory is None or not uuid or pathlib.Path(uuid).name != uuid:
+            return None
+        if uuid not in self._files:
+            self._files[uuid] = InstanceLogFile(self.directory / f"{uuid}.log")
+        return self._files[uuid]
+
+    def write(self, uuid: str, lines: list[str]) -> None:
+        if log := self.get(uuid):
+            log.write(lines)
+
+    def flush(self, uuid: str) -> None:
+        if uuid in self._files:
+            self._files[uuid].flush()
+
+    def discard(self, uuid: str) -> None:
+        """Forget the instance and delete its log files, for when the instance is deleted."""
+        # Through get() so that a file left from a previous run goes too
+        if log := self.get(uuid):
+            del self._files[uuid]
+            log.discard()
+
+    async def flush_all(self) -> None:
+        for log in self._files.values():
+            log.flush()
+        await asyncio.gather(*(log.wait_for_writes() for log in list(self._files.values())))
+
+
+# ── API ─────────────────────────────────────────────────────────────────────
+
+router = APIRouter(tags=["instances"])
+
+
+def _instance_log(uuid: str) -> InstanceLogFile:
+    # Imported here since the manager is what builds the context that imports this module
+    from .manager import pipelineManager
+    log = pipelineManager.ctx.instance_logs.get(uuid)
+    if log is None:
+        raise HTTPException(status_code=404, detail="Instance log files are not enabled" if not pipelineManager.ctx.instance_logs.enabled else f"No log for the instance {uuid}")
+    return log
+
+
+async def tail_log_events(log: InstanceLogFile, offset: int, client: Request):
+    """SSE events of everything in the log from offset onwards, then each new flush as it happens. Each event id is the offset to resume from."""
+    while True:
+        text, offset = log.read(offset)
+        if text:
+            yield {"event": "log", "id": str(offset), "data": text}
+            continue
+        if await client.is_disconnected():
+            return
+        await log.wait_for_flush(INSTANCE_LOG_TAIL_POLL_SECONDS)
+
+
+@router.get('/instances/{uuid}/log')
+async def read_instance_log(uuid: str, offset: int = 0):
+    log = _instance_log(uuid)
+    text, next_offset = log.read(offset)
+    return {"text": text, "offset": next_offset}
+
+
+@router.get('/instances/{uuid}/log/stream')
+async def stream_instance_log(uuid: str, request: Request, offset: int | None = None):
+    """Tail the log over SSE. A reconnecting EventSource resumes from its Last-Event-ID, and with neither that nor an offset the tail starts at the end."""
+    log = _instance_log(uuid)
+    if offset is None:
+        last_event_id = request.headers.get("last-event-id", "")
+        offset = int(last_event_id) if last_event_id.isdigit() else log.end_offset()
+    return EventSourceResponse(tail_log_events(log, offset, request))
@@ -1,9 +1,11 @@
 # To break the circular dependencies with Workflow, we do this other import style along with the __future__ to allow delayed type checking so everything is imported before the checking happens
 from __future__ import annotations
+from collections import deque
 from datetime import datetime
-from copy import deepcopy,copy
+from copy import copy
 import pipeline_backend.variables as variables
 import pipeline_backend.workflows as workflows
+from pipeline_backend.changes import TrackedDict
 from pipeline_backend.context import PipelineContext
 
 # Enough to hold a stack trace plus some context, which is what the log is really for.
@@ -14,19 +16,26 @@ CONSOLE_LOG_MAX_LINES = 50
 class Instance:
     uuid: str
     workflow_uuid: str
-    state: workflows.RunStates
+    _state: workflows.RunStates
     ctx: PipelineContext
 
     # Per Instance Variables - Initially populated with setup_variables and then runtime can mutate it
-    variables: dict[str, variables.WorkVariable]
+    _variables: TrackedDict
 
     # We always start with the procedure named "start" and at its 0th step
-    processing_step: tuple[str, int]
+    _processing_step: tuple[str, int]
     # The next time we will want to be iterated on. This is not a precise time it will run, but a rough minimum before it gets run. Often gets set by the yield_* commands
-    next_processing_time:datetime
+    _next_processing_time:datetime
 
     # It is handy to debug things when there is actually feedback to the user
-    console_log: str
+    # Kept as the most recent lines and only joined back into text when something reads console_log
+    _console_lines: deque[str]
+    _console_text: str|None
+    # How many lines have ever been logged, trimmed ones included
+    console_log_line_count: int
+
+    # How many attempts at the current step have failed and been retried, see retries.py
+    _retry_attempts: int
 
     def __init__(self, ctx: PipelineContext) -> None:
         self.ctx = ctx
@@ -37,6 +46,7 @@ class Instance:
         self.processing_step = ("start", 0)
         self.next_processing_time = datetime.now()
         self.console_log = ""
+        self.retry_attempts = 0
 
     def __str__(self) -> str:
         return f"Instance {self.uuid} - Workflow: {self.workflow_uuid} - {self.state.name}"
@@ -48,21 +58,98 @@ class Instance:
             sss += f"\n    {varname} = {self.variables[varname]}"
         return sss
 
+    def __setstate__(self, state: dict) -> None:
+        # deepcopy() hands back the variables as a plain dict, so wrap them again
+        self.__dict__.update(state)
+        self._variables = TrackedDict(self._mark_changed, self._variables)
+
+    def _mark_changed(self, _key=None) -> None:
+        """Tell the persistence layer this instance needs saving."""
+        if self.ctx.instances.get(self.uuid) is self:
+            self.ctx.changes.mark_instance(self.uuid)
+
+    # Both of these decide when the instance runs next, so changing either one reschedules it
+    @property
+    def state(self) -> workflows.RunStates:
+        return self._state
+
+    @state.setter
+    def state(self, state: workflows.RunStates) -> None:
+        self._state = state
+        self._mark_changed()
+        self.ctx.due_queue.push(self)
+
+    @property
+    def next_processing_time(self) -> datetime:
+        return self._next_processing_time
+
+    @next_processing_time.setter
+    def next_processing_time(self, next_processing_time: datetime) -> None:
+        self._next_processing_time = next_processing_time
+        self._mark_changed()
+        self.ctx.due_queue.push(self)
+
+    @property
+    def processing_step(self) -> tuple[str, int]:
+        return self._processing_step
+
+    @processing_step.setter
+    def processing_step(self, processing_step: tuple[str, int]) -> None:
+        self._processing_step = processing_step
+        self._mark_changed()
+
+    @property
+    def retry_attempts(self) -> int:
+        return self._retry_attempts
+
+    @retry_attempts.setter
+    def retry_attempts(self, retry_attempts: int) -> None:
+        self._retry_attempts = retry_attempts
+        self._mark_changed()
+
+    @property
+    def console_log(self) -> str:
+        if self._console_text is None:
+            self._console_text = "".join(line+"\n" for line in self._console_lines)
+        return self._console_text
+
+    @property
+    def console_log_trimmed_lines(self) -> int:
+        """How many of the earliest logged lines console_log no longer has."""
+        return self.console_log_line_count - len(self._console_lines)
+
+    @console_log.setter
+    def console_log(self, console_log: str) -> None:
+        # The text always ends in a newline, which would otherwise become a trailing empty line
+        lines = console_log.split("\n")
+        if lines[-1] == "":
+            lines.pop()
+        self._console_lines = deque(lines, maxlen=CONSOLE_LOG_MAX_LINES)
+        self._console_text = None
+        self.console_log_line_count = len(lines)
+        self._mark_changed()
+
+    @property
+    def variables(self) -> dict[str, variables.WorkVariable]:
+        return self._variables
+
+    @variables.setter
+    def variables(self, new_variables: dict[str, variables.WorkVariable]) -> None:
+        self._variables = TrackedDict(self._mark_changed, new_variables)
+        self._mark_changed()
+
     def get_associated_workflow(self) -> workflows.Workflow:
         return self.ctx.workflows[self.workflow_uuid]
 
     def log_line(self, line):
         """Will add a line to the log. This will add its own newline to the end of the line. Only the most recent CONSOLE_LOG_MAX_LINES lines are kept."""
-        self.console_log += line+"\n"
-        self.trim_console_log()
-
-    def trim_console_log(self) -> None:
-        """Keep only the most recent CONSOLE_LOG_MAX_LINES lines of the log."""
         # A logged line can itself be multi-line (tracebacks), so count real lines.
-        # console_log always ends in a newline, hence the trailing empty entry.
-        lines = self.console_log.split("\n")
-        if len(lines) > CONSOLE_LOG_MAX_LINES + 1:
-            self.console_log = "\n".join(lines[-(CONSOLE_LOG_MAX_LINES+1):])
+        lines = line.split("\n")
+        self._console_lines.extend(lines)
+        self.console_log_line_count += len(lines)
+        self._console_text = None
+        self.ctx.instance_logs.write(self.uuid, lines)
+        self._mark_changed()
 
     def __getitem__(self, var_name: str|variables.VariablePath) -> variables.WorkVariable:
         """Get the value of the variable at the given name or dot-notation path (e.g. 'entry.link').
@@ -78,23 +165,24 @@ class Instance:
         for scope in (self.variables, w.constants, w.setup_variables,
                       self.ctx.variables, self.ctx.secrets):
             if first in scope:
-                result = deepcopy(scope[first])
+                result = scope[first].share()
                 break
         else:
             raise KeyError(f"Unable to find the variable named {first} - {self.workflow_uuid}/{self.uuid}")
 
+        # Walking the path only reads, so it goes through read_value() and shares just the leaf
         for part in parts[1:]:
             match result:
                 case variables.Dictionary():
-                    if part not in result.value:
+                    if part not in result.read_value():
                         raise KeyError(f"Key '{part}' not found in Dictionary")
-                    result = deepcopy(result.value[part])
+                    result = result.read_value()[part].share()
                 case variables.VariableList():
-                    result = deepcopy(result.value[int(part)])
+                    result = result.read_value()[int(part)].share()
                 case variables.StringList():
-                    result = variables.String(result.value[int(part)])
+                    result = variables.String(result.read_value()[int(part)])
                 case variables.VariableNameList():
-                    result = variables.VariablePath(result.value[int(part)])
+                    result = variables.VariablePath(result.read_value()[int(part)])
                 case _:
                     raise KeyError(f"Cannot index into {type(result).__name__} with '{part}'")
 
@@ -109,13 +197,13 @@ class Instance:
         parts = var_name.split('.')
 
         if len(parts) == 1:
-            self.variables[var_name] = deepcopy(value)
+            self.variables[var_name] = value.share()
             return
 
         # Get or create the top-level container
         top_key = parts[0]
         if top_key in self.variables:
-            top = deepcopy(self.variables[top_key])
+            top = self.variables[top_key].share()
         else:
             top = variables.Dictionary()
 
@@ -130,7 +218,7 @@ class Instance:
 
         if not isinstance(current, variables.Dictionary):
             raise TypeError(f"Cannot set key '{parts[-1]}' into {type(current).__name__}")
-        current.value[parts[-1]] = deepcopy(value)
+        current.value[parts[-1]] = value.share()
         self.variables[top_key] = top
 
     def __delitem__(self, var_name: str|variables.VariablePath) -> None:
@@ -161,7 +249,7 @@ class Instance:
             asoc_wf = self.get_associated_workflow()
         except:
             return False
-        return self.state == workflows.RunStates.Running and asoc_wf.state == workflows.RunStates.Running
+        return self.state == workflows.RunStates.Running and asoc_wf.state == workflows.RunStates.Running and asoc_wf.compile_error is None
     
 
     def json_savable(self) -> dict:
@@ -172,6 +260,8 @@ class Instance:
             'processing_step': copy(self.processing_step),
             'next_processing_time': self.next_processing_time.isoformat(),
             'console_log': copy(self.console_log),
+            'console_log_line_count': self.console_log_line_count,
+            'retry_attempts': self.retry_attempts,
             'variables': {}
             }
         for var_name in self.variables:
@@ -185,7 +275,8 @@ class Instance:
         self.processing_step = tuple(data['processing_step'])
         self.next_processing_time = datetime.fromisoformat( data['next_processing_time'] )
         self.console_log = data['console_log']
-        self.trim_console_log()
+        self.console_log_line_count = data.get('console_log_line_count', self.console_log_line_count)
+        self.retry_attempts = data.get('retry_attempts', 0)
         for var_name in data['variables']:
             var = variables.WorkVariable()
             var.json_loadable(data['variables'][var_name])
@@ -1,4 +1,5 @@
 import asyncio
+from collections import Counter
 from asyncio import Handle, TimerHandle, get_running_loop
 from datetime import datetime, timedelta
 import importlib.util
@@ -6,10 +7,16 @@ import json
 import os
 import pathlib
 import sys
+import threading
+import time
 import traceback
 import types
 
+from .changes import ChangeTracker
 from .context import PipelineContext
+from .cpu_pool import shutdown_cpu_pool
+from . import metrics
+from .persistence import ChangedKeys, JsonStateStore, StateStore, atomic_write_json, empty_state, open_state_store
 from .workflows import Workflow
 from .instances import Instance
 from .variables import WorkVariable
@@ -21,12 +28,60 @@ from .event_callbacks import eventsCallbackManager, EventCallbacksManager
 # is what lets an addon split itself across files and use relative imports.
 ADDON_NAMESPACE = "webautotender_addons"
 
+# A burst of instances yielding together should cost one write of the state file, not one
+# each. Writes wait for things to go quiet for the coalesce window, but never hold a change
+# back for longer than the max latency.
+SAVE_COALESCE_SECONDS = 1.0
+SAVE_MAX_LATENCY_SECONDS = 10.0
+
+# How the backing store is kept on disk - "json" rewrites one file, "journal" appends the
+# changes to a journal next to it, and "sqlite" keeps a row per object. See persistence.py
+STATE_BACKEND = os.environ.get("WEBAUTOTENDER_STATE_BACKEND", "json")
+
+# With the journal backend, append what an instance changed as soon as it yields rather than
+# coalescing it with everything else, so a crash loses no step that has finished. Each yield
+# then costs an append and an fsync of its own.
+JOURNAL_EACH_YIELD = bool(int(os.environ.get("WEBAUTOTENDER_JOURNAL_EACH_YIELD", 0)))
+
+# How many instances may run at once across the whole pipeline, 0 for no limit. A workflow can
+# also cap its own instances with Workflow.max_running_instances. Due instances that are held
+# back start in due time order as the running ones yield.
+MAX_RUNNING_INSTANCES = int(os.environ.get("WEBAUTOTENDER_MAX_RUNNING_INSTANCES", 0))
+
+# How long stop() waits for running instances to yield before cancelling them. A cancelled
+# instance stays on the step it was running, so that step runs again on the next start.
+STOP_GRACE_SECONDS = float(os.environ.get("WEBAUTOTENDER_STOP_GRACE_SECONDS", 30))
+
 
 def _ensure_addon_namespace() -> None:
     if ADDON_NAMESPACE not in sys.modules:
         sys.modules[ADDON_NAMESPACE] = types.ModuleType(ADDON_NAMESPACE)
 
 
+def load_addon_module(module_name: str, init_path: str) -> types.ModuleType:
+    """Import the addon package whose __init__.py is at init_path as module_name. Raises whatever importing it raises."""
+    _ensure_addon_namespace()
+    spec = importlib.util.spec_from_file_location(module_name, init_path)
+    module = importlib.util.module_from_spec(spec)
+    # Has to be registered before it is executed, otherwise a relative import
+    # inside the addon cannot find the package it belongs to.
+    sys.modules[module_name] = module
+    try:
+        spec.loader.exec_module(module)
+    except BaseException:
+        sys.modules.pop(module_name, None)
+        raise
+    return module
+
+
+def loaded_addon_locations() -> dict[str, str]:
+    """The module name and __init__.py of every addon imported so far."""
+    return {
+        name: module.__spec__.origin for name, module in list(sys.modules.items())
+        if name.startswith(f"{ADDON_NAMESPACE}.") and name.count(".") == 1
+    }
+
+
 def addon_search_paths() -> list[pathlib.Path]:
     """Every folder that may hold addons, highest priority first. An addon found earlier in this list shadows one of the same name found later."""
     paths: list[pathlib.Path] = []
@@ -66,51 +121,198 @@ class PipelineManager:
     def __init__(self) -> None:
         super().__init__()
         self.ctx = PipelineContext()
+        self.ctx.notify_of_something_happening = self.notify_of_something_happening
         self.delayedTask = None
         self._running_instance_tasks: dict[str, asyncio.Task] = {}
+        self.stop_grace_seconds = STOP_GRACE_SECONDS
+        self.max_running_instances = MAX_RUNNING_INSTANCES
+        # Due instances that their workflow's running limit held back, by workflow uuid in the order they were due
+        self._held_back: dict[str, dict[str, Instance]] = {}
         self._shutting_down = False
         self.__backing_store_filename = ""
         self.__secrets_filename = ""
+        self.state_backend = STATE_BACKEND
+        self.journal_each_yield = JOURNAL_EACH_YIELD
+        self._state_store: StateStore | None = None
+        self.save_coalesce_seconds = SAVE_COALESCE_SECONDS
+        self.save_max_latency_seconds = SAVE_MAX_LATENCY_SECONDS
+        self._save_handle: TimerHandle | None = None
+        self._save_task: asyncio.Task | None = None
+        self._dirty_since: float | None = None
+        # json_savable() of every workflow, instance and global as of the last snapshot. Only
+        # what ctx.changes reports gets rebuilt, and _unsaved is what the backing store has
+        # not been sent yet.
+        self._savable: dict[str, dict[str, dict]] = empty_state()
+        self._unsaved = ChangeTracker()
+        # Background writes and the synchronous save_state() can overlap, so the generation
+        # stops an older snapshot that finishes late from replacing a newer one
+        self._state_write_lock = threading.Lock()
+        self._state_generation = 0
+        self._written_state_generation = 0
 
     # ── Persistence ───────────────────────────────────────────────────────────
 
     def _atomic_write_json(self, target: str, data: dict) -> None:
-        tmp_target = f"{target}.tmp"
+        atomic_write_json(target, data)
+
+    def _state_target(self, filename: str = "") -> str:
+        return filename or self.__backing_store_filename or "pipeline_state.json"
+
+    def _get_state_store(self, target: str) -> StateStore:
+        """The backing store for the backing file. Any other file is a plain JSON export."""
+        if target != self._state_target():
+            return JsonStateStore(target)
+        if self._state_store is None or self._state_store.filename != target:
+            if self._state_store is not None:
+                self._state_store.close()
+            self._state_store = open_state_store(target, self.state_backend)
+        return self._state_store
+
+    def _live_state(self) -> dict[str, dict]:
+        return {"workflows": self.ctx.workflows, "instances": self.ctx.instances, "variables": self.ctx.variables}
+
+    def _refresh_savable(self) -> None:
+        """Rebuild the cached json_savable() of whatever changed since the last call."""
+        taken = self.ctx.changes.take()
+        live = self._live_state()
+        for section, keys in taken.items():
+            for key in keys:
+                if key in live[section]:
+                    self._savable[section][key] = live[section][key].json_savable()
+                else:
+                    self._savable[section].pop(key, None)
+        self._unsaved.restore(taken)
+
+    def _savable_state(self) -> dict:
+        # Only the json_savable() calls for what changed happen here on the event loop. The
+        # dumps and fsync happen wherever the state is written. Variable values are only ever
+        # replaced by Instance.__setitem__ rather than edited in place, so the leaves this
+        # shares with the live objects stay put while another thread serializes them.
+        data = {}
+        for section, live in self._live_state().items():
+            savable = self._savable[section]
+            for key in live.keys() - savable.keys():
+                savable[key] = live[key].json_savable()
+            data[section] = {key: savable[key] for key in live}
+        return data
+
+    def _state_snapshot(self) -> tuple[dict, ChangedKeys, int]:
+        """The state for the backing store, along with what changed since it was last sent any."""
+        self._refresh_savable()
+        self._state_generation += 1
+        return self._savable_state(), self._unsaved.take(), self._state_generation
+
+    def _write_state_snapshot(self, target: str, data: dict, changed: ChangedKeys, generation: int) -> bool:
+        """Returns False when a newer snapshot was written already. Its caller has to hand the changes back to _unsaved."""
+        with self._state_write_lock:
+            if generation < self._written_state_generation:
+                return False
+            start = time.perf_counter()
+            written_bytes = self._get_state_store(target).write_snapshot(data, changed)
+            metrics.save_duration_histogram.observe(time.perf_counter() - start)
+            metrics.save_bytes_counter.inc(written_bytes)
+            metrics.last_save_bytes_gauge.set(written_bytes)
+            self._written_state_generation = generation
+            return True
+
+    def save_state(self, filename: str = "") -> None:
+        """Write the state out right now. Saving to the backing store also covers any save that request_save() has pending."""
+        target = self._state_target(filename)
+        if target != self._state_target():
+            self.export_state(target)
+            return
+        self._dirty_since = None
+        if self._save_handle:
+            self._save_handle.cancel()
+            self._save_handle = None
+        data, changed, generation = self._state_snapshot()
+        written = False
         try:
-            with open(tmp_target, "w") as f:
-                f.write(json.dumps(data, indent=4))
-                f.flush()
-                os.fsync(f.fileno())
-            os.replace(tmp_target, target)
+            written = self._write_state_snapshot(target, data, changed, generation)
         finally:
-            try:
-                os.remove(tmp_target)
-            except FileNotFoundError:
-                pass
+            if not written:
+                self._unsaved.restore(changed)
 
-    def save_state(self, filename: str = "") -> None:
-        target = filename or self.__backing_store_filename or "pipeline_state.json"
-        data = {
-            "workflows": {uuid: w.json_savable() for uuid, w in self.ctx.workflows.items()},
-            "instances": {uuid: i.json_savable() for uuid, i in self.ctx.instances.items()},
-            "variables": {name: v.json_savable() for name, v in self.ctx.variables.items()},
-        }
-        self._atomic_write_json(target, data)
+    def request_save(self, immediately: bool = False) -> None:
+        """Mark the state as changed. It gets written out off the event loop once things have been quiet for save_coalesce_seconds, or save_max_latency_seconds after the first unsaved change at the latest - or straight away if asked to."""
+        try:
+            loop = get_running_loop()
+        except RuntimeError:
+            self.save_state()
+            return
+        now = loop.time()
+        if self._dirty_since is None:
+            self._dirty_since = now
+        deadline = now if immediately else min(now + self.save_coalesce_seconds, self._dirty_since + self.save_max_latency_seconds)
+        if self._save_handle:
+            self._save_handle.cancel()
+        self._save_handle = loop.call_at(deadline, self._begin_flush)
+
+    def _begin_flush(self) -> None:
+        self._save_handle = None
+        if self._save_task and not self._save_task.done():
+            # Still writing the last batch - it reschedules itself if anything changed meanwhile
+            return
+        self._save_task = get_running_loop().create_task(self.flush_state())
+
+    async def flush_state(self) -> None:
+        """Write out the state if request_save() has a save pending. The file work happens in a thread."""
+        if self._dirty_since is None:
+            return
+        self._dirty_since = None
+        if self._save_handle:
+            self._save_handle.cancel()
+            self._save_handle = None
+        target = self._state_target()
+        data, changed, generation = self._state_snapshot()
+        written = False
+        try:
+            written = await asyncio.to_thread(self._write_state_snapshot, target, data, changed, generation)
+        except Exception:
+            print(f"Unable to save the pipeline state to {target} - will retry")
+            print(traceback.format_exc())
+        finally:
+            if not written:
+                # Whatever this snapshot carried still has to reach the store
+                self._unsaved.restore(changed)
+                self.request_save()
+        if self._dirty_since is not None and self._save_handle is None:
+            self.request_save(self._journals_each_yield())
 
     def restore_state(self, filename: str = "pipeline_state.json") -> None:
         self.__backing_store_filename = filename
-        try:
-            with open(filename, "r") as f:
-                data = json.loads(f.read())
-        except FileNotFoundError:
+        data = self._get_state_store(filename).load()
+        if data is None:
             print(f"Unable to open filepath {filename} - skipping restoring state")
             return
+        self._load_state_data(data)
+        # The store already holds everything that was just loaded
+        self._refresh_savable()
+        self._unsaved.take()
+
+    def export_state(self, filename: str) -> None:
+        """Write the state as a plain JSON file, whichever backend is in use."""
+        self._refresh_savable()
+        JsonStateStore(filename).write_snapshot(self._savable_state())
+
+    def import_state(self, filename: str) -> None:
+        """Replace the state with a plain JSON file and save it to the backing store."""
+        data = JsonStateStore(filename).load()
+        if data is None:
+            raise FileNotFoundError(f"Unable to open filepath {filename} to import state from")
+        self._load_state_data(data)
+        self.save_state()
 
+    def _load_state_data(self, data: dict) -> None:
+        # Clearing and refilling the registries marks every old and new key as changed
         self.ctx.workflows.clear()
         for uuid, workflow_data in data["workflows"].items():
             workflow = Workflow(self.ctx)
             workflow.json_loadable(workflow_data)
             self.ctx.workflows[uuid] = workflow
+            # Hold back a workflow with a step that cannot run now, rather than fail partway through an instance
+            if not workflow.compile():
+                print(f"Workflow {uuid} does not compile, so its instances will not run until it does - {workflow.compile_error}")
 
         self.ctx.instances.clear()
         for uuid, instance_data in data["instances"].items():
@@ -156,33 +358,71 @@ class PipelineManager:
             )
         finally:
             self._running_instance_tasks.pop(instance.uuid, None)
-            self.save_state()
+            self.ctx.instance_logs.flush(instance.uuid)
+            # Whatever it was rescheduled to while running was skipped over, so queue it again
+            self.ctx.due_queue.push(instance)
+            # A slot of its workflow is free, so whatever that held back gets another go
+            self.ctx.due_queue.push_all(self._held_back.pop(instance.workflow_uuid, {}).values())
+            self.request_save(self._journals_each_yield())
             await self.notify_of_something_happening()
 
+    def _journals_each_yield(self) -> bool:
+        return self.journal_each_yield and self.state_backend == "journal"
+
+    def _at_running_limit(self) -> bool:
+        return bool(self.max_running_instances) and len(self._running_instance_tasks) >= self.max_running_instances
+
+    def _running_per_workflow(self) -> Counter[str]:
+        running = Counter()
+        for uuid in self._running_instance_tasks:
+            if instance := self.ctx.instances.get(uuid):
+                running[instance.workflow_uuid] += 1
+        return running
+
     async def run_due_instances(self) -> None:
-        """Launches all instances that are due as independent concurrent tasks."""
+        """Launches the instances that are due as independent concurrent tasks, soonest due first, as far as the running instance limits allow."""
         current_time = datetime.now()
-        for instance in list(self.ctx.instances.values()):
-            if (instance.is_allowed_to_run()
-                    and instance.past_time_to_run(current_time)
-                    and instance.uuid not in self._running_instance_tasks):
-                task = get_running_loop().create_task(self._run_one_instance(instance))
-                self._running_instance_tasks[instance.uuid] = task
+        running_per_workflow = self._running_per_workflow()
+        while not self._at_running_limit() and (instance := self.ctx.due_queue.pop_due(current_time, self._running_instance_tasks)):
+            # Also what flags an instance that lost its due time as an Error
+            if not instance.past_time_to_run(current_time):
+                continue
+            workflow = self.ctx.workflows.get(instance.workflow_uuid)
+            if workflow and workflow.max_running_instances and running_per_workflow[workflow.uuid] >= workflow.max_running_instances:
+                # Out of the due queue until one of the workflow's instances finishes running
+                self._held_back.setdefault(workflow.uuid, {})[instance.uuid] = instance
+                continue
+            running_per_workflow[instance.workflow_uuid] += 1
+            lag_seconds = (current_time - instance.next_processing_time).total_seconds()
+            metrics.dispatched_counter.inc()
+            metrics.scheduler_lag_histogram.observe(lag_seconds)
+            task = get_running_loop().create_task(self._run_one_instance(instance))
+            self._running_instance_tasks[instance.uuid] = task
+
+    def update_metrics(self) -> None:
+        """Fill in the metrics that are worked out when they are scraped rather than kept up to date."""
+        by_workflow_and_state = Counter((instance.workflow_uuid, instance.state.name) for instance in self.ctx.instances.values())
+        metrics.instances_gauge.clear()
+        for (workflow_uuid, state), count in by_workflow_and_state.items():
+            workflow = self.ctx.workflows.get(workflow_uuid)
+            metrics.instances_gauge.set(count, workflow_uuid=workflow_uuid, workflow=workflow.name if workflow else "", state=state)
+        metrics.running_instances_gauge.set(len(self._running_instance_tasks))
+        metrics.due_backlog_gauge.set(self.ctx.due_queue.count_due(datetime.now(), self._running_instance_tasks))
+        metrics.held_back_instances_gauge.set(sum(
+            1 for held_back in self._held_back.values() for instance in held_back.values()
+            if self.ctx.instances.get(instance.uuid) is instance and instance.is_allowed_to_run()))
 
     def get_next_due_time(self) -> datetime | None:
-        current_time = datetime.now()
-        minimum_next_due_time = current_time + timedelta(seconds=1)
-
-        possible_instances = [i for i in self.ctx.instances.values()
-                              if i.is_allowed_to_run() and i.uuid not in self._running_instance_tasks]
-        if len(possible_instances) == 0:
+        if self._at_running_limit():
+            # Nothing more can start until a running instance yields, and that wakes us anyway
+            return None
+        next_due_time = self.ctx.due_queue.peek_next_due_time(self._running_instance_tasks)
+        if next_due_time is None:
             return None
         # An instance with no next_processing_time gets marked Error by past_time_to_run(),
-        # so just wake on the floor and let the next pass sort it out.
-        due_times = [i.next_processing_time for i in possible_instances if i.next_processing_time]
-        if not due_times:
-            return minimum_next_due_time
-        return max(min(due_times), minimum_next_due_time)
+        # so it just wakes on the floor and lets the next pass sort it out
+        minimum_next_due_time = datetime.now() + timedelta(seconds=1)
+        return max(next_due_time, minimum_next_due_time)
 
     async def run(self):
         await self.run_due_instances()
@@ -216,9 +456,19 @@ class PipelineManager:
             print(f"Waiting for {len(uuids)} running instance(s) to yield before shutdown:")
             for uuid in uuids:
                 print(f"  {uuid}")
-            await asyncio.gather(*self._running_instance_tasks.values(), return_exceptions=True)
-            print("All instances have yielded, shutting down.")
+            _, still_running = await asyncio.wait(self._running_instance_tasks.values(), timeout=self.stop_grace_seconds)
+            if still_running:
+                print(f"Cancelling {len(still_running)} instance(s) that did not yield within {self.stop_grace_seconds} seconds")
+                for task in still_running:
+                    task.cancel()
+                await asyncio.gather(*still_running, return_exceptions=True)
+            print("All instances have stopped, shutting down.")
+        if self._save_task:
+            await asyncio.gather(self._save_task, return_exceptions=True)
+        # Anything still waiting out the coalesce window gets written now
         self.save_state()
+        await self.ctx.instance_logs.flush_all()
+        shutdown_cpu_pool()
 
     def discover_addons(self) -> dict[str, pathlib.Path]:
         """Map each addon name to the folder it will be loaded from. The first match along the search path wins, so a higher priority location shadows a lower one."""
@@ -248,17 +498,10 @@ class PipelineManager:
 
     def import_addon(self, module_path: pathlib.Path):
         """Import a single addon directory as a submodule of ADDON_NAMESPACE. Returns the module, or None if it failed to import."""
-        _ensure_addon_namespace()
         module_name = f"{ADDON_NAMESPACE}.{module_path.name}"
         try:
-            spec = importlib.util.spec_from_file_location(module_name, module_path.as_posix() + "/__init__.py")
-            module = importlib.util.module_from_spec(spec)
-            # Has to be registered before it is executed, otherwise a relative import
-            # inside the addon cannot find the package it belongs to.
-            sys.modules[module_name] = module
-            spec.loader.exec_module(module)
+            module = load_addon_module(module_name, module_path.as_posix() + "/__init__.py")
         except Exception:
-            sys.modules.pop(module_name, None)
             print(f"Unable to import the addon at {module_path}")
             print(traceback.format_exc())
             return None
@@ -266,3 +509,4 @@ class PipelineManager:
 
 
 pipelineManager = PipelineManager()
+metrics.metrics.add_collector(pipelineManager.update_metrics)
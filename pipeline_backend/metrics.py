@@ -0,0 +1,247 @@
+import math
+import threading
+from collections.abc import Callable, Iterable
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+# =====================================================================================
+# Metrics
+# =====================================================================================
+# Counters, gauges and histograms that the manager, the runner and the event callbacks keep
+# up to date, served at /api/metrics in the Prometheus text format for anything that scrapes
+# it. Whatever is cheaper to work out when asked than to keep up to date on every change
+# (how many instances are in each state, how deep the due backlog is) is filled in by the
+# collectors that run just before each scrape.
+#
+# Metrics are recorded from the save thread as well as the event loop, so each one has its
+# own lock.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds, from a quick sync command up to a download or a long wait on a server
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0, 300.0, 1800.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str]) -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    kind = ""
+    name: str
+    help: str
+    labelnames: tuple[str, ...]
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        if labels.keys() != set(self.labelnames):
+            raise ValueError(f"The metric {self.name} takes the labels {self.labelnames}, not {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """Only ever goes up."""
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()) -> None:
+        super().__init__(name, help, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in values]
+
+
+class Gauge(Metric):
+    """A value that goes up and down."""
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()) -> None:
+        super().__init__(name, help, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def clear(self) -> None:
+        """Forget every label set, for a collector that fills the gauge in afresh."""
+        with self._lock:
+            self._values.clear()
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in values]
+
+
+class Histogram(Metric):
+    """How many observations fell at or under each bucket's upper bound, along with their count and sum."""
+    kind = "histogram"
+    buckets: tuple[float, ...]
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # Per label set, the count in each bucket (not yet cumulative) and the sum
+        self._counts: dict[tuple[str, ...], list[int]] = {}
+        self._sums: dict[tuple[str, ...], float] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = next(i for i, bound in enumerate(self.buckets) if value <= bound)
+        with self._lock:
+            if key not in self._counts:
+                self._counts[key] = [0] * len(self.buckets)
+                self._sums[key] = 0.0
+            self._counts[key][index] += 1
+            self._sums[key] += value
+
+    def count(self, **labels: str) -> int:
+        return sum(self._counts.get(self._key(labels), ()))
+
+    def sum(self, **labels: str) -> float:
+        return self._sums.get(self._key(labels), 0.0)
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            series = [(key, list(counts), self._sums[key]) for key, counts in self._counts.items()]
+        lines = []
+        for key, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames + ("le",), key + (_format_value(bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self._metrics: dict[str, Metric] = {}
+        self._collectors: list[Callable[[], None]] = []
+
+    def _register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"A metric named {metric.name} is registered already")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, help, labelnames))
+
+    def gauge(self, name: str, help: str, labelnames: tuple[str, ...] = ()) -> Gauge:
+        return self._register(Gauge(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def get(self, name: str) -> Metric:
+        return self._metrics[name]
+
+    def add_collector(self, collector: Callable[[], None]) -> None:
+        """Have collector fill in its metrics just before every render."""
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception as e:
+                print(f"Unable to collect metrics with {collector}: {e}")
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+
+metrics = MetricsRegistry()
+
+# ── Scheduler ───────────────────────────────────────────────────────────────
+
+instances_gauge = metrics.gauge("webautotender_instances", "Instances by workflow and state", ("workflow_uuid", "workflow", "state"))
+running_instances_gauge = metrics.gauge("webautotender_running_instances", "Instances running right now")
+due_backlog_gauge = metrics.gauge("webautotender_due_backlog", "Instances that are due but not running")
+held_back_instances_gauge = metrics.gauge("webautotender_held_back_instances", "Due instances waiting for their workflow's running limit to let them start")
+dispatched_counter = metrics.counter("webautotender_dispatched_total", "Instances the scheduler has started running")
+scheduler_lag_histogram = metrics.histogram(
+    "webautotender_scheduler_lag_seconds", "How long after its next_processing_time an instance was started",
+    buckets=(0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 1800.0, 3600.0))
+
+# ── Commands ────────────────────────────────────────────────────────────────
+
+step_duration_histogram = metrics.histogram("webautotender_step_duration_seconds", "How long each run of a command took", ("command",))
+command_retries_counter = metrics.counter("webautotender_command_retries_total", "Failed runs of a command that will be tried again", ("command",))
+command_failures_counter = metrics.counter("webautotender_command_failures_total", "Runs of a command that raised and marked the instance Error", ("command",))
+command_blocked_seconds_gauge = metrics.gauge("webautotender_command_blocked_seconds", "Time in all that a command has held up the event loop or a blocking command thread", ("command",))
+command_blocked_max_seconds_gauge = metrics.gauge("webautotender_command_blocked_max_seconds", "The longest a single run of a command has held up the event loop or a blocking command thread", ("command",))
+
+# ── Saving ──────────────────────────────────────────────────────────────────
+
+save_duration_histogram = metrics.histogram(
+    "webautotender_save_state_duration_seconds", "How long writing the state to the backing store took",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0))
+save_bytes_counter = metrics.counter("webautotender_save_state_bytes_total", "Bytes written to the backing store")
+last_save_bytes_gauge = metrics.gauge("webautotender_save_state_last_bytes", "Bytes written by the latest save of the state")
+
+# ── Server Sent Events ──────────────────────────────────────────────────────
+
+sse_subscribers_gauge = metrics.gauge("webautotender_sse_subscribers", "Clients connected to the events stream")
+sse_queued_messages_gauge = metrics.gauge("webautotender_sse_queued_messages", "Events waiting to be sent, across every client")
+sse_max_queue_depth_gauge = metrics.gauge("webautotender_sse_max_queue_depth", "Events waiting to be sent to the client furthest behind")
+events_signalled_counter = metrics.counter("webautotender_events_signalled_total", "Events signalled to the subscribers", ("event",))
+
+
+# ── API ─────────────────────────────────────────────────────────────────────
+
+router = APIRouter(tags=["utils"])
+
+
+@router.get('/metrics', response_class=PlainTextResponse)
+async def read_metrics():
+    return PlainTextResponse(metrics.render(), media_type=CONTENT_TYPE)
@@ -0,0 +1,391 @@
+import json
+import os
+import sqlite3
+import threading
+
+# =====================================================================================
+# State Stores
+# =====================================================================================
+# Where PipelineManager keeps the workflows, instances and globals between runs.
+# Every store speaks the same "state" dict that json_savable() builds:
+#   {"workflows": {uuid: ...}, "instances": {uuid: ...}, "variables": {name: ...}}
+# and that plain JSON layout stays the import/export format no matter which store is in use.
+#
+# write_snapshot() is always called from a worker thread with the PipelineManager write lock
+# held, so a store never sees two writes at once. Along with the state it is told which keys
+# of each section changed since the last write (see pipeline_backend.changes), so unchanged
+# objects never have to be serialized again.
+
+STATE_SECTIONS = ("workflows", "instances", "variables")
+
+# {section: {key, ...}} - the keys that changed. A key that is missing from the state was removed.
+ChangedKeys = dict[str, set[str]]
+
+
+def empty_state() -> dict:
+    return {section: {} for section in STATE_SECTIONS}
+
+
+def atomic_write_text(target: str, text: str) -> int:
+    """Replace target with text, all or nothing. Returns how many bytes were written."""
+    payload = text.encode()
+    tmp_target = f"{target}.tmp"
+    try:
+        with open(tmp_target, "wb") as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_target, target)
+    finally:
+        try:
+            os.remove(tmp_target)
+        except FileNotFoundError:
+            pass
+    return len(payload)
+
+
+def atomic_write_json(target: str, data: dict) -> None:
+    atomic_write_text(target, json.dumps(data, indent=4))
+
+
+def _indent_json(value, depth: int) -> str:
+    """json.dumps(value, indent=4) as it reads when nested depth levels deep."""
+    return json.dumps(value, indent=4).replace("\n", "\n" + "    " * depth)
+
+
+class StateStore:
+    filename: str
+
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        # Each object as it was last rendered by _render_json()
+        self._fragments: dict[str, dict[str, str]] = {section: {} for section in STATE_SECTIONS}
+
+    def load(self) -> dict | None:
+        """Read back the saved state, or None when nothing has been saved yet."""
+        raise NotImplementedError
+
+    def write_snapshot(self, data: dict, changed: ChangedKeys | None = None) -> int:
+        """Persist the complete state, returning how many bytes that wrote. changed narrows down what differs from the last write - None means anything might."""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+    def _render_json(self, data: dict, changed: ChangedKeys | None = None) -> str:
+        """The same text as json.dumps(data, indent=4), only dumping the objects that changed since the last call."""
+        parts = []
+        for name, value in data.items():
+            if name not in STATE_SECTIONS:
+                parts.append(f"    {json.dumps(name)}: {_indent_json(value, 1)}")
+                continue
+            fragments = self._fragments[name]
+            for key in fragments.keys() - value.keys():
+                del fragments[key]
+            for key, obj in value.items():
+                if changed is None or key in changed[name] or key not in fragments:
+                    fragments[key] = _indent_json(obj, 2)
+            if value:
+                entries = ",\n".join(f"        {json.dumps(key)}: {fragments[key]}" for key in value)
+                parts.append(f"    {json.dumps(name)}: {{\n{entries}\n    }}")
+            else:
+                parts.append(f"    {json.dumps(name)}: {{}}")
+        if not parts:
+            return "{}"
+        return "{\n" + ",\n".join(parts) + "\n}"
+
+
+class JsonStateStore(StateStore):
+    """The whole world in a single JSON file, rewritten on every save."""
+
+    def load(self) -> dict | None:
+        try:
+            with open(self.filename, "r") as f:
+                return json.loads(f.read())
+        except FileNotFoundError:
+            return None
+
+    def write_snapshot(self, data: dict, changed: ChangedKeys | None = None) -> int:
+        return atomic_write_text(self.filename, self._render_json(data, changed))
+
+
+class IncrementalStateStore(StateStore):
+    """Base for the stores that write each workflow, instance and global on its own, so only what changed needs writing."""
+
+    def __init__(self, filename: str) -> None:
+        super().__init__(filename)
+        # What each object looked like when it was last written, to know what changed
+        self._persisted: dict[tuple[str, str], str] = {}
+        # Set when the store holds less than was loaded (eg state imported from elsewhere), so
+        # the next write has to go over everything rather than only what changed
+        self._needs_full_write = False
+
+    def _remember_persisted(self, data: dict) -> None:
+        self._persisted = {
+            (section, key): json.dumps(value)
+            for section in STATE_SECTIONS
+            for key, value in data.get(section, {}).items()
+        }
+
+    def _diff(self, data: dict, changed: ChangedKeys | None) -> tuple[list[tuple[str, str, str]], list[tuple[str, str]]]:
+        """Returns the (section, key, dumped) of the objects that changed, and the (section, key) of the ones that are gone."""
+        if changed is None or self._needs_full_write:
+            candidates = {(section, key) for section in STATE_SECTIONS for key in data[section]} | self._persisted.keys()
+        else:
+            candidates = {(section, key) for section, keys in changed.items() for key in keys}
+        updated = []
+        removed = []
+        for section, key in candidates:
+            if key in data[section]:
+                dumped = json.dumps(data[section][key])
+                if self._persisted.get((section, key)) != dumped:
+                    updated.append((section, key, dumped))
+            elif (section, key) in self._persisted:
+                removed.append((section, key))
+        return updated, removed
+
+    def _remember_written(self, updated: list[tuple[str, str, str]], removed: list[tuple[str, str]]) -> None:
+        for section, key, dumped in updated:
+            self._persisted[(section, key)] = dumped
+        for section, key in removed:
+            del self._persisted[(section, key)]
+        self._needs_full_write = False
+
+
+# Compact the journal into the snapshot once it holds this many records
+JOURNAL_COMPACT_RECORDS = 5000
+
+
+class JournalStateStore(IncrementalStateStore):
+    """A JSON snapshot plus an append-only journal next to it ({filename}.journal).
+
+    A save only appends a small record for each workflow, instance or global that changed since
+    the last one, and every so often the journal is folded back into the snapshot. Each record
+    carries a sequence number and the snapshot remembers the last one it includes, so a crash
+    between writing the snapshot and truncating the journal cannot replay stale records.
+    """
+
+    def __init__(self, filename: str) -> None:
+        super().__init__(filename)
+        self.journal_filename = f"{filename}.journal"
+        self.compact_records = JOURNAL_COMPACT_RECORDS
+        self._sequence = 0
+        self._journal_records = 0
+
+    def load(self) -> dict | None:
+        try:
+            with open(self.filename, "r") as f:
+                data = json.loads(f.read())
+        except FileNotFoundError:
+            data = None
+        snapshot_sequence = data.pop("journal_sequence", 0) if data else 0
+        self._sequence = snapshot_sequence
+        self._journal_records = 0
+
+        try:
+            with open(self.journal_filename, "rb") as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            lines = []
+        if data is None and not lines:
+            return None
+        if data is None:
+            data = empty_state()
+
+        good_bytes = 0
+        for line in lines:
+            try:
+                if not line.endswith(b"\n"):
+                    raise ValueError("record without its newline")
+                record = json.loads(line)
+            except ValueError:
+                # A torn final record from a crash mid-append - everything before it is good. It is
+                # cut off here, or the next append would carry on from the torn line and be lost with it
+                print(f"Dropping a torn record at byte {good_bytes} of {self.journal_filename}")
+                with open(self.journal_filename, "r+b") as f:
+                    f.truncate(good_bytes)
+                    f.flush()
+                    os.fsync(f.fileno())
+                break
+            good_bytes += len(line)
+            self._journal_records += 1
+            if record["seq"] <= snapshot_sequence:
+                continue
+            self._sequence = record["seq"]
+            section = data.setdefault(record["section"], {})
+            if record["op"] == "put":
+                section[record["key"]] = record["data"]
+            else:
+                section.pop(record["key"], None)
+
+        self._remember_persisted(data)
+        return data
+
+    def write_snapshot(self, data: dict, changed: ChangedKeys | None = None) -> int:
+        updated, removed = self._diff(data, changed)
+        records = []
+        for section, key, dumped in updated:
+            self._sequence += 1
+            records.append(f'{{"seq": {self._sequence}, "op": "put", "section": {json.dumps(section)}, "key": {json.dumps(key)}, "data": {dumped}}}\n')
+        for section, key in removed:
+            self._sequence += 1
+            records.append(json.dumps({"seq": self._sequence, "op": "delete", "section": section, "key": key}) + "\n")
+
+        written_bytes = 0
+        if self._journal_records + len(records) >= self.compact_records or not os.path.exists(self.filename):
+            written_bytes = self.compact(data)
+        elif records:
+            payload = "".join(records).encode()
+            with open(self.journal_filename, "ab") as f:
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            self._journal_records += len(records)
+            written_bytes = len(payload)
+        self._remember_written(updated, removed)
+        return written_bytes
+
+    def compact(self, data: dict) -> int:
+        """Fold everything into a fresh snapshot and start the journal over. Returns the size of the snapshot."""
+        # The journal writes bypass _render_json(), so every object has to be rendered afresh
+        written_bytes = atomic_write_text(self.filename, self._render_json({**data, "journal_sequence": self._sequence}))
+        with open(self.journal_filename, "w") as f:
+            f.flush()
+            os.fsync(f.fileno())
+        self._journal_records = 0
+        return written_bytes
+
+
+class SqliteStateStore(IncrementalStateStore):
+    """One row per workflow, instance and global in an SQLite database (WAL mode).
+
+    Only rows that changed get written, and instances carry their workflow_uuid, state and
+    next_processing_time in indexed columns so they can be looked up without loading everything.
+    The database sits next to the JSON state file with a .sqlite3 extension, and the first time
+    it is opened the JSON state file is imported into it. The first save records that in the meta
+    table, so a database that is emptied later on stays empty.
+    """
+    database_filename: str
+
+    def __init__(self, filename: str) -> None:
+        super().__init__(filename)
+        base, extension = os.path.splitext(filename)
+        self.database_filename = f"{base}.sqlite3" if extension == ".json" else filename
+        self._lock = threading.Lock()
+        # Writes come from the manager's worker threads, and WAL lets readers carry on meanwhile
+        self._connection = sqlite3.connect(self.database_filename, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript("""
+            CREATE TABLE IF NOT EXISTS workflows (uuid TEXT PRIMARY KEY, state TEXT, data TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS instances (
+                uuid TEXT PRIMARY KEY,
+                workflow_uuid TEXT,
+                state TEXT,
+                next_processing_time TEXT,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS instances_by_workflow_and_state ON instances (workflow_uuid, state);
+            CREATE INDEX IF NOT EXISTS instances_by_state_and_due_time ON instances (state, next_processing_time);
+            CREATE TABLE IF NOT EXISTS variables (name TEXT PRIMARY KEY, data TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+        """)
+        self._import_pending = False
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def _is_empty(self) -> bool:
+        return not any(
+            self._connection.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone()
+            for table in ("workflows", "instances", "variables")
+        )
+
+    def _json_imported(self) -> bool:
+        return self._connection.execute("SELECT 1 FROM meta WHERE key = 'json_imported'").fetchone() is not None
+
+    def load(self) -> dict | None:
+        with self._lock:
+            if self._is_empty():
+                if self.database_filename == self.filename or self._json_imported():
+                    return None
+                # A new database - start from the JSON state file if there is one, and have the
+                # first save write every row of it
+                data = JsonStateStore(self.filename).load()
+                self._needs_full_write = data is not None
+                self._import_pending = True
+                return data
+            # Databases from before the meta table have had their import already
+            self._connection.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('json_imported', '1')")
+            data = empty_state()
+            for uuid, row in self._connection.execute("SELECT uuid, data FROM workflows"):
+                data["workflows"][uuid] = json.loads(row)
+            for uuid, row in self._connection.execute("SELECT uuid, data FROM instances"):
+                data["instances"][uuid] = json.loads(row)
+            for name, row in self._connection.execute("SELECT name, data FROM variables"):
+                data["variables"][name] = json.loads(row)
+        self._remember_persisted(data)
+        return data
+
+    def write_snapshot(self, data: dict, changed: ChangedKeys | None = None) -> int:
+        updated, removed = self._diff(data, changed)
+        if not updated and not removed and not self._import_pending:
+            return 0
+        with self._lock:
+            self._connection.execute("BEGIN")
+            try:
+                if self._import_pending:
+                    self._connection.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('json_imported', '1')")
+                for section, key, dumped in updated:
+                    value = data[section][key]
+                    match section:
+                        case "workflows":
+                            self._connection.execute(
+                                "INSERT OR REPLACE INTO workflows (uuid, state, data) VALUES (?, ?, ?)",
+                                (key, value["state"], dumped))
+                        case "instances":
+                            self._connection.execute(
+                                "INSERT OR REPLACE INTO instances (uuid, workflow_uuid, state, next_processing_time, data) VALUES (?, ?, ?, ?, ?)",
+                                (key, value["workflow_uuid"], value["state"], value["next_processing_time"], dumped))
+                        case "variables":
+                            self._connection.execute(
+                                "INSERT OR REPLACE INTO variables (name, data) VALUES (?, ?)",
+                                (key, dumped))
+                for section, key in removed:
+                    key_column = "name" if section == "variables" else "uuid"
+                    self._connection.execute(f"DELETE FROM {section} WHERE {key_column} = ?", (key,))
+                self._connection.execute("COMMIT")
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._import_pending = False
+        self._remember_written(updated, removed)
+        return sum(len(dumped.encode()) for _, _, dumped in updated)
+
+    def query_instances(self, workflow_uuid: str | None = None, state: str | None = None) -> dict[str, dict]:
+        """The saved instances of a workflow and/or in a RunStates name (e.g. "Error"), straight from the indexed columns."""
+        clauses = []
+        params = []
+        if workflow_uuid is not None:
+            clauses.append("workflow_uuid = ?")
+            params.append(workflow_uuid)
+        if state is not None:
+            clauses.append("state = ?")
+            params.append(state)
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._lock:
+            rows = self._connection.execute(f"SELECT uuid, data FROM instances{where}", params).fetchall()
+        return {uuid: json.loads(row) for uuid, row in rows}
+
+
+STATE_BACKENDS: dict[str, type[StateStore]] = {
+    "json": JsonStateStore,
+    "journal": JournalStateStore,
+    "sqlite": SqliteStateStore,
+}
+
+
+def open_state_store(filename: str, backend: str = "json") -> StateStore:
+    if backend not in STATE_BACKENDS:
+        raise ValueError(f"Unknown state backend '{backend}' - expected one of {', '.join(STATE_BACKENDS)}")
+    return STATE_BACKENDS[backend](filename)
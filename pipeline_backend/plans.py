@@ -0,0 +1,144 @@
+# Workflow imports this to compile itself, so commands comes in the module style that tolerates the circular import
+from __future__ import annotations
+from typing import TYPE_CHECKING
+import pipeline_backend.commands as commands
+from pipeline_backend.variables import WorkVariable, VariablePath, String
+
+if TYPE_CHECKING:
+    from .retries import RetryPolicy
+    from .workflows import Workflow, ProcessingStep
+
+# =====================================================================================
+# Compiled Workflows
+# =====================================================================================
+# Everything about a step that does not depend on the instance running it is worked out once
+# per workflow rather than on every step: which command it calls, that the arguments it was
+# given match what the command takes, which of them are literals (already coerced into the
+# type the command wants) and which are VariablePaths to look up at run time, and that the
+# procedures it can jump to exist. A workflow that fails any of that is rejected as a whole
+# before any instance runs it, instead of erroring partway through.
+#
+# Workflow.compiled_plan() caches the result until the workflow changes or another command is
+# registered. Like the change tracking for persistence it only sees procedures being replaced,
+# not a step list being edited in place.
+
+
+class WorkflowCompileError(Exception):
+    """A workflow has a step that can never run."""
+
+
+class CompiledArgument:
+    name: str
+    req_type: type[WorkVariable]|tuple[type[WorkVariable]]
+    # The value from the step, already one of the accepted types. Copied for every call
+    literal: WorkVariable | None
+    # The VariablePath from the step, when the value has to be looked up on the instance
+    path: VariablePath | None
+
+    def __init__(self, name: str, req_type: type[WorkVariable]|tuple[type[WorkVariable]], literal: WorkVariable | None = None, path: VariablePath | None = None) -> None:
+        self.name = name
+        self.req_type = req_type
+        self.literal = literal
+        self.path = path
+
+
+class CompiledStep:
+    source: ProcessingStep
+    command: commands.CommandDescriptor
+    arguments: list[CompiledArgument]
+    # The step's own timeout if it has one, otherwise the command's. None for no timeout
+    timeout_seconds: float | None
+    # The step's own retry policy if it has one, otherwise the command's. None for the runner's default
+    retry_policy: RetryPolicy | None
+
+    def __init__(self, source: ProcessingStep, command: commands.CommandDescriptor, arguments: list[CompiledArgument]) -> None:
+        self.source = source
+        self.command = command
+        self.arguments = arguments
+        timeout_seconds = command.timeout_seconds if source.timeout_seconds is None else source.timeout_seconds
+        self.timeout_seconds = timeout_seconds or None
+        self.retry_policy = source.retry_policy or command.retry_policy
+
+
+class CompiledWorkflow:
+    procedures: dict[str, list[CompiledStep]]
+    # commands.Commands.generation when this was compiled
+    commands_generation: int
+
+    def __init__(self, procedures: dict[str, list[CompiledStep]], commands_generation: int) -> None:
+        self.procedures = procedures
+        self.commands_generation = commands_generation
+
+    def is_current(self) -> bool:
+        return self.commands_generation == commands.Commands.generation
+
+
+def _accepts(req_type: type[WorkVariable]|tuple[type[WorkVariable]], given: WorkVariable) -> bool:
+    """Whether the value can be handed over as is - the same test the ProcedureRunner uses at run time."""
+    if type(req_type) == tuple:
+        return type(given) in req_type
+    return req_type == given.__class__ or req_type == WorkVariable
+
+
+def _coerce(given: WorkVariable, req_type: type[WorkVariable]|tuple[type[WorkVariable]]) -> WorkVariable | None:
+    if type(req_type) == tuple:
+        for req_type2 in req_type:
+            converted_var = given.coerce_into_type(req_type2)
+            if converted_var:
+                return converted_var
+        return None
+    return given.coerce_into_type(req_type)
+
+
+def _type_name(req_type: type[WorkVariable]|tuple[type[WorkVariable]]) -> str:
+    return "|".join(t.__name__ for t in req_type) if isinstance(req_type, tuple) else req_type.__name__
+
+
+def compile_step(workflow: Workflow, step: ProcessingStep) -> CompiledStep:
+    try:
+        command = commands.Commands.get_command_descriptor(step.command_name)
+    except KeyError:
+        raise WorkflowCompileError(f"Unable to find the command {step.command_name}")
+    if len(command.arguments) != len(step.variables):
+        raise WorkflowCompileError(f"Inconsistent number of variables for the command {step.command_name} - we have {len(step.variables)} but the command expects {len(command.arguments)}")
+
+    if step.timeout_seconds and not command.is_coroutine:
+        raise WorkflowCompileError(f"The command {step.command_name} cannot be given a timeout, only async commands can be cancelled")
+    if step.retry_policy and (unknown := step.retry_policy.resolve_exceptions()):
+        raise WorkflowCompileError(f"The retry policy names {', '.join(unknown)}, which is not a builtin or registered exception class")
+
+    arguments = []
+    for arg_name, req_type in command.arguments:
+        if not arg_name in step.variables:
+            raise WorkflowCompileError(f"Unable to find the argument {arg_name} given in the procedure step")
+        given_var = step.variables[arg_name]
+        if _accepts(req_type, given_var):
+            arguments.append(CompiledArgument(arg_name, req_type, literal=given_var))
+        elif given_var.__class__ == VariablePath:
+            arguments.append(CompiledArgument(arg_name, req_type, path=given_var))
+        else:
+            converted_var = _coerce(given_var, req_type)
+            if not converted_var:
+                raise WorkflowCompileError(f"Unable to convert argument {arg_name} from a {given_var.__class__.__name__} to a {_type_name(req_type)}")
+            arguments.append(CompiledArgument(arg_name, req_type, literal=converted_var))
+
+    for argument in arguments:
+        if argument.name in command.procedure_arguments and isinstance(argument.literal, String):
+            if not argument.literal.value in workflow.procedures:
+                raise WorkflowCompileError(f"Cannot jump to the procedure {argument.literal.value} because it does not exist in the workflow")
+    return CompiledStep(step, command, arguments)
+
+
+def compile_workflow(workflow: Workflow) -> CompiledWorkflow:
+    """Resolve every step of every procedure. Raises a WorkflowCompileError naming the first step that cannot run."""
+    commands_generation = commands.Commands.generation
+    procedures = {}
+    for proc_name, steps in workflow.procedures.items():
+        compiled_steps = []
+        for step_idx, step in enumerate(steps):
+            try:
+                compiled_steps.append(compile_step(workflow, step))
+            except WorkflowCompileError as e:
+                raise WorkflowCompileError(f"Step {step_idx} of procedure {proc_name} in the workflow {workflow.name}: {e}") from None
+        procedures[proc_name] = compiled_steps
+    return CompiledWorkflow(procedures, commands_generation)
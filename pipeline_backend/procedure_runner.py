@@ -1,11 +1,99 @@
 import asyncio
+import contextvars
+import os
+import time
 import traceback
-from copy import deepcopy
-from inspect import iscoroutinefunction
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from .commands import *
 from .variables import *
 from .instances import *
 from .workflows import *
+from .plans import CompiledStep, WorkflowCompileError
+from .retries import RetryPolicy, register_exception
+from . import metrics
+
+# How long an instance gets to run before it goes back in the due queue behind whatever else
+# is due, so one instance working through a big list cannot hold up the pollers. Whichever
+# runs out first ends the slice, and 0 turns that limit off. The time is what its steps took,
+# less the longest of them, so a single pause (a garbage collection, the machine being busy)
+# cannot use up a slice by itself - it takes steps that are slow one after another.
+SLICE_MAX_STEPS = int(os.environ.get("WEBAUTOTENDER_SLICE_MAX_STEPS", 1000))
+SLICE_MAX_SECONDS = float(os.environ.get("WEBAUTOTENDER_SLICE_MAX_SECONDS", 0.05))
+
+# The slow calls commands hand to run_blocking() run on these threads, so a slow rmtree on a network
+# mount only holds up the instance that asked for it. Bounded so a burst of them cannot swamp the disk
+BLOCKING_COMMAND_THREADS = int(os.environ.get("WEBAUTOTENDER_BLOCKING_COMMAND_THREADS", 4))
+_blocking_command_executor: ThreadPoolExecutor | None = None
+
+
+def blocking_command_executor() -> ThreadPoolExecutor:
+    global _blocking_command_executor
+    if _blocking_command_executor is None:
+        _blocking_command_executor = ThreadPoolExecutor(max_workers=BLOCKING_COMMAND_THREADS, thread_name_prefix="blocking-command")
+    return _blocking_command_executor
+
+# The command the current step is running, for run_blocking() to charge its time to
+_running_command: contextvars.ContextVar[CommandDescriptor | None] = contextvars.ContextVar("running_command", default=None)
+
+
+async def run_blocking(fn: Callable, *args):
+    """Run fn(*args) on the blocking command threads and return what it returns.
+
+    For an async command whose filesystem or other slow call should not hold up the event loop.
+    Only that call goes to the thread - the instance belongs to the event loop, so setting its
+    variables, logging and jumping are left to the command once this returns."""
+    command = _running_command.get()
+    start = time.perf_counter()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(blocking_command_executor(), fn, *args)
+    finally:
+        if command is not None:
+            command.stats.record(time.perf_counter() - start)
+
+
+# An async command that runs past its timeout is cancelled, and raises CommandTimedOut as far
+# as its retry policy is concerned. Steps whose command has no policy of its own retry just
+# those, COMMAND_TIMEOUT_RETRIES times after the first, before the instance is marked Error.
+COMMAND_TIMEOUT_RETRIES = int(os.environ.get("WEBAUTOTENDER_COMMAND_TIMEOUT_RETRIES", 3))
+COMMAND_TIMEOUT_BACKOFF_SECONDS = float(os.environ.get("WEBAUTOTENDER_COMMAND_TIMEOUT_BACKOFF_SECONDS", 30))
+
+
+@register_exception
+class CommandTimedOut(TimeoutError):
+    """An async command ran past its timeout and was cancelled."""
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy(max_attempts=COMMAND_TIMEOUT_RETRIES + 1, backoff_seconds=COMMAND_TIMEOUT_BACKOFF_SECONDS, retry_on=(CommandTimedOut,))
+
+
+async def _call_with_timeout(command:CommandDescriptor, args:list, timeout_seconds:float|None) -> CommandReturnStatus:
+    deadline = asyncio.timeout(timeout_seconds)
+    try:
+        async with deadline:
+            return await command.fn(*args)
+    except TimeoutError:
+        # The command may raise a TimeoutError of its own, which is just an exception like any other
+        if deadline.expired():
+            raise CommandTimedOut(f"The command {command.name} did not finish within {timeout_seconds} seconds and was cancelled") from None
+        raise
+
+
+def _timed_call(command:CommandDescriptor, args:list) -> CommandReturnStatus:
+    start = time.perf_counter()
+    try:
+        return command.fn(*args)
+    finally:
+        command.stats.record(time.perf_counter() - start)
+
+def update_command_metrics() -> None:
+    for command in Commands.descriptors.values():
+        if command.stats.calls:
+            metrics.command_blocked_seconds_gauge.set(command.stats.total_seconds, command=command.name)
+            metrics.command_blocked_max_seconds_gauge.set(command.stats.max_seconds, command=command.name)
+
+
+metrics.metrics.add_collector(update_command_metrics)
 
 # =====================================================================================
 # Processing Steps
@@ -14,9 +102,10 @@ from .workflows import *
 # A processing step is something that addons can create that let us perform actions.
 # There are some built in processings steps, such as yield_for and yield_until.
 #
-# Important Programmer Note : deepcopy variables that go into the funtion to prevent
+# Important Programmer Note : copy variables that go into the funtion to prevent
 # unintended sideeffects of changing the Constants of the ProcessingStep or values
-# of the Instance variables when just naivly using the values in an addon
+# of the Instance variables when just naivly using the values in an addon. share() is
+# a copy-on-write copy, so this costs nothing unless the command modifies the value
 
 
 class ProcedureRunner:
@@ -34,40 +123,53 @@ class ProcedureRunner:
 
         if not self.workflow:
             return self.__mark_error("No Associated Workflow - This Is An Orphan")
-        # get the command for the current step
+        # get the compiled step - compiling already found the command and checked the arguments given to it
+        try:
+            plan = self.workflow.compiled_plan()
+        except WorkflowCompileError as e:
+            # Held back like on load rather than Error, so it carries on once the workflow is fixed
+            self.workflow.compile_error = str(e)
+            self.instance.log_line(f"Waiting for the workflow to compile - {e}")
+            return CommandReturnStatus.Yield | CommandReturnStatus.Keep_Position
         proc_name,step_idx = self.instance.processing_step
         try:
-            procedure:list[ProcessingStep] = self.workflow.procedures[proc_name]
+            procedure:list[CompiledStep] = plan.procedures[proc_name]
             proc_step = procedure[step_idx]
-            # ProcessingStep has workvariables inside of it that are intended to be passed to the command, so we need to do some simple verification before handing it off to said command
         except KeyError as e:
             return self.__mark_error(f"Error: Unable to find the procedure {proc_name} in the workflow {self.workflow.name} when processing an Instance")
         except IndexError as e:
             return self.__mark_error(f"Error: Unable to get step {step_idx} of procedure {proc_name} in the workflow {self.workflow.name} when processing an Instance. Only {len(procedure)} steps are in that procedure")
-        
-        # Find the command - also guarentees we can find the var to go with it to build the variable list
-        try:
-            command:Callable = Commands.get_command_by_name(proc_step.command_name)
-        except KeyError:
-            return self.__mark_error(f"\nError: Unable to find the command {proc_step.command_name}",True)
+        command = proc_step.command
 
-        # check the vars it needs and resolve references if it is asking for a more concrete type but given a variable name, or error if given an invalid type
+        # resolve references if it is asking for a more concrete type but given a variable name, or error if it cannot be converted
         variables_for_command:list|None = self.build_variables_list_for_command(proc_step)
         if not variables_for_command:
             return CommandReturnStatus.Error
 
         # run command
+        started = time.perf_counter()
+        running = _running_command.set(command)
         try:
-            if iscoroutinefunction(command):
-                command_finish_state:CommandReturnStatus = await command(*variables_for_command)
+            if command.is_coroutine:
+                command_finish_state:CommandReturnStatus = await _call_with_timeout(command, variables_for_command, proc_step.timeout_seconds)
             else:
-                command_finish_state:CommandReturnStatus = command(*variables_for_command)
+                command_finish_state:CommandReturnStatus = _timed_call(command, variables_for_command)
+        except asyncio.CancelledError:
+            # Shutting down and out of patience. The step was not finished so it runs again on the next start
+            self.instance.log_line(f"Cancelled while running the command {command.name}, it will be run again")
+            raise
         except Exception as e:
-            return self.__mark_error(f"{traceback.format_exc()}\nError: Exception thrown by the command {proc_step.command_name} in instance:")
+            metrics.step_duration_histogram.observe(time.perf_counter() - started, command=command.name)
+            return self.__command_raised(proc_step, e)
+        finally:
+            _running_command.reset(running)
+        metrics.step_duration_histogram.observe(time.perf_counter() - started, command=command.name)
+        if self.instance.retry_attempts:
+            self.instance.retry_attempts = 0
 
         # check return state
         if type(command_finish_state) != CommandReturnStatus:
-            return self.__mark_error(f"Error: Command {proc_step.command_name} returned a value that is not a CommandReturnStatus but instead a {type(command_finish_state)}")
+            return self.__mark_error(f"Error: Command {command.name} returned a value that is not a CommandReturnStatus but instead a {type(command_finish_state)}")
         match(command_finish_state):
             case x if CommandReturnStatus.Error in x:
                 self.instance.state = RunStates.Error
@@ -75,17 +177,51 @@ class ProcedureRunner:
                 if not CommandReturnStatus.Keep_Position in command_finish_state:
                     self.instance.processing_step = (proc_name,step_idx+1)
             case _:
-                return self.__mark_error(f"Error: Unknown return state from the command {proc_step.command_name} - {command_finish_state} {type(command_finish_state)}")
+                return self.__mark_error(f"Error: Unknown return state from the command {command.name} - {command_finish_state} {type(command_finish_state)}")
 
         return command_finish_state
     
-    async def run_instance_until_yield(self):
+    async def run_instance_until_yield(self, max_steps:int=None, max_seconds:float=None) -> bool:
+        """Run steps until the instance yields or its slice runs out. Returns False when the slice ran out, leaving the instance due straight away."""
+        max_steps = SLICE_MAX_STEPS if max_steps is None else max_steps
+        max_seconds = SLICE_MAX_SECONDS if max_seconds is None else max_seconds
+        steps = 0
+        busy_seconds = longest_step_seconds = 0.0
+        step_started = time.monotonic()
         while CommandReturnStatus.Success in await self.run_single_step():
+            steps += 1
+            step_seconds = time.monotonic() - step_started
+            busy_seconds += step_seconds
+            longest_step_seconds = max(longest_step_seconds, step_seconds)
+            if (max_steps and steps >= max_steps) or (max_seconds and busy_seconds - longest_step_seconds >= max_seconds):
+                # Due again as of now, so anything that was already waiting goes first
+                self.instance.next_processing_time = datetime.now()
+                return False
             # Sync commands have no suspension point, so a self-looping workflow would
             # spin the event loop forever and lock up the web UI and Ctrl+C.
             await asyncio.sleep(0)
+            step_started = time.monotonic()
+        return True
 
 
+    def __command_raised(self,proc_step:CompiledStep,error:Exception)->CommandReturnStatus:
+        """Try the step again later if its retry policy says so, otherwise mark the instance Error. Call from within the except block."""
+        policy = proc_step.retry_policy or DEFAULT_RETRY_POLICY
+        failed_attempts = self.instance.retry_attempts + 1
+        if not policy.should_retry(error, failed_attempts):
+            metrics.command_failures_counter.inc(command=proc_step.command.name)
+            self.instance.retry_attempts = 0
+            if isinstance(error, CommandTimedOut):
+                return self.__mark_error(f"Error: {error}. Giving up after {failed_attempts} attempt(s)")
+            return self.__mark_error(f"{traceback.format_exc()}\nError: Exception thrown by the command {proc_step.command.name} in instance, giving up after {failed_attempts} attempt(s):")
+        metrics.command_retries_counter.inc(command=proc_step.command.name)
+        backoff = policy.backoff_for(failed_attempts)
+        self.instance.retry_attempts = failed_attempts
+        attempts_left = f" of {policy.max_attempts}" if policy.max_attempts else ""
+        self.instance.log_line(f"Attempt {failed_attempts}{attempts_left} at {proc_step.command.name} failed - {type(error).__name__}: {error}. Trying again in {backoff:.0f} seconds")
+        self.instance.next_processing_time = datetime.now() + timedelta(seconds=backoff)
+        return CommandReturnStatus.Yield | CommandReturnStatus.Keep_Position
+
     def __mark_error(self,message:str="",also_mark_workflow:bool=False)->CommandReturnStatus:
         self.instance.state = RunStates.Error
         if also_mark_workflow:
@@ -98,10 +234,10 @@ class ProcedureRunner:
         # Happy case - already as expected or the function will take anything
         if type(req_type) == tuple:
             if type(given_var) in req_type:
-                return deepcopy(given_var)
+                return given_var.share()
         else:
             if req_type == given_var.__class__ or req_type == WorkVariable:
-                return deepcopy(given_var)
+                return given_var.share()
 
         # Common case of giving a variable name but really we are wanting to pass the value of a variable
         if given_var.__class__ == VariablePath:
@@ -127,22 +263,15 @@ class ProcedureRunner:
             self.__mark_error(f"Error: Unable to convert argument from a {given_var.__class__.__name__} to a {req_type_name} in the procedure step", True)
             return None
 
-    def build_variables_list_for_command(self,proc_step:ProcessingStep) -> list|None:
-        req_vartypes = Commands.get_command_input_variables(proc_step.command_name)
-        if len(req_vartypes) != len(proc_step.variables):
-            self.__mark_error(f"Error: Inconsistent number of variables for the command {proc_step.command_name} - we have {len(proc_step.variables)} but the command expects {len(req_vartypes)}", True)
-            return None
-
+    def build_variables_list_for_command(self,proc_step:CompiledStep) -> list|None:
         variables_for_command: list = [self.instance]
-        for var_name, req_type in req_vartypes:
-            if not var_name in proc_step.variables:
-                self.__mark_error(f"Error: Unable to find the argument {var_name} given in the procedure step", True)
-                return None
-            given_var = proc_step.variables[var_name]
-            conv_var = self.__check_deref_coerce_variable(given_var,req_type)
+        for argument in proc_step.arguments:
+            if argument.path is None:
+                variables_for_command.append(argument.literal.share())
+                continue
+            conv_var = self.__check_deref_coerce_variable(argument.path,argument.req_type)
             if not conv_var:
                 return None
-            else:
-                variables_for_command.append(conv_var)
+            variables_for_command.append(conv_var)
 
         return variables_for_command
@@ -0,0 +1,120 @@
+from __future__ import annotations
+import builtins
+import random
+
+# =====================================================================================
+# Retry Policies
+# =====================================================================================
+# When a command raises, the ProcedureRunner asks the step's RetryPolicy (or else its
+# command's) whether to try again. A retry leaves the instance on the same step and due again
+# after a backoff that grows by multiplier with every attempt, up to max_backoff_seconds.
+# The backoff is spread by +/- jitter of itself, so the instances that all failed together
+# when a server went down do not all come back to it in the same second.
+#
+# How many attempts have failed so far is kept on the Instance, and saved with it, so a
+# restart does not reset the count.
+#
+# A policy is saved with its ProcessingStep, so exception classes are kept by name -
+# "OSError", or "module.Class" for those outside of builtins. Saved state is not trusted to
+# import anything, so a name only loads as a builtin exception or one that was registered with
+# register_exception (the classes of a command's own policy are registered with the command).
+# Any other name is kept on the policy as unknown, which stops its workflow compiling.
+
+
+class RetryPolicy:
+    # Attempts in all, the first one included. 0 to keep retrying for as long as it takes
+    max_attempts: int
+    # The wait before the first retry
+    backoff_seconds: float
+    multiplier: float
+    max_backoff_seconds: float
+    # How far either way each wait is spread, as a fraction of it
+    jitter: float
+    # An exception that is one of these is retried, anything else marks the instance Error
+    retry_on: tuple[type[BaseException], ...]
+    # Names in retry_on when it was loaded that are neither builtin nor registered exceptions
+    unknown_exceptions: tuple[str, ...]
+
+    def __init__(self, max_attempts: int = 5, backoff_seconds: float = 30.0, multiplier: float = 2.0,
+                 max_backoff_seconds: float = 3600.0, jitter: float = 0.2,
+                 retry_on: tuple[type[BaseException], ...] = (OSError,)) -> None:
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.multiplier = multiplier
+        self.max_backoff_seconds = max_backoff_seconds
+        self.jitter = jitter
+        self.retry_on = tuple(retry_on)
+        self.unknown_exceptions = ()
+
+    def __repr__(self) -> str:
+        return f"RetryPolicy({self.json_savable()})"
+
+    def should_retry(self, error: BaseException, failed_attempts: int) -> bool:
+        """Whether to try again after failed_attempts attempts have failed, the latest with error."""
+        if not isinstance(error, self.retry_on):
+            return False
+        return not self.max_attempts or failed_attempts < self.max_attempts
+
+    def backoff_for(self, failed_attempts: int) -> float:
+        """Seconds to wait before the next attempt, after failed_attempts of them have failed."""
+        backoff = min(self.max_backoff_seconds, self.backoff_seconds * self.multiplier ** (failed_attempts - 1))
+        if self.jitter:
+            backoff *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        return max(0.0, backoff)
+
+    def json_savable(self) -> dict:
+        return {
+            'max_attempts': self.max_attempts,
+            'backoff_seconds': self.backoff_seconds,
+            'multiplier': self.multiplier,
+            'max_backoff_seconds': self.max_backoff_seconds,
+            'jitter': self.jitter,
+            'retry_on': [_exception_name(cls) for cls in self.retry_on] + list(self.unknown_exceptions),
+        }
+
+    @staticmethod
+    def from_json(data: dict) -> RetryPolicy:
+        policy = RetryPolicy()
+        for name in ('max_attempts', 'backoff_seconds', 'multiplier', 'max_backoff_seconds', 'jitter'):
+            if name in data:
+                setattr(policy, name, data[name])
+        if 'retry_on' in data:
+            policy.retry_on = ()
+            policy.unknown_exceptions = tuple(data['retry_on'])
+            policy.resolve_exceptions()
+        return policy
+
+    def resolve_exceptions(self) -> tuple[str, ...]:
+        """Look the unknown exception names up again, as they may have been registered since. Returns those still unknown."""
+        unknown = []
+        for name in self.unknown_exceptions:
+            cls = _exception_class(name)
+            if cls is None:
+                unknown.append(name)
+            elif cls not in self.retry_on:
+                self.retry_on += (cls,)
+        self.unknown_exceptions = tuple(unknown)
+        return self.unknown_exceptions
+
+
+# Exception classes outside of builtins that a saved policy may name, by that name
+_registered_exceptions: dict[str, type[BaseException]] = {}
+
+
+def register_exception(cls: type[BaseException]) -> type[BaseException]:
+    """Let a saved retry policy name cls. Returns cls, so it can decorate an exception class."""
+    _registered_exceptions[_exception_name(cls)] = cls
+    return cls
+
+
+def _exception_name(cls: type[BaseException]) -> str:
+    if cls.__module__ == "builtins":
+        return cls.__qualname__
+    return f"{cls.__module__}.{cls.__qualname__}"
+
+
+def _exception_class(name: str) -> type[BaseException] | None:
+    cls = _registered_exceptions.get(name) if "." in name else getattr(builtins, name, None)
+    if not isinstance(cls, type) or not issubclass(cls, BaseException):
+        return None
+    return cls
@@ -0,0 +1,109 @@
+from __future__ import annotations
+from datetime import datetime
+import heapq
+from collections.abc import Callable, Container
+from itertools import count
+from typing import TYPE_CHECKING
+from .changes import TrackedDict
+
+if TYPE_CHECKING:
+    from .instances import Instance
+
+# =====================================================================================
+# Due Time Scheduling
+# =====================================================================================
+# Almost every instance spends almost all of its life asleep until its next_processing_time,
+# so rather than scanning every instance on every wakeup we keep them in a min-heap keyed on
+# that time. Instances push themselves back in whenever their due time or run state changes.
+#
+# Entries are never removed from the middle of the heap. Instead every push bumps a per uuid
+# sequence number, and an entry is thrown away when it reaches the top if it is no longer the
+# newest one for that instance, or the instance cannot run anymore. A paused or errored
+# instance is pushed back in when it is set to Running again, so dropping it costs nothing.
+
+# Heap entries for instances that have no due time sort first, so the next pass finds them
+# and past_time_to_run() can flag them as an Error
+_NO_DUE_TIME = datetime.min
+
+
+class DueQueue:
+    instances: dict[str, Instance]
+
+    def __init__(self, instances: dict[str, Instance]) -> None:
+        self.instances = instances
+        self._heap: list[tuple[datetime, int, str, Instance]] = []
+        self._latest: dict[str, int] = {}
+        self._sequence = count()
+
+    def __len__(self) -> int:
+        return len(self._latest)
+
+    def push(self, instance: Instance) -> None:
+        """(Re)schedule an instance at its current next_processing_time. Ignored for instances that are not registered in the pipeline."""
+        if self.instances.get(instance.uuid) is not instance:
+            return
+        seq = next(self._sequence)
+        self._latest[instance.uuid] = seq
+        heapq.heappush(self._heap, (instance.next_processing_time or _NO_DUE_TIME, seq, instance.uuid, instance))
+        # Every reschedule leaves a stale entry behind, so rebuild once they outnumber the live ones
+        if len(self._heap) > 2 * len(self._latest) + 64:
+            self._compact()
+
+    def push_all(self, instances) -> None:
+        for instance in instances:
+            self.push(instance)
+
+    def _is_live(self, entry: tuple[datetime, int, str, Instance]) -> bool:
+        _, seq, uuid, instance = entry
+        return self._latest.get(uuid) == seq and self.instances.get(uuid) is instance and instance.is_allowed_to_run()
+
+    def _discard_top(self) -> None:
+        _, seq, uuid, _ = heapq.heappop(self._heap)
+        if self._latest.get(uuid) == seq:
+            del self._latest[uuid]
+
+    def _compact(self) -> None:
+        self._heap = [entry for entry in self._heap if self._is_live(entry)]
+        heapq.heapify(self._heap)
+        self._latest = {uuid: seq for _, seq, uuid, _ in self._heap}
+
+    def peek_next_due_time(self, skip: Container[str] = ()) -> datetime | None:
+        """The soonest due time of any runnable instance, ignoring the uuids in skip. An instance with no due time gives datetime.min."""
+        while self._heap:
+            entry = self._heap[0]
+            # An instance that is currently running gets pushed again once it yields
+            if self._is_live(entry) and entry[2] not in skip:
+                return entry[0]
+            self._discard_top()
+        return None
+
+    def count_due(self, current_time: datetime, skip: Container[str] = ()) -> int:
+        """How many runnable instances are due, ignoring the uuids in skip.
+
+        Only for the metrics collector, which calls it when the metrics are scraped. Which entries
+        are due changes with the clock rather than with pushes, so there is no count to keep up to
+        date and this walks the whole heap - keep it off the scheduling path."""
+        return sum(1 for entry in self._heap if entry[0] < current_time and entry[2] not in skip and self._is_live(entry))
+
+    def pop_due(self, current_time: datetime, skip: Container[str] = ()) -> Instance | None:
+        """Remove and return the next runnable instance whose due time has passed, or None when nothing is due yet."""
+        next_due_time = self.peek_next_due_time(skip)
+        if next_due_time is None or next_due_time >= current_time:
+            return None
+        _, _, uuid, instance = heapq.heappop(self._heap)
+        del self._latest[uuid]
+        return instance
+
+
+class InstanceRegistry(TrackedDict):
+    """The uuid -> Instance mapping of a PipelineContext. Registering an instance schedules it."""
+    due_queue: DueQueue
+
+    def __init__(self, on_change: Callable[[str], None]) -> None:
+        super().__init__(on_change)
+        self.due_queue = DueQueue(self)
+
+    def __setitem__(self, uuid: str, instance: Instance) -> None:
+        super().__setitem__(uuid, instance)
+        self.due_queue.push(instance)
+
@@ -19,13 +19,112 @@ from copy import deepcopy
 # information added to the constructor
 #
 # Tech Explination Ramblings:
-# Class.__subclasses__() is a dynamically created list of subclasses.
-# All an addon would have to do is subclass the WorkVariable class and it will just magically get registered already!
+# __init_subclass__ runs for every subclass as it is created, however deep in the tree.
+# All an addon would have to do is subclass the WorkVariable class (or any of its subclasses) and it will just magically get registered already!
 # You can also just grab the human readable name with __name__ to then reference back and forth.
 # And to round it off, you can *force* a class change with self.__class__ = OtherClass and if it is in the heritable tree, it will be cast!
+#
+# A big feed or torrent file list is a tree of many thousands of tiny variables, so they are
+# slotted rather than each carrying a __dict__. Casting with __class__ only works between
+# classes with the same memory layout though, so no subclass may add slots of its own - the
+# metaclass gives every subclass an empty __slots__, addon types included, and refuses any
+# that asks for more.
+
+# =====================================================================================
+# Copy On Write
+# =====================================================================================
+# Commands must never be able to change a workflow constant or an instance variable by
+# editing the value they were handed, but deep copying a 5000 entry VariableList for every
+# argument and lookup is far too slow. So copies are made lazily instead: share() (and
+# copy/deepcopy) hand back a twin that points at the same value, with both flagged as shared.
+# Whichever of them next reads .value takes its own shallow copy first, sharing the
+# WorkVariables inside it the same way, so a value is only ever copied as deep as it is
+# actually touched.
+#
+# Everything in here reads _value directly when it will not modify it, so that serializing
+# or printing a shared value does not copy it. The one thing sharing cannot protect against
+# is holding on to a .value from before the share() and editing it afterwards.
+
+# Values that can never be edited in place, so there is nothing to copy
+_IMMUTABLE_TYPES = (str, int, float, bool, type(None), tuple, bytes)
+
+
+def _copy_item(item: Any) -> Any:
+    if isinstance(item, WorkVariable):
+        return item.share()
+    if type(item) in _IMMUTABLE_TYPES:
+        return item
+    return deepcopy(item)
+
+
+class WorkVariableType(type):
+    def __new__(mcls, name: str, bases: tuple, namespace: dict, **kwargs):
+        if any(isinstance(base, WorkVariableType) for base in bases):
+            slots = namespace.setdefault("__slots__", ())
+            if tuple(slots):
+                raise TypeError(f"The WorkVariable type {name} cannot declare __slots__ - every WorkVariable type has to share one layout so they can be cast into each other")
+        return super().__new__(mcls, name, bases, namespace, **kwargs)
+
+
+class WorkVariable(metaclass=WorkVariableType):
+    __slots__ = ("_value", "_shared")
+    _value:Any|Self
+    _shared:bool
+    # Every subclass by its __name__, so deserializing a value is one dict lookup
+    _types_by_name:dict[str,type[Self]] = {}
+
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        existing = WorkVariable._types_by_name.get(cls.__name__)
+        if existing is not None and existing.__module__ != cls.__module__:
+            print(f"The WorkVariable type {cls.__name__} from {cls.__module__} replaces the one from {existing.__module__}")
+        WorkVariable._types_by_name[cls.__name__] = cls
+
+    @property
+    def value(self) -> Any|Self:
+        if self._shared:
+            self._unshare()
+        return self._value
+
+    @value.setter
+    def value(self, value: Any|Self) -> None:
+        self._value = value
+        self._shared = False
+
+    def _unshare(self) -> None:
+        value = self._value
+        if type(value) == list:
+            value = [_copy_item(item) for item in value]
+        elif type(value) == dict:
+            value = {key: _copy_item(item) for key, item in value.items()}
+        else:
+            value = _copy_item(value)
+        self._value = value
+        self._shared = False
+
+    def _share_value_of(self, other: "WorkVariable") -> None:
+        self._value = other._value
+        if type(other._value) in _IMMUTABLE_TYPES:
+            self._shared = False
+        else:
+            self._shared = other._shared = True
+
+    def share(self) -> Self:
+        """A copy in O(1) - see Copy On Write above. This is what copy() and deepcopy() give too."""
+        twin = self.__class__.__new__(self.__class__)
+        twin._share_value_of(self)
+        return twin
+
+    def __copy__(self) -> Self:
+        return self.share()
+
+    def __deepcopy__(self, memo) -> Self:
+        return self.share()
+
+    def read_value(self) -> Any|Self:
+        """The value without taking a private copy of a shared one. Only for reading - never modify what this returns."""
+        return self._value
 
-class WorkVariable:
-    value:Any|Self
     @property
     def typename(self)->str:
         return self.__class__.__name__
@@ -36,16 +135,21 @@ class WorkVariable:
 
     @staticmethod
     def class_from_name(typename: str) -> type:
-        for cls in WorkVariable.__subclasses__():
-            if cls.__name__ == typename:
-                return cls
-        raise TypeError(f"Unable to find a WorkVariable type to cast into with the name {typename}")
+        try:
+            return WorkVariable._types_by_name[typename]
+        except KeyError:
+            raise TypeError(f"Unable to find a WorkVariable type to cast into with the name {typename}") from None
+
+    @staticmethod
+    def type_names() -> list[str]:
+        """The names of every WorkVariable type, in the order they were defined."""
+        return list(WorkVariable._types_by_name)
 
     def __init__(self, value: Self | None = None):
         # Copy constructor or encapsulation type promotion
         # the subclasses implement their own inits to add in type information for easier linting when using the variables
         if type(value) == self.__class__:
-            self.value = deepcopy(value.value)
+            self._share_value_of(value)
         else:
             self.value = deepcopy(value)
 
@@ -60,10 +164,10 @@ class WorkVariable:
         self.value = None
 
     def __str__(self)->str:
-        return f"{self.__class__.__name__}({self.value})"
+        return f"{self.__class__.__name__}({self._value})"
     
     def json_savable(self)->dict:
-        return {'value':self.value,'typename':self.typename}
+        return {'value':self._value,'typename':self.typename}
     def json_loadable(self,data:dict)->None:
         self.value = data['value']
         self.typename = data['typename']
@@ -71,7 +175,7 @@ class WorkVariable:
 
     def coerce_into_type(self,new_type:type[Self])->Self|None:
         """Makes a copy of itself and attempt to coerce it into the new_type. Will return None if unsucsessful."""
-        converted_var = deepcopy(self)
+        converted_var = self.share()
         converted_var.__class__ = new_type
         try:
             converted_var.normalize()
@@ -86,10 +190,10 @@ class WorkVariable:
         Converts recursivly the value of the WorkVaraible to be a base python type.
         Some types are simple and jsut need to return their value, but others like lists need to do some extra work.
         """
-        if issubclass(self.value.__class__,WorkVariable):
-            return self.value.convert_to_python_type()
+        if issubclass(self._value.__class__,WorkVariable):
+            return self._value.convert_to_python_type()
         else:
-            return deepcopy(self.value)
+            return deepcopy(self._value)
 
 class String(WorkVariable):
     value:str
@@ -204,12 +308,12 @@ class VariableList(WorkVariable):
 
     def json_savable(self) -> dict:
         simplified_value = []
-        for value in self.value:
+        for value in self._value:
             simplified_value.append(value.json_savable())
         return {'value': simplified_value, 'typename': self.typename}
 
     def convert_to_python_type(self)->list[Any]:
-        return [var.convert_to_python_type() for var in self.value]
+        return [var.convert_to_python_type() for var in self._value]
 
 class Boolean(WorkVariable):
     value:bool
@@ -307,10 +411,10 @@ class Dictionary(WorkVariable):
         self.value = {}
     def json_savable(self) -> dict:
         simplified_value = {}
-        for key,value in self.value.items():
+        for key,value in self._value.items():
             simplified_value[key] = value.json_savable()
         return {'value': simplified_value, 'typename': self.typename}
 
     def convert_to_python_type(self)->dict[str,Any]:
-        return {name:var.convert_to_python_type() for name,var in self.value.items()}
+        return {name:var.convert_to_python_type() for name,var in self._value.items()}
 
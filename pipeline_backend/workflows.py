@@ -5,6 +5,9 @@ from copy import deepcopy,copy
 from uuid import uuid4
 import pipeline_backend.variables as variables
 import pipeline_backend.instances as instances
+import pipeline_backend.plans as plans
+from pipeline_backend.retries import RetryPolicy
+from pipeline_backend.changes import TrackedDict
 from pipeline_backend.context import PipelineContext
 
 
@@ -16,11 +19,17 @@ class RunStates(Enum):
 class ProcessingStep:
     command_name: str
     variables: dict[str, variables.WorkVariable]
+    # Overrides the command's own timeout_seconds for this step. None to use the command's, 0 for no timeout
+    timeout_seconds: float | None
+    # Overrides the command's own retry_policy for this step. None to use the command's
+    retry_policy: RetryPolicy | None
     def __init__(self,command_name:str="",**kwargs)->None:
         self.command_name = command_name
         for vals in kwargs.values():
             assert(issubclass(vals.__class__,variables.WorkVariable))
         self.variables = kwargs
+        self.timeout_seconds = None
+        self.retry_policy = None
     def __str__(self) -> str:
         return f"ProcessingStep - {self.command_name} - {len(self.variables)} variables"
     def __repr__(self)->str:
@@ -36,10 +45,17 @@ class ProcessingStep:
         }
         for var_name in self.variables:
             data['variables'][var_name] = self.variables[var_name].json_savable()
+        # Left out unless set, so steps that do not override it save as they always have
+        if self.timeout_seconds is not None:
+            data['timeout_seconds'] = self.timeout_seconds
+        if self.retry_policy is not None:
+            data['retry_policy'] = self.retry_policy.json_savable()
         return data
 
     def json_loadable(self, data: dict) -> None:
         self.command_name = data['command_name']
+        self.timeout_seconds = data.get('timeout_seconds')
+        self.retry_policy = RetryPolicy.from_json(data['retry_policy']) if 'retry_policy' in data else None
         for var_name in data['variables']:
             var = variables.WorkVariable()
             var.json_loadable(data['variables'][var_name])
@@ -55,22 +71,87 @@ class Workflow:
 
     # On startup and on set from the web UI, we will revalidate that everything looks correct
     # If something looks incorrect, we will mark it as invalid and skip processing
-    state: RunStates
+    _state: RunStates
+    # The procedures compiled for the ProcedureRunner, or None until they are next needed
+    _plan: plans.CompiledWorkflow | None
+    # Why the procedures did not compile when last checked, which holds back the instances. Not
+    # saved, so a workflow left behind by an addon that failed to load runs again once it loads
+    compile_error: str | None
 
     # A free space for a user to leave notes for whatever reason. Probably a description of the workflow and reminder of how it works.
     user_notes: str
 
+    # How many of this workflow's instances may run at once, on top of the limit for the whole pipeline. 0 for no limit
+    max_running_instances: int
+
     ctx: PipelineContext
 
+    # Setting any of these marks the workflow as needing to be saved, and the dicts among them
+    # get wrapped so that adding or removing an entry does too
+    _SAVED_ATTRIBUTES = frozenset({"name", "uuid", "constants", "setup_variables", "procedures", "_state", "user_notes", "max_running_instances"})
+    _TRACKED_DICTS = frozenset({"constants", "setup_variables", "procedures"})
+
     def __init__(self, ctx: PipelineContext) -> None:
         self.ctx = ctx
-        self.name = ""
+        self._plan = None
+        self.compile_error = None
         self.uuid = ""
+        self.name = ""
         self.constants = {}
         self.setup_variables = {}
         self.procedures = {"start": []}
-        self.state = RunStates.Running
+        self._state = RunStates.Running
         self.user_notes = ""
+        self.max_running_instances = 0
+
+    def __setattr__(self, name: str, value) -> None:
+        if name in self._TRACKED_DICTS and not isinstance(value, TrackedDict):
+            value = TrackedDict(self._mark_changed, value)
+        super().__setattr__(name, value)
+        if name in self._SAVED_ATTRIBUTES:
+            self._mark_changed()
+
+    def __setstate__(self, state: dict) -> None:
+        # deepcopy() hands back the dicts as plain dicts, so wrap them again
+        self.__dict__.update(state)
+        self._plan = None
+        for name in self._TRACKED_DICTS:
+            super().__setattr__(name, TrackedDict(self._mark_changed, state[name]))
+
+    def _mark_changed(self, _key=None) -> None:
+        """Tell the persistence layer this workflow needs saving."""
+        # Whatever changed may well be the procedures, so compile them again when next needed
+        self._plan = None
+        if self.ctx.workflows.get(self.uuid) is self:
+            self.ctx.changes.mark_workflow(self.uuid)
+
+    @property
+    def state(self) -> RunStates:
+        return self._state
+
+    @state.setter
+    def state(self, state: RunStates) -> None:
+        resumed = state == RunStates.Running and self._state != RunStates.Running
+        self._state = state
+        # Instances of a workflow that cannot run fall out of the due queue, so put them back on resume
+        if resumed and self.ctx.workflows.get(self.uuid) is self:
+            self.ctx.due_queue.push_all(self.get_instances())
+
+    def compiled_plan(self) -> plans.CompiledWorkflow:
+        """The procedures compiled for running. Raises a plans.WorkflowCompileError if any step cannot run."""
+        if self._plan is None or not self._plan.is_current():
+            self._plan = plans.compile_workflow(self)
+        return self._plan
+
+    def compile(self) -> bool:
+        """Check every step can run, setting compile_error when one cannot. Returns whether it compiled."""
+        try:
+            self.compiled_plan()
+        except plans.WorkflowCompileError as e:
+            self.compile_error = str(e)
+            return False
+        self.compile_error = None
+        return True
 
     def spawn_instance(self, setup_var_non_defaults: dict[str, variables.WorkVariable] = {}) -> instances.Instance:
         """Create a new Instance with some variables. The setup variables are optional, and if not everything is specified, will be filled with defaults as setup in the workflow. Can also be used to shadow values that are constants in the parent workflow."""
@@ -111,6 +192,7 @@ class Workflow:
             'state': copy(self.state.name),
             'uuid': copy(self.uuid),
             'user_notes': copy(self.user_notes),
+            'max_running_instances': self.max_running_instances,
             'constants':       {name:v.json_savable() for name,v in self.constants.items()},
             'setup_variables': {name:v.json_savable() for name,v in self.setup_variables.items()},
             'procedures':      {name:[step.json_savable() for step in proc] for name,proc in self.procedures.items()}
@@ -121,6 +203,7 @@ class Workflow:
         self.uuid = data['uuid']
         self.state = RunStates[data['state']]
         self.user_notes = data['user_notes']
+        self.max_running_instances = data.get('max_running_instances', 0)
         for var_name in data['constants']:
             var = variables.WorkVariable()
             var.json_loadable(data['constants'][var_name])
@@ -0,0 +1,111 @@
+"""Tests for the change tracking that tells persistence which objects need saving."""
+from copy import deepcopy
+
+from pipeline_backend.changes import ChangeTracker, TrackedDict
+from pipeline_backend.workflows import Workflow, RunStates, ProcessingStep
+from pipeline_backend.instances import Instance
+from pipeline_backend.variables import String, Integer
+
+
+# ---------------------------------------------------------------------------
+# Helpers
+# ---------------------------------------------------------------------------
+
+def make_workflow(mgr, uuid="wf-1", name="Changes"):
+    wf = Workflow(mgr.ctx)
+    wf.uuid = uuid
+    wf.name = name
+    mgr.ctx.workflows[uuid] = wf
+    return wf
+
+
+# ---------------------------------------------------------------------------
+# TrackedDict / ChangeTracker
+# ---------------------------------------------------------------------------
+
+class TestTrackedDict:
+    def test_every_mutation_reports_its_key(self):
+        seen = []
+        d = TrackedDict(seen.append, {"a": 1})
+        d["b"] = 2
+        del d["a"]
+        d.pop("b")
+        d.pop("missing", None)
+        d.update(c=3)
+        d.setdefault("d", 4)
+        d |= {"e": 5}
+        d.clear()
+        assert seen == ["b", "a", "b", "c", "d", "e", "c", "d", "e"]
+
+    def test_copies_are_plain_dicts(self):
+        d = TrackedDict(lambda key: None, {"a": [1]})
+        copied = deepcopy(d)
+        assert type(copied) is dict and copied == {"a": [1]}
+        assert copied["a"] is not d["a"]
+
+    def test_take_hands_over_and_resets(self):
+        tracker = ChangeTracker()
+        tracker.mark_instance("i-1")
+        taken = tracker.take()
+        assert taken["instances"] == {"i-1"}
+        assert not tracker
+        tracker.restore(taken)
+        assert tracker.instances == {"i-1"}
+
+
+# ---------------------------------------------------------------------------
+# What marks an object as changed
+# ---------------------------------------------------------------------------
+
+class TestInstanceChanges:
+    def test_registering_marks_the_instance(self, mgr):
+        inst = make_workflow(mgr).spawn_instance()
+        assert inst.uuid in mgr.ctx.changes.instances
+
+    def test_saved_attributes_mark_the_instance(self, mgr):
+        inst = make_workflow(mgr).spawn_instance()
+        for change in (
+            lambda: setattr(inst, "processing_step", ("start", 1)),
+            lambda: setattr(inst, "state", RunStates.Paused),
+            lambda: inst.log_line("hello"),
+            lambda: inst.__setitem__("counter", Integer(1)),
+            lambda: inst.__delitem__("counter"),
+        ):
+            mgr.ctx.changes.take()
+            change()
+            assert mgr.ctx.changes.instances == {inst.uuid}
+
+    def test_unregistered_instances_are_not_marked(self, mgr):
+        make_workflow(mgr)
+        inst = Instance(mgr.ctx)
+        inst.uuid = "loose"
+        inst.workflow_uuid = "wf-1"
+        inst["counter"] = Integer(1)
+        assert "loose" not in mgr.ctx.changes.instances
+
+
+class TestWorkflowChanges:
+    def test_saved_attributes_mark_the_workflow(self, mgr):
+        wf = make_workflow(mgr)
+        for change in (
+            lambda: setattr(wf, "name", "Renamed"),
+            lambda: setattr(wf, "state", RunStates.Paused),
+            lambda: wf.constants.__setitem__("limit", Integer(3)),
+            lambda: wf.setup_variables.__setitem__("name", String("x")),
+            lambda: wf.procedures.__setitem__("start", [ProcessingStep("log", msg=String("hi"))]),
+        ):
+            mgr.ctx.changes.take()
+            change()
+            assert mgr.ctx.changes.workflows == {"wf-1"}
+
+    def test_deep_copied_workflow_still_tracks_its_dicts(self, mgr):
+        wf = deepcopy(make_workflow(mgr))
+        wf.ctx = mgr.ctx
+        mgr.ctx.workflows["wf-1"] = wf
+        mgr.ctx.changes.take()
+        wf.constants["limit"] = Integer(3)
+        assert mgr.ctx.changes.workflows == {"wf-1"}
+
+    def test_globals_are_marked(self, mgr):
+        mgr.ctx.variables["shared"] = Integer(1)
+        assert mgr.ctx.changes.variables == {"shared"}
@@ -365,3 +365,40 @@ class TestRegex:
         result = asyncio.run(str_regex_matchAll(instance, String(r"\d+"), String("no digits"), VariablePath("out")))
         assert result == CommandReturnStatus.Success
         assert instance.variables["out"].value == []
+
+
+class TestCommandDescriptors:
+    def test_arguments_are_parsed_at_registration(self):
+        from pipeline_backend.commands import Commands
+        descriptor = Commands.get_command_descriptor("log")
+        assert descriptor.arguments == [("msg", String)]
+        assert descriptor.is_coroutine is False
+        assert descriptor.category == Commands.categories["log"]
+        assert descriptor.doc == log.__doc__
+
+    def test_lookups_do_not_reparse_the_signature(self):
+        from unittest.mock import patch
+        from pipeline_backend.commands import Commands
+        with patch("pipeline_backend.commands.signature") as mock_signature:
+            Commands.get_command_input_variables("math_add")
+            Commands.json_savable_all_commands_with_args()
+        mock_signature.assert_not_called()
+
+    def test_json_savable_is_a_copy(self):
+        from pipeline_backend.commands import Commands
+        info = Commands.json_savable_command_information("log")
+        info["arguments"].clear()
+        assert Commands.json_savable_command_information("log")["arguments"] == {"msg": "String"}
+
+    def test_unknown_command_raises(self):
+        from pipeline_backend.commands import Commands
+        with pytest.raises(KeyError):
+            Commands.get_command_descriptor("no_such_command")
+
+    def test_sync_command_cannot_have_a_timeout(self):
+        from pipeline_backend.commands import Commands
+        with pytest.raises(TypeError, match="timeout"):
+            @Commands.register_command(category="Test", timeout_seconds=5)
+            def descriptor_test_sync_timeout(instance: Instance) -> CommandReturnStatus:
+                return CommandReturnStatus.Success
+        assert "descriptor_test_sync_timeout" not in Commands.commands
@@ -0,0 +1,81 @@
+"""Tests for running the pure part of CPU heavy commands in worker processes."""
+import hashlib
+import os
+import sys
+import pytest
+
+import pipeline_backend.cpu_pool as cpu_pool
+from builtin_addons import rssfeed, rtorrent
+from pipeline_backend.manager import PipelineManager
+from pipeline_backend.cpu_pool import cpu_bound
+from pipeline_backend.variables import Dictionary, Integer, String, StringList
+
+
+@cpu_bound
+def _whereabouts(tag: String, count: int) -> Dictionary:
+    return Dictionary({"pid": Integer(os.getpid()), "tag": String(tag.value * count)})
+
+
+@cpu_bound
+def _fails() -> None:
+    raise ValueError("bad input")
+
+
+@pytest.fixture(autouse=True)
+def fresh_pool():
+    yield
+    cpu_pool.shutdown_cpu_pool()
+
+
+class TestCpuBound:
+    async def test_runs_in_another_process(self):
+        result = await _whereabouts(String("ab"), 2)
+        assert type(result) == Dictionary
+        assert result.value["tag"].value == "abab"
+        assert result.value["pid"].value != os.getpid()
+
+    async def test_exceptions_come_back(self):
+        with pytest.raises(ValueError, match="bad input"):
+            await _fails()
+
+    async def test_runs_in_a_thread_without_processes(self, monkeypatch):
+        monkeypatch.setattr(cpu_pool, "CPU_BOUND_PROCESSES", 0)
+        result = await _whereabouts(String("x"), 3)
+        assert result.value["pid"].value == os.getpid()
+        assert result.value["tag"].value == "xxx"
+
+    def test_payloads_are_json_savable_forms(self):
+        payload = cpu_pool._encode(StringList(["a", "b"]))
+        assert payload == ("WorkVariable", StringList(["a", "b"]).json_savable())
+        decoded = cpu_pool._decode(payload)
+        assert type(decoded) == StringList and decoded.value == ["a", "b"]
+        assert cpu_pool._decode(cpu_pool._encode(b"raw")) == b"raw"
+
+
+class TestAddonsUseThePool:
+    async def test_infohash_of_torrent_bytes(self):
+        info = b"d4:name4:test12:piece lengthi16384ee"
+        torrent = b"d8:announce3:url4:info" + info + b"e"
+        assert await rtorrent._infohash_from_torrent_bytes(torrent) == hashlib.sha1(info).hexdigest().upper()
+
+    async def test_addon_loaded_from_its_folder(self, tmp_path):
+        addon = tmp_path / "pooled_addon"
+        addon.mkdir()
+        (addon / "__init__.py").write_text(
+            "import os\n"
+            "from pipeline_backend.cpu_pool import cpu_bound\n"
+            "@cpu_bound\n"
+            "def worker_pid() -> int:\n"
+            "    return os.getpid()\n")
+        module = PipelineManager().import_addon(addon)
+        try:
+            assert await module.worker_pid() != os.getpid()
+        finally:
+            sys.modules.pop(module.__name__, None)
+
+    async def test_feed_parsed_from_bytes(self):
+        feed = (b'<?xml version="1.0"?><rss version="2.0"><channel><title>t</title>'
+                b'<item><title>First</title><link>https://example.com/1</link></item></channel></rss>')
+        entries = await rssfeed._parse_feed_entries(feed)
+        assert entries[0]["title"] == "First"
+        assert entries[0]["link"] == "https://example.com/1"
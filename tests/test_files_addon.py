@@ -1,8 +1,9 @@
 import pytest
 import os
-from pipeline_backend.commands import CommandReturnStatus
+from pipeline_backend.commands import Commands, CommandReturnStatus
 from pipeline_backend.commands_builtin import list_pop_next
-from pipeline_backend.workflows import Workflow, RunStates
+from pipeline_backend.workflows import Workflow, RunStates, ProcessingStep
+from pipeline_backend.procedure_runner import ProcedureRunner
 from pipeline_backend.variables import String, StringList, VariablePath, Boolean
 from pipeline_backend.manager import PipelineManager
 
@@ -30,31 +31,49 @@ def instance(workflow):
     return workflow.spawn_instance()
 
 
+# ============================================================
+# Running through the runner
+# ============================================================
+
+class TestRunByTheRunner:
+    async def test_result_is_stored_and_time_is_recorded(self, workflow, instance, tmp_path):
+        workflow.procedures["start"] = [
+            ProcessingStep("list_folder_contents", path=String(str(tmp_path)), output_varname=VariablePath("entries")),
+        ]
+        (tmp_path / "a.txt").write_text("x")
+        stats = Commands.get_command_descriptor("list_folder_contents").stats
+        calls = stats.calls
+        result = await ProcedureRunner(instance).run_single_step()
+        assert result == CommandReturnStatus.Success
+        assert instance["entries"].value == ["a.txt"]
+        assert stats.calls == calls + 1
+
+
 # ============================================================
 # move_file
 # ============================================================
 
 class TestMoveFile:
-    def test_moves_file_to_new_path(self, instance, tmp_path):
+    async def test_moves_file_to_new_path(self, instance, tmp_path):
         src = tmp_path / "a.txt"
         dst = tmp_path / "b.txt"
         src.write_text("hello")
-        result = move_file(instance, String(str(src)), String(str(dst)))
+        result = await move_file(instance, String(str(src)), String(str(dst)))
         assert result == CommandReturnStatus.Success
         assert not src.exists()
         assert dst.read_text() == "hello"
 
-    def test_moves_file_into_existing_folder(self, instance, tmp_path):
+    async def test_moves_file_into_existing_folder(self, instance, tmp_path):
         src = tmp_path / "a.txt"
         src.write_text("data")
         dst_dir = tmp_path / "subdir"
         dst_dir.mkdir()
-        result = move_file(instance, String(str(src)), String(str(dst_dir)))
+        result = await move_file(instance, String(str(src)), String(str(dst_dir)))
         assert result == CommandReturnStatus.Success
         assert (dst_dir / "a.txt").exists()
 
-    def test_nonexistent_source_returns_error(self, instance, tmp_path):
-        result = move_file(instance, String(str(tmp_path / "no.txt")), String(str(tmp_path / "dst.txt")))
+    async def test_nonexistent_source_returns_error(self, instance, tmp_path):
+        result = await move_file(instance, String(str(tmp_path / "no.txt")), String(str(tmp_path / "dst.txt")))
         assert result == CommandReturnStatus.Error
 
 
@@ -63,15 +82,15 @@ class TestMoveFile:
 # ============================================================
 
 class TestDeleteFile:
-    def test_deletes_existing_file(self, instance, tmp_path):
+    async def test_deletes_existing_file(self, instance, tmp_path):
         f = tmp_path / "f.txt"
         f.write_text("x")
-        result = delete_file(instance, String(str(f)))
+        result = await delete_file(instance, String(str(f)))
         assert result == CommandReturnStatus.Success
         assert not f.exists()
 
-    def test_nonexistent_file_returns_error(self, instance, tmp_path):
-        result = delete_file(instance, String(str(tmp_path / "missing.txt")))
+    async def test_nonexistent_file_returns_error(self, instance, tmp_path):
+        result = await delete_file(instance, String(str(tmp_path / "missing.txt")))
         assert result == CommandReturnStatus.Error
 
 
@@ -80,16 +99,16 @@ class TestDeleteFile:
 # ============================================================
 
 class TestDeleteFolder:
-    def test_deletes_directory_tree(self, instance, tmp_path):
+    async def test_deletes_directory_tree(self, instance, tmp_path):
         d = tmp_path / "tree"
         d.mkdir()
         (d / "child.txt").write_text("y")
-        result = delete_folder(instance, String(str(d)))
+        result = await delete_folder(instance, String(str(d)))
         assert result == CommandReturnStatus.Success
         assert not d.exists()
 
-    def test_nonexistent_folder_returns_error(self, instance, tmp_path):
-        result = delete_folder(instance, String(str(tmp_path / "nope")))
+    async def test_nonexistent_folder_returns_error(self, instance, tmp_path):
+        result = await delete_folder(instance, String(str(tmp_path / "nope")))
         assert result == CommandReturnStatus.Error
 
 
@@ -98,20 +117,20 @@ class TestDeleteFolder:
 # ============================================================
 
 class TestCreateFolder:
-    def test_creates_directory(self, instance, tmp_path):
+    async def test_creates_directory(self, instance, tmp_path):
         d = tmp_path / "new"
-        result = create_folder(instance, String(str(d)))
+        result = await create_folder(instance, String(str(d)))
         assert result == CommandReturnStatus.Success
         assert d.is_dir()
 
-    def test_creates_nested_directories(self, instance, tmp_path):
+    async def test_creates_nested_directories(self, instance, tmp_path):
         d = tmp_path / "a" / "b" / "c"
-        result = create_folder(instance, String(str(d)))
+        result = await create_folder(instance, String(str(d)))
         assert result == CommandReturnStatus.Success
         assert d.is_dir()
 
-    def test_existing_directory_is_idempotent(self, instance, tmp_path):
-        result = create_folder(instance, String(str(tmp_path)))
+    async def test_existing_directory_is_idempotent(self, instance, tmp_path):
+        result = await create_folder(instance, String(str(tmp_path)))
         assert result == CommandReturnStatus.Success
 
 
@@ -120,46 +139,46 @@ class TestCreateFolder:
 # ============================================================
 
 class TestPathChecks:
-    def test_file_exists_true_for_file(self, instance, tmp_path):
+    async def test_file_exists_true_for_file(self, instance, tmp_path):
         f = tmp_path / "f.txt"
         f.write_text("")
-        file_exists(instance, String(str(f)), VariablePath("result"))
+        await file_exists(instance, String(str(f)), VariablePath("result"))
         assert type(instance.variables["result"]) == Boolean and instance.variables["result"].value is True
 
-    def test_file_exists_false_for_missing(self, instance, tmp_path):
-        file_exists(instance, String(str(tmp_path / "nope")), VariablePath("result"))
+    async def test_file_exists_false_for_missing(self, instance, tmp_path):
+        await file_exists(instance, String(str(tmp_path / "nope")), VariablePath("result"))
         assert type(instance.variables["result"]) == Boolean and instance.variables["result"].value is False
 
-    def test_file_exists_true_for_directory(self, instance, tmp_path):
-        file_exists(instance, String(str(tmp_path)), VariablePath("result"))
+    async def test_file_exists_true_for_directory(self, instance, tmp_path):
+        await file_exists(instance, String(str(tmp_path)), VariablePath("result"))
         assert type(instance.variables["result"]) == Boolean and instance.variables["result"].value is True
 
-    def test_is_file_true_for_file(self, instance, tmp_path):
+    async def test_is_file_true_for_file(self, instance, tmp_path):
         f = tmp_path / "f.txt"
         f.write_text("")
-        is_file(instance, String(str(f)), VariablePath("result"))
+        await is_file(instance, String(str(f)), VariablePath("result"))
         assert type(instance.variables["result"]) == Boolean and instance.variables["result"].value is True
 
-    def test_is_file_false_for_directory(self, instance, tmp_path):
-        is_file(instance, String(str(tmp_path)), VariablePath("result"))
+    async def test_is_file_false_for_directory(self, instance, tmp_path):
+        await is_file(instance, String(str(tmp_path)), VariablePath("result"))
         assert type(instance.variables["result"]) == Boolean and instance.variables["result"].value is False
 
-    def test_is_file_false_for_missing(self, instance, tmp_path):
-        is_file(instance, String(str(tmp_path / "nope")), VariablePath("result"))
+    async def test_is_file_false_for_missing(self, instance, tmp_path):
+        await is_file(instance, String(str(tmp_path / "nope")), VariablePath("result"))
         assert type(instance.variables["result"]) == Boolean and instance.variables["result"].value is False
 
-    def test_is_folder_true_for_directory(self, instance, tmp_path):
-        is_folder(instance, String(str(tmp_path)), VariablePath("result"))
+    async def test_is_folder_true_for_directory(self, instance, tmp_path):
+        await is_folder(instance, String(str(tmp_path)), VariablePath("result"))
         assert type(instance.variables["result"]) == Boolean and instance.variables["result"].value is True
 
-    def test_is_folder_false_for_file(self, instance, tmp_path):
+    async def test_is_folder_false_for_file(self, instance, tmp_path):
         f = tmp_path / "f.txt"
         f.write_text("")
-        is_folder(instance, String(str(f)), VariablePath("result"))
+        await is_folder(instance, String(str(f)), VariablePath("result"))
         assert type(instance.variables["result"]) == Boolean and instance.variables["result"].value is False
 
-    def test_is_folder_false_for_missing(self, instance, tmp_path):
-        is_folder(instance, String(str(tmp_path / "nope")), VariablePath("result"))
+    async def test_is_folder_false_for_missing(self, instance, tmp_path):
+        await is_folder(instance, String(str(tmp_path / "nope")), VariablePath("result"))
         assert type(instance.variables["result"]) == Boolean and instance.variables["result"].value is False
 
 
@@ -168,35 +187,35 @@ class TestPathChecks:
 # ============================================================
 
 class TestGotoBranches:
-    def test_goto_if_file_jumps_for_file(self, workflow, instance, tmp_path):
+    async def test_goto_if_file_jumps_for_file(self, workflow, instance, tmp_path):
         f = tmp_path / "f.txt"
         f.write_text("")
-        result = goto_if_file(instance, String("target"), String(str(f)))
+        result = await goto_if_file(instance, String("target"), String(str(f)))
         assert result == CommandReturnStatus.Success | CommandReturnStatus.Keep_Position
         assert instance.processing_step == ("target", 0)
 
-    def test_goto_if_file_continues_for_directory(self, workflow, instance, tmp_path):
-        result = goto_if_file(instance, String("target"), String(str(tmp_path)))
+    async def test_goto_if_file_continues_for_directory(self, workflow, instance, tmp_path):
+        result = await goto_if_file(instance, String("target"), String(str(tmp_path)))
         assert result == CommandReturnStatus.Success
         assert instance.processing_step == ("start", 0)
 
-    def test_goto_if_file_continues_for_missing(self, workflow, instance, tmp_path):
-        result = goto_if_file(instance, String("target"), String(str(tmp_path / "nope")))
+    async def test_goto_if_file_continues_for_missing(self, workflow, instance, tmp_path):
+        result = await goto_if_file(instance, String("target"), String(str(tmp_path / "nope")))
         assert result == CommandReturnStatus.Success
 
-    def test_goto_if_folder_jumps_for_directory(self, workflow, instance, tmp_path):
-        result = goto_if_folder(instance, String("target"), String(str(tmp_path)))
+    async def test_goto_if_folder_jumps_for_directory(self, workflow, instance, tmp_path):
+        result = await goto_if_folder(instance, String("target"), String(str(tmp_path)))
         assert result == CommandReturnStatus.Success | CommandReturnStatus.Keep_Position
         assert instance.processing_step == ("target", 0)
 
-    def test_goto_if_folder_continues_for_file(self, workflow, instance, tmp_path):
+    async def test_goto_if_folder_continues_for_file(self, workflow, instance, tmp_path):
         f = tmp_path / "f.txt"
         f.write_text("")
-        result = goto_if_folder(instance, String("target"), String(str(f)))
+        result = await goto_if_folder(instance, String("target"), String(str(f)))
         assert result == CommandReturnStatus.Success
 
-    def test_goto_if_folder_continues_for_missing(self, workflow, instance, tmp_path):
-        result = goto_if_folder(instance, String("target"), String(str(tmp_path / "nope")))
+    async def test_goto_if_folder_continues_for_missing(self, workflow, instance, tmp_path):
+        result = await goto_if_folder(instance, String("target"), String(str(tmp_path / "nope")))
         assert result == CommandReturnStatus.Success
 
 
@@ -205,28 +224,28 @@ class TestGotoBranches:
 # ============================================================
 
 class TestListFolderContents:
-    def test_lists_files_sorted(self, instance, tmp_path):
+    async def test_lists_files_sorted(self, instance, tmp_path):
         (tmp_path / "c.txt").write_text("")
         (tmp_path / "a.txt").write_text("")
         (tmp_path / "b.txt").write_text("")
-        result = list_folder_contents(instance, String(str(tmp_path)), VariablePath("entries"))
+        result = await list_folder_contents(instance, String(str(tmp_path)), VariablePath("entries"))
         assert result == CommandReturnStatus.Success
         assert instance.variables["entries"].value == ["a.txt", "b.txt", "c.txt"]
 
-    def test_includes_subdirectories(self, instance, tmp_path):
+    async def test_includes_subdirectories(self, instance, tmp_path):
         (tmp_path / "file.txt").write_text("")
         (tmp_path / "subdir").mkdir()
-        list_folder_contents(instance, String(str(tmp_path)), VariablePath("entries"))
+        await list_folder_contents(instance, String(str(tmp_path)), VariablePath("entries"))
         assert "file.txt" in instance.variables["entries"].value
         assert "subdir" in instance.variables["entries"].value
 
-    def test_empty_folder_returns_empty_list(self, instance, tmp_path):
-        result = list_folder_contents(instance, String(str(tmp_path)), VariablePath("entries"))
+    async def test_empty_folder_returns_empty_list(self, instance, tmp_path):
+        result = await list_folder_contents(instance, String(str(tmp_path)), VariablePath("entries"))
         assert result == CommandReturnStatus.Success
         assert instance.variables["entries"].value == []
 
-    def test_nonexistent_folder_returns_error(self, instance, tmp_path):
-        result = list_folder_contents(instance, String(str(tmp_path / "nope")), VariablePath("entries"))
+    async def test_nonexistent_folder_returns_error(self, instance, tmp_path):
+        result = await list_folder_contents(instance, String(str(tmp_path / "nope")), VariablePath("entries"))
         assert result == CommandReturnStatus.Error
 
 
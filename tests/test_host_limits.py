@@ -0,0 +1,131 @@
+"""Tests for the per host rate and concurrency limits the addons share."""
+import asyncio
+import time
+from copy import deepcopy
+import pytest
+
+from builtin_addons import rtorrent
+from pipeline_backend.host_limits import HostLimits, host_of
+from pipeline_backend.instances import Instance
+from pipeline_backend.variables import Dictionary, Float, Integer, String
+from pipeline_backend.workflows import Workflow
+
+
+def set_limits(mgr, **hosts):
+    mgr.ctx.variables["host_limits"] = Dictionary({
+        host.replace("_", "."): Dictionary(limits) for host, limits in hosts.items()
+    })
+
+
+async def hold(limits, url, seconds, tracker):
+    async with limits.acquire(url):
+        tracker["active"] += 1
+        tracker["max_active"] = max(tracker["max_active"], tracker["active"])
+        await asyncio.sleep(seconds)
+        tracker["active"] -= 1
+
+
+def new_tracker():
+    return {"active": 0, "max_active": 0}
+
+
+class TestHostOf:
+    def test_urls_and_bare_hosts(self):
+        assert host_of("https://Example.com:8080/feed.xml") == "example.com"
+        assert host_of("seedbox.example.com") == "seedbox.example.com"
+        assert host_of("seedbox.example.com:2222") == "seedbox.example.com"
+
+
+class TestConfig:
+    def test_unlimited_without_the_global(self, mgr):
+        config = mgr.ctx.host_limits.config_for("example.com")
+        assert config.requests_per_second == 0 and config.max_in_flight == 0
+
+    def test_host_entry_wins_over_default(self, mgr):
+        set_limits(mgr, default={"max_in_flight": Integer(8)}, example_com={"max_in_flight": Integer(2)})
+        assert mgr.ctx.host_limits.config_for("example.com").max_in_flight == 2
+        assert mgr.ctx.host_limits.config_for("other.com").max_in_flight == 8
+
+    def test_unreadable_values_are_ignored(self, mgr):
+        set_limits(mgr, default={"max_in_flight": String("lots"), "requests_per_second": String("2.5")})
+        config = mgr.ctx.host_limits.config_for("example.com")
+        assert config.max_in_flight == 0
+        assert config.requests_per_second == 2.5
+
+
+class TestLimits:
+    async def test_max_in_flight_is_per_host(self, mgr):
+        set_limits(mgr, example_com={"max_in_flight": Integer(2)})
+        limited, other = new_tracker(), new_tracker()
+        await asyncio.gather(
+            *(hold(mgr.ctx.host_limits, "https://example.com/a", 0.02, limited) for _ in range(5)),
+            *(hold(mgr.ctx.host_limits, "https://other.com/a", 0.02, other) for _ in range(5)),
+        )
+        assert limited["max_active"] == 2
+        assert other["max_active"] == 5
+
+    async def test_raising_the_limit_frees_waiters(self, mgr):
+        set_limits(mgr, example_com={"max_in_flight": Integer(1)})
+        tracker = new_tracker()
+        tasks = [asyncio.create_task(hold(mgr.ctx.host_limits, "https://example.com", 0.05, tracker)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        set_limits(mgr, example_com={"max_in_flight": Integer(3)})
+        await asyncio.gather(*tasks)
+        # The first release lets both waiters in at once under the new limit
+        assert tracker["max_active"] == 2
+
+    async def test_rate_spaces_out_requests_after_the_burst(self, mgr):
+        set_limits(mgr, example_com={"requests_per_second": Float(50.0), "burst": Integer(2)})
+        started = []
+
+        async def request():
+            async with mgr.ctx.host_limits.acquire("https://example.com"):
+                started.append(time.monotonic())
+
+        await asyncio.gather(*(request() for _ in range(4)))
+        # Two go straight away, then one every 20ms
+        assert started[1] - started[0] < 0.01
+        assert started[3] - started[0] >= 0.035
+
+    async def test_slot_is_released_on_error(self, mgr):
+        set_limits(mgr, example_com={"max_in_flight": Integer(1)})
+        with pytest.raises(RuntimeError):
+            async with mgr.ctx.host_limits.acquire("https://example.com"):
+                raise RuntimeError()
+        assert mgr.ctx.host_limits.limiter_for("example.com").in_flight == 0
+
+
+class TestAddonsAcquire:
+    async def test_rtorrent_rpc_goes_through_the_host_limit(self, mgr, monkeypatch):
+        instance = Instance(mgr.ctx)
+        acquired = []
+        original = HostLimits.acquire
+
+        def recording_acquire(self, url):
+            acquired.append(url)
+            return original(self, url)
+
+        monkeypatch.setattr(HostLimits, "acquire", recording_acquire)
+        monkeypatch.setattr(rtorrent.Server, "_Server__connect_to_server_basic", lambda self, url, username, password: None)
+        server = rtorrent.Server(instance, Dictionary({
+            "URL": String("https://rtorrent.example/xmlrpc"),
+            "username": String("user"),
+            "password": String("password"),
+        }))
+        assert await server.run_rpc(lambda: "ok") == "ok"
+        assert acquired == ["https://rtorrent.example/xmlrpc"]
+
+
+async def test_workflow_can_be_copied_while_waiting_for_a_slot(mgr):
+    set_limits(mgr, example_com={"max_in_flight": Integer(1)})
+    workflow = Workflow(mgr.ctx)
+    workflow.uuid = "wf-host-limit-copy"
+    mgr.ctx.workflows[workflow.uuid] = workflow
+    tracker = new_tracker()
+    holders = [asyncio.ensure_future(hold(mgr.ctx.host_limits, "https://example.com/a", 0.05, tracker)) for _ in range(2)]
+    await asyncio.sleep(0.01)
+    # One holds the slot and the other waits on the limiter's condition
+    assert tracker["active"] == 1
+    draft = deepcopy(workflow)
+    assert draft.ctx is mgr.ctx
+    await asyncio.gather(*holders)
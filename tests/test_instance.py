@@ -250,6 +250,36 @@ class TestDotNotationSet:
             inst["x.key"] = String("val")
 
 
+class TestCopyOnWriteLookups:
+    def test_lookup_shares_instead_of_copying(self, workflow):
+        workflow.constants["feed"] = StringList(["item"] * 5000)
+        inst = workflow.spawn_instance()
+        assert inst["feed"].read_value() is workflow.constants["feed"].read_value()
+
+    def test_editing_a_lookup_cannot_corrupt_a_constant(self, workflow):
+        workflow.constants["feed"] = VariableList([String("a")])
+        inst = workflow.spawn_instance()
+        feed = inst["feed"]
+        feed.value[0].value = "changed"
+        feed.value.append(String("b"))
+        assert workflow.constants["feed"].convert_to_python_type() == ["a"]
+
+    def test_editing_a_stored_value_afterwards_does_not_reach_the_instance(self, workflow):
+        inst = workflow.spawn_instance()
+        entry = Dictionary({"title": String("old")})
+        inst["entry"] = entry
+        entry.value["title"] = String("new")
+        assert inst["entry.title"].value == "old"
+
+    def test_dot_notation_set_leaves_earlier_lookups_alone(self, workflow):
+        inst = workflow.spawn_instance()
+        inst["entry.title"] = String("old")
+        before = inst["entry"]
+        inst["entry.title"] = String("new")
+        assert before.value["title"].value == "old"
+        assert inst["entry.title"].value == "new"
+
+
 def log_lines(inst):
     """The log always ends in a newline, so drop the trailing empty entry."""
     return inst.console_log.split("\n")[:-1]
@@ -289,6 +319,38 @@ class TestConsoleLog:
             inst.log_line(f"line {i}")
         assert inst.console_log.endswith("\n")
 
+    def test_line_count_includes_trimmed_lines(self, workflow):
+        inst = workflow.spawn_instance()
+        for i in range(200):
+            inst.log_line(f"line {i}")
+        inst.log_line("a\nb")
+        assert inst.console_log_line_count == 202
+
+    def test_trimmed_lines_are_counted_across_a_save(self, workflow):
+        inst = workflow.spawn_instance()
+        for i in range(CONSOLE_LOG_MAX_LINES + 5):
+            inst.log_line(f"line {i}")
+        assert inst.console_log_trimmed_lines == 5
+        restored = Instance(workflow.ctx)
+        restored.json_loadable(inst.json_savable())
+        assert restored.console_log_trimmed_lines == 5
+
+    def test_setting_the_text_replaces_the_log(self, workflow):
+        inst = workflow.spawn_instance()
+        inst.log_line("old")
+        inst.console_log = "line 1\nline 2\n"
+        assert log_lines(inst) == ["line 1", "line 2"]
+        assert inst.console_log_line_count == 2
+        inst.console_log = ""
+        assert inst.console_log == ""
+
+    def test_rendered_text_follows_new_lines(self, workflow):
+        inst = workflow.spawn_instance()
+        inst.log_line("first")
+        assert inst.console_log == "first\n"
+        inst.log_line("second")
+        assert inst.console_log == "first\nsecond\n"
+
     def test_oversized_log_from_an_old_state_file_is_trimmed_on_load(self, workflow):
         inst = workflow.spawn_instance()
         inst.uuid = "inst-oversized"
@@ -0,0 +1,208 @@
+"""Tests for the per instance log files that keep the full history beyond console_log."""
+import asyncio
+from copy import deepcopy
+import pytest
+
+import pipeline_backend.instance_logs as instance_logs
+from pipeline_backend.instance_logs import InstanceLogs, tail_log_events
+from pipeline_backend.procedure_runner import ProcedureRunner
+from pipeline_backend.variables import String
+from pipeline_backend.workflows import Workflow, ProcessingStep
+
+
+class FakeRequest:
+    """Stands in for the Starlette Request that the SSE stream watches."""
+    def __init__(self, disconnected=False):
+        self.disconnected = disconnected
+
+    async def is_disconnected(self):
+        return self.disconnected
+
+
+@pytest.fixture
+def logs(mgr, tmp_path):
+    mgr.ctx.instance_logs = InstanceLogs(tmp_path)
+    return mgr.ctx.instance_logs
+
+
+@pytest.fixture
+def instance(mgr, logs):
+    wf = Workflow(mgr.ctx)
+    wf.uuid = "wf-log-test"
+    wf.procedures["start"] = [
+        ProcessingStep("log", msg=String("hello")),
+        ProcessingStep("yield_for_seconds", num_seconds=String("60")),
+    ]
+    mgr.ctx.workflows[wf.uuid] = wf
+    return wf.spawn_instance()
+
+
+def logged_text(logs, uuid):
+    return (logs.directory / f"{uuid}.log").read_text()
+
+
+class TestWriting:
+    def test_disabled_without_a_directory(self, mgr):
+        assert not mgr.ctx.instance_logs.enabled
+        assert InstanceLogs("").get("some-uuid") is None
+
+    def test_uuid_must_be_a_plain_file_name(self, logs):
+        assert logs.get("../escape") is None
+        assert logs.get("") is None
+
+    def test_lines_are_buffered_until_flushed(self, logs, instance):
+        instance.log_line("first")
+        assert not (logs.directory / f"{instance.uuid}.log").exists()
+        logs.flush(instance.uuid)
+        assert logged_text(logs, instance.uuid).endswith(" first\n")
+
+    def test_history_outlives_the_console_log(self, logs, instance):
+        for i in range(200):
+            instance.log_line(f"line {i}")
+        logs.flush(instance.uuid)
+        lines = logged_text(logs, instance.uuid).splitlines()
+        assert len(lines) == 200
+        assert lines[0].endswith(" line 0")
+
+    def test_large_buffer_flushes_itself(self, logs, instance, monkeypatch):
+        monkeypatch.setattr(instance_logs, "INSTANCE_LOG_BUFFER_BYTES", 100)
+        instance.log_line("x" * 100)
+        assert (logs.directory / f"{instance.uuid}.log").exists()
+
+    async def test_flushed_when_the_instance_yields(self, mgr, logs, instance):
+        await mgr._run_one_instance(instance)
+        await logs.get(instance.uuid).wait_for_writes()
+        assert logged_text(logs, instance.uuid).endswith(" hello\n")
+
+    async def test_written_in_a_thread_batching_what_comes_in_meanwhile(self, logs, instance):
+        log = logs.get(instance.uuid)
+        instance.log_line("first")
+        log.flush()
+        # Nothing is written on the event loop itself
+        assert not log.path.exists()
+        instance.log_line("second")
+        log.flush()
+        await log.wait_for_writes()
+        assert logged_text(logs, instance.uuid).splitlines()[-1].endswith(" second")
+
+    async def test_flush_all_waits_for_the_writes(self, logs, instance):
+        instance.log_line("at shutdown")
+        await logs.flush_all()
+        assert logged_text(logs, instance.uuid).endswith(" at shutdown\n")
+
+
+class TestDiscarding:
+    def test_deletes_the_file_and_its_backups(self, logs, instance, monkeypatch):
+        monkeypatch.setattr(instance_logs, "INSTANCE_LOG_MAX_BYTES", 1000)
+        for i in range(2):
+            instance.log_line("x" * 1000)
+            logs.flush(instance.uuid)
+        instance.log_line("pending")
+        logs.discard(instance.uuid)
+        assert list(logs.directory.iterdir()) == []
+        assert instance.uuid not in logs._files
+
+    async def test_waits_for_a_write_under_way(self, logs, instance):
+        instance.log_line("being written")
+        logs.flush(instance.uuid)
+        log = logs.get(instance.uuid)
+        logs.discard(instance.uuid)
+        await log.wait_for_writes()
+        assert not log.path.exists()
+
+    async def test_deleting_the_instance_discards_its_log(self, mgr, logs, instance):
+        workflow = mgr.ctx.workflows[instance.workflow_uuid]
+        workflow.procedures["start"] = [ProcessingStep("delete_this_instance")]
+        instance.log_line("about to go")
+        logs.flush(instance.uuid)
+        log = logs.get(instance.uuid)
+        await log.wait_for_writes()
+        await ProcedureRunner(instance).run_single_step()
+        await log.wait_for_writes()
+        assert not log.path.exists()
+
+    def test_file_is_rotated(self, logs, instance, monkeypatch):
+        monkeypatch.setattr(instance_logs, "INSTANCE_LOG_MAX_BYTES", 1000)
+        for i in range(3):
+            instance.log_line("x" * 1000)
+            logs.flush(instance.uuid)
+        assert (logs.directory / f"{instance.uuid}.log.1").exists()
+        assert (logs.directory / f"{instance.uuid}.log.3").exists()
+        assert not (logs.directory / f"{instance.uuid}.log").exists()
+
+
+class TestReading:
+    def test_read_resumes_from_the_offset(self, logs, instance):
+        log = logs.get(instance.uuid)
+        instance.log_line("one")
+        log.flush()
+        text, offset = log.read(0)
+        assert text.endswith(" one\n")
+        assert log.read(offset) == ("", offset)
+        instance.log_line("two")
+        log.flush()
+        text, _ = log.read(offset)
+        assert text.endswith(" two\n") and "one" not in text
+
+    def test_read_stops_at_a_line_end(self, logs, instance):
+        log = logs.get(instance.uuid)
+        instance.log_line("a" * 10)
+        instance.log_line("b" * 10)
+        log.flush()
+        text, offset = log.read(0, max_bytes=len(log.read(0)[0]) - 5)
+        assert text.count("\n") == 1
+        assert log.read(offset)[0].endswith("b" * 10 + "\n")
+
+    def test_offsets_keep_counting_across_rotation(self, logs, instance, monkeypatch):
+        monkeypatch.setattr(instance_logs, "INSTANCE_LOG_MAX_BYTES", 1000)
+        log = logs.get(instance.uuid)
+        instance.log_line("x" * 1000)
+        log.flush()
+        _, offset = log.read(0)
+        instance.log_line("after rotation")
+        log.flush()
+        # The offset is past the end of the new file, yet still picks up right where it left off
+        assert offset > log.path.stat().st_size
+        assert log.read(offset)[0].endswith(" after rotation\n")
+
+    def test_offset_past_the_end_starts_over(self, logs, instance):
+        log = logs.get(instance.uuid)
+        instance.log_line("only line")
+        log.flush()
+        text, _ = log.read(10**9)
+        assert text.endswith(" only line\n")
+
+
+class TestTail:
+    async def test_tail_sends_history_then_new_lines(self, logs, instance):
+        log = logs.get(instance.uuid)
+        instance.log_line("old")
+        log.flush()
+        events = tail_log_events(log, 0, FakeRequest())
+        first = await anext(events)
+        assert first["data"].endswith(" old\n")
+
+        pending = asyncio.ensure_future(anext(events))
+        await asyncio.sleep(0)
+        assert not pending.done()
+        instance.log_line("new")
+        log.flush()
+        second = await asyncio.wait_for(pending, 1)
+        assert second["data"].endswith(" new\n")
+        assert int(second["id"]) == log.end_offset()
+        await events.aclose()
+
+    async def test_tail_stops_when_the_client_leaves(self, logs, instance):
+        log = logs.get(instance.uuid)
+        events = tail_log_events(log, 0, FakeRequest(disconnected=True))
+        with pytest.raises(StopAsyncIteration):
+            await anext(events)
+
+
+async def test_workflow_can_be_copied_once_a_tail_has_waited(mgr, logs, instance):
+    log = logs.get(instance.uuid)
+    await log.wait_for_flush(0.01)
+    workflow = mgr.ctx.workflows[instance.workflow_uuid]
+    draft = deepcopy(workflow)
+    assert draft.ctx is mgr.ctx
+    assert draft.procedures["start"][0].command_name == "log"
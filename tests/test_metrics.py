@@ -0,0 +1,136 @@
+"""Tests for the metrics registry and what the pipeline records into it."""
+import asyncio
+from datetime import datetime, timedelta
+from unittest.mock import patch
+import pytest
+
+from pipeline_backend import metrics
+from pipeline_backend.event_callbacks import EventCallbacksManager, ServerSideSignalsQueue
+from pipeline_backend.metrics import MetricsRegistry, read_metrics
+from pipeline_backend.procedure_runner import ProcedureRunner
+from pipeline_backend.variables import String
+from pipeline_backend.workflows import Workflow, RunStates, ProcessingStep
+
+
+class FakeRequest:
+    """Stands in for the Starlette Request that the SSE stream watches."""
+    async def is_disconnected(self):
+        return False
+
+
+@pytest.fixture
+def workflow(mgr):
+    wf = Workflow(mgr.ctx)
+    wf.uuid = "wf-metrics-test"
+    wf.name = "Metrics Test"
+    wf.procedures["start"] = [ProcessingStep("log", msg=String("hi")), ProcessingStep("pause_this_instance")]
+    mgr.ctx.workflows[wf.uuid] = wf
+    return wf
+
+
+class TestRegistry:
+    def test_counter_and_gauge_text(self):
+        registry = MetricsRegistry()
+        requests = registry.counter("test_requests_total", "Requests", ("host",))
+        depth = registry.gauge("test_depth", "Depth")
+        requests.inc(host="a")
+        requests.inc(2, host="a")
+        depth.set(1.5)
+        text = registry.render()
+        assert "# TYPE test_requests_total counter" in text
+        assert 'test_requests_total{host="a"} 3' in text
+        assert "test_depth 1.5" in text
+
+    def test_histogram_buckets_are_cumulative(self):
+        registry = MetricsRegistry()
+        latency = registry.histogram("test_latency_seconds", "Latency", buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 0.7, 5):
+            latency.observe(value)
+        lines = registry.render().splitlines()
+        assert 'test_latency_seconds_bucket{le="0.1"} 1' in lines
+        assert 'test_latency_seconds_bucket{le="1"} 3' in lines
+        assert 'test_latency_seconds_bucket{le="+Inf"} 4' in lines
+        assert "test_latency_seconds_count 4" in lines
+        assert "test_latency_seconds_sum 6.25" in lines
+
+    def test_label_values_are_escaped(self):
+        registry = MetricsRegistry()
+        registry.gauge("test_named", "Named", ("name",)).set(1, name='say "hi"\\n')
+        assert 'test_named{name="say \\"hi\\"\\\\n"} 1' in registry.render()
+
+    def test_labels_must_match(self):
+        registry = MetricsRegistry()
+        counter = registry.counter("test_labelled_total", "Labelled", ("command",))
+        with pytest.raises(ValueError):
+            counter.inc(host="a")
+
+    def test_names_are_unique(self):
+        registry = MetricsRegistry()
+        registry.counter("test_once_total", "Once")
+        with pytest.raises(ValueError):
+            registry.gauge("test_once_total", "Twice")
+
+    def test_collectors_run_before_render(self):
+        registry = MetricsRegistry()
+        gauge = registry.gauge("test_collected", "Collected")
+        registry.add_collector(lambda: gauge.set(42))
+        assert "test_collected 42" in registry.render()
+
+
+class TestPipelineMetrics:
+    def test_instances_by_workflow_and_state(self, mgr, workflow):
+        workflow.spawn_instance()
+        workflow.spawn_instance().state = RunStates.Paused
+        mgr.update_metrics()
+        assert metrics.instances_gauge.value(workflow_uuid=workflow.uuid, workflow="Metrics Test", state="Running") == 1
+        assert metrics.instances_gauge.value(workflow_uuid=workflow.uuid, workflow="Metrics Test", state="Paused") == 1
+        assert metrics.due_backlog_gauge.value() == 1
+
+    async def test_dispatch_records_the_scheduler_lag(self, mgr, workflow):
+        inst = workflow.spawn_instance()
+        inst.next_processing_time = datetime.now() - timedelta(seconds=30)
+        count, total = metrics.scheduler_lag_histogram.count(), metrics.scheduler_lag_histogram.sum()
+        with patch.object(mgr, 'request_save'), patch.object(mgr, 'notify_of_something_happening'):
+            await mgr.run_due_instances()
+            await asyncio.gather(*mgr._running_instance_tasks.values())
+        assert metrics.scheduler_lag_histogram.count() == count + 1
+        assert 30 <= metrics.scheduler_lag_histogram.sum() - total < 31
+
+    async def test_step_duration_is_recorded_per_command(self, workflow):
+        count = metrics.step_duration_histogram.count(command="log")
+        await ProcedureRunner(workflow.spawn_instance()).run_single_step()
+        assert metrics.step_duration_histogram.count(command="log") == count + 1
+
+    async def test_time_commands_held_things_up_is_exported(self, workflow):
+        await ProcedureRunner(workflow.spawn_instance()).run_single_step()
+        text = metrics.metrics.render()
+        assert 'webautotender_command_blocked_seconds{command="log"}' in text
+        assert 'webautotender_command_blocked_max_seconds{command="log"}' in text
+
+    def test_save_records_duration_and_bytes(self, mgr, workflow, tmp_path):
+        state_file = tmp_path / "state.json"
+        mgr.restore_state(str(state_file))
+        workflow.spawn_instance()
+        count = metrics.save_duration_histogram.count()
+        mgr.save_state()
+        assert metrics.save_duration_histogram.count() == count + 1
+        assert metrics.last_save_bytes_gauge.value() == state_file.stat().st_size
+
+    async def test_sse_subscribers_and_queue_depth(self):
+        sse = ServerSideSignalsQueue(FakeRequest())
+        stream = sse.message_generator()
+        await sse.add_new_message(EventCallbacksManager.Events.RefreshInstance, "inst-1")
+        await sse.add_new_message(EventCallbacksManager.Events.RefreshInstance, "inst-2")
+        await anext(stream)
+        await sse.add_new_message(EventCallbacksManager.Events.RefreshInstance, "inst-3")
+        ServerSideSignalsQueue.update_metrics()
+        assert metrics.sse_subscribers_gauge.value() == 1
+        assert metrics.sse_queued_messages_gauge.value() == 2
+        await stream.aclose()
+        ServerSideSignalsQueue.update_metrics()
+        assert metrics.sse_subscribers_gauge.value() == 0
+
+    async def test_route_serves_the_text_format(self):
+        response = await read_metrics()
+        assert response.media_type.startswith("text/plain; version=0.0.4")
+        assert b"# TYPE webautotender_step_duration_seconds histogram" in response.body
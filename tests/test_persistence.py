@@ -1,5 +1,8 @@
 """Tests for pipeline state save/load round-trips via PipelineManager."""
+import asyncio
+import json
 import os
+import threading
 import pytest
 from datetime import datetime
 from unittest.mock import patch
@@ -7,6 +10,7 @@ from unittest.mock import patch
 from pipeline_backend.workflows import Workflow, RunStates, ProcessingStep
 from pipeline_backend.variables import String, Integer, Float, VariablePath, Dictionary
 from pipeline_backend.manager import PipelineManager
+from pipeline_backend.persistence import JournalStateStore, JsonStateStore, atomic_write_text
 
 
 # ---------------------------------------------------------------------------
@@ -271,6 +275,16 @@ class TestAtomicSaves:
         assert state_file.read_text() == "old contents"
         assert not (tmp_path / "state.json.tmp").exists()
 
+    def test_stores_report_the_bytes_they_wrote(self, tmp_path):
+        data = {"workflows": {"wf-1": {"name": "Caf\u00e9 \u2615"}}, "instances": {}, "variables": {}}
+        json_file = tmp_path / "state.json"
+        assert JsonStateStore(str(json_file)).write_snapshot(data) == json_file.stat().st_size
+
+        journal = JournalStateStore(str(tmp_path / "journal.json"))
+        assert journal.write_snapshot(data) == (tmp_path / "journal.json").stat().st_size
+        data["workflows"]["wf-1"] = {"name": "Th\u00e9 \U0001F375"}
+        assert journal.write_snapshot(data, {"workflows": {"wf-1"}}) == (tmp_path / "journal.json.journal").stat().st_size
+
     def test_save_secrets_uses_atomic_replace(self, mgr, tmp_path):
         secrets_file = tmp_path / "secrets.json"
         mgr.ctx.secrets["api_key"] = String("secret123")
@@ -280,3 +294,362 @@ class TestAtomicSaves:
 
         mock_replace.assert_called_once_with(str(secrets_file) + ".tmp", str(secrets_file))
         assert not (tmp_path / "secrets.json.tmp").exists()
+
+
+# ---------------------------------------------------------------------------
+# Coalesced background saves
+# ---------------------------------------------------------------------------
+
+class TestCoalescedSaves:
+    @pytest.fixture
+    def state_file(self, mgr, tmp_path):
+        state_file = tmp_path / "state.json"
+        mgr.restore_state(str(state_file))  # missing file, but it becomes the backing store
+        mgr.save_coalesce_seconds = 0.05
+        mgr.save_max_latency_seconds = 0.2
+        return state_file
+
+    async def test_burst_of_requests_is_one_write(self, mgr, state_file):
+        make_workflow(mgr, "wf-1")
+        with patch("pipeline_backend.persistence.atomic_write_text", wraps=atomic_write_text) as mock_write:
+            for _ in range(50):
+                mgr.request_save()
+            await asyncio.sleep(0.15)
+        mock_write.assert_called_once()
+        assert "wf-1" in state_file.read_text()
+
+    async def test_max_latency_bounds_a_steady_stream_of_changes(self, mgr, state_file):
+        with patch("pipeline_backend.persistence.atomic_write_text") as mock_write:
+            for _ in range(15):
+                mgr.request_save()
+                await asyncio.sleep(0.02)
+        # Never quiet for the coalesce window, yet the latency bound still forced a write
+        assert mock_write.called
+
+    async def test_write_happens_off_the_event_loop(self, mgr, state_file):
+        write_threads = []
+        with patch("pipeline_backend.persistence.atomic_write_text", side_effect=lambda *a: write_threads.append(threading.get_ident())):
+            mgr.request_save()
+            await asyncio.sleep(0.15)
+        assert write_threads and write_threads[0] != threading.get_ident()
+
+    async def test_stop_flushes_a_pending_save(self, mgr, state_file):
+        mgr.save_coalesce_seconds = 60
+        mgr.save_max_latency_seconds = 60
+        make_workflow(mgr, "wf-1")
+        mgr.request_save()
+        assert not state_file.exists()
+        await mgr.stop()
+        assert "wf-1" in state_file.read_text()
+
+    def test_older_snapshot_does_not_replace_a_newer_one(self, mgr, state_file):
+        make_workflow(mgr, "wf-old")
+        old_data, old_changed, old_generation = mgr._state_snapshot()
+        make_workflow(mgr, "wf-new")
+        mgr.save_state()
+        assert not mgr._write_state_snapshot(str(state_file), old_data, old_changed, old_generation)
+        assert "wf-new" in state_file.read_text()
+
+
+# ---------------------------------------------------------------------------
+# Only what changed gets serialized
+# ---------------------------------------------------------------------------
+
+class TestChangedOnlySaves:
+    @pytest.fixture
+    def state_file(self, mgr, tmp_path):
+        state_file = tmp_path / "state.json"
+        mgr.restore_state(str(state_file))
+        return state_file
+
+    def test_unchanged_instances_are_not_serialized_again(self, mgr, state_file):
+        wf = make_workflow(mgr, "wf-1")
+        quiet = wf.spawn_instance()
+        busy = wf.spawn_instance()
+        mgr.save_state()
+        busy.processing_step = ("start", 3)
+        with patch.object(type(quiet), "json_savable", autospec=True, side_effect=lambda i: {}) as mock_savable:
+            mgr.save_state()
+        assert [call.args[0] for call in mock_savable.call_args_list] == [busy]
+
+    def test_file_matches_a_full_dump(self, mgr, state_file):
+        wf = make_workflow(mgr, "wf-1")
+        inst = wf.spawn_instance()
+        inst.variables["counter"] = Integer(1)
+        mgr.ctx.variables["shared"] = String("line one\nline two")
+        mgr.save_state()
+        inst["counter"] = Integer(2)
+        mgr.save_state()
+        expected = json.dumps(mgr._savable_state(), indent=4)
+        assert state_file.read_text() == expected
+
+    def test_removed_objects_leave_the_file(self, mgr, state_file):
+        wf = make_workflow(mgr, "wf-1")
+        inst = wf.spawn_instance()
+        mgr.save_state()
+        mgr.ctx.instances.pop(inst.uuid)
+        mgr.save_state()
+        assert inst.uuid not in state_file.read_text()
+
+    def test_restore_leaves_nothing_unsaved(self, mgr, state_file):
+        make_workflow(mgr, "wf-1")
+        mgr.save_state()
+        restored = PipelineManager()
+        restored.restore_state(str(state_file))
+        restored._refresh_savable()
+        assert not restored._unsaved
+
+    def test_failed_write_keeps_the_changes(self, mgr, state_file):
+        make_workflow(mgr, "wf-1")
+        with patch("pipeline_backend.persistence.atomic_write_text", side_effect=OSError("disk full")):
+            with pytest.raises(OSError):
+                mgr.save_state()
+        assert "wf-1" in mgr._unsaved.workflows
+
+    def test_render_matches_json_dumps_with_extra_keys(self):
+        store = JsonStateStore("unused.json")
+        data = {"workflows": {}, "instances": {"a": {"x": [1, 2]}}, "variables": {"v": {"y": None}}, "journal_sequence": 4}
+        assert store._render_json(data) == json.dumps(data, indent=4)
+
+
+# ---------------------------------------------------------------------------
+# Journal backend
+# ---------------------------------------------------------------------------
+
+class TestJournalBackend:
+    @pytest.fixture
+    def journal_mgr(self, tmp_path):
+        mgr = PipelineManager()
+        mgr.state_backend = "journal"
+        mgr.restore_state(str(tmp_path / "state.json"))
+        return mgr
+
+    def reopen(self, tmp_path):
+        mgr = PipelineManager()
+        mgr.state_backend = "journal"
+        mgr.restore_state(str(tmp_path / "state.json"))
+        return mgr
+
+    def journal_lines(self, tmp_path):
+        return (tmp_path / "state.json.journal").read_text().splitlines()
+
+    def test_first_save_writes_a_snapshot(self, journal_mgr, tmp_path):
+        make_workflow(journal_mgr, "wf-1")
+        journal_mgr.save_state()
+        assert "wf-1" in (tmp_path / "state.json").read_text()
+        assert self.journal_lines(tmp_path) == []
+
+    def test_later_saves_only_append_what_changed(self, journal_mgr, tmp_path):
+        wf = make_workflow(journal_mgr, "wf-1")
+        quiet = wf.spawn_instance()
+        busy = wf.spawn_instance()
+        journal_mgr.save_state()
+        busy.processing_step = ("start", 4)
+        journal_mgr.save_state()
+        lines = self.journal_lines(tmp_path)
+        assert len(lines) == 1
+        assert busy.uuid in lines[0]
+        assert quiet.uuid not in lines[0]
+
+    def test_restore_replays_the_journal_over_the_snapshot(self, journal_mgr, tmp_path):
+        wf = make_workflow(journal_mgr, "wf-1")
+        inst = wf.spawn_instance()
+        journal_mgr.save_state()
+        inst.processing_step = ("start", 4)
+        journal_mgr.ctx.variables["shared"] = Integer(3)
+        journal_mgr.save_state()
+
+        restored = self.reopen(tmp_path)
+        assert restored.ctx.instances[inst.uuid].processing_step == ("start", 4)
+        assert restored.ctx.variables["shared"].value == 3
+
+    def test_deletions_are_replayed(self, journal_mgr, tmp_path):
+        wf = make_workflow(journal_mgr, "wf-1")
+        inst = wf.spawn_instance()
+        journal_mgr.save_state()
+        del journal_mgr.ctx.instances[inst.uuid]
+        journal_mgr.save_state()
+        assert inst.uuid not in self.reopen(tmp_path).ctx.instances
+
+    def test_journal_is_compacted_into_the_snapshot(self, journal_mgr, tmp_path):
+        wf = make_workflow(journal_mgr, "wf-1")
+        inst = wf.spawn_instance()
+        journal_mgr.save_state()
+        journal_mgr._state_store.compact_records = 3
+        for step in range(5):
+            inst.processing_step = ("start", step)
+            journal_mgr.save_state()
+        assert len(self.journal_lines(tmp_path)) < 3
+        assert self.reopen(tmp_path).ctx.instances[inst.uuid].processing_step == ("start", 4)
+
+    def test_torn_final_record_is_ignored(self, journal_mgr, tmp_path):
+        wf = make_workflow(journal_mgr, "wf-1")
+        inst = wf.spawn_instance()
+        journal_mgr.save_state()
+        inst.processing_step = ("start", 2)
+        journal_mgr.save_state()
+        with open(tmp_path / "state.json.journal", "a") as f:
+            f.write('{"seq": 99, "op": "put", "sec')
+        assert self.reopen(tmp_path).ctx.instances[inst.uuid].processing_step == ("start", 2)
+
+    def test_saves_after_a_torn_record_survive_the_next_restore(self, journal_mgr, tmp_path):
+        wf = make_workflow(journal_mgr, "wf-1")
+        inst = wf.spawn_instance()
+        journal_mgr.save_state()
+        inst.processing_step = ("start", 2)
+        journal_mgr.save_state()
+        with open(tmp_path / "state.json.journal", "a") as f:
+            f.write('{"seq": 99, "op": "put", "sec')
+
+        restored = self.reopen(tmp_path)
+        restored.ctx.instances[inst.uuid].processing_step = ("start", 3)
+        restored.save_state()
+        assert all(json.loads(line) for line in self.journal_lines(tmp_path))
+        assert self.reopen(tmp_path).ctx.instances[inst.uuid].processing_step == ("start", 3)
+
+    def test_records_already_in_the_snapshot_are_not_replayed(self, journal_mgr, tmp_path):
+        wf = make_workflow(journal_mgr, "wf-1")
+        inst = wf.spawn_instance()
+        journal_mgr.save_state()
+        inst.processing_step = ("start", 1)
+        journal_mgr.save_state()
+        stale_journal = (tmp_path / "state.json.journal").read_text()
+        inst.processing_step = ("start", 2)
+        journal_mgr._state_store.compact(journal_mgr._state_snapshot()[0])
+        # As if we crashed after writing the snapshot but before truncating the journal
+        (tmp_path / "state.json.journal").write_text(stale_journal)
+        assert self.reopen(tmp_path).ctx.instances[inst.uuid].processing_step == ("start", 2)
+
+    async def test_each_yield_can_be_appended_straight_away(self, journal_mgr, tmp_path):
+        journal_mgr.journal_each_yield = True
+        journal_mgr.save_coalesce_seconds = journal_mgr.save_max_latency_seconds = 3600
+        wf = make_workflow(journal_mgr, "wf-1")
+        wf.procedures["start"] = [
+            ProcessingStep("log", msg=String("stepped")),
+            ProcessingStep("yield_for_seconds", num_seconds=Integer(60)),
+        ]
+        inst = wf.spawn_instance()
+        journal_mgr.save_state()
+        await journal_mgr._run_one_instance(inst)
+        # Due straight away rather than after the hour long coalesce window
+        for _ in range(10):
+            if journal_mgr._save_task is not None:
+                break
+            await asyncio.sleep(0)
+        await journal_mgr._save_task
+        records = [json.loads(line) for line in self.journal_lines(tmp_path)]
+        assert [record["key"] for record in records] == [inst.uuid]
+        assert records[0]["data"]["processing_step"] == ["start", 2]
+
+    def test_export_to_another_file_is_plain_json(self, journal_mgr, tmp_path):
+        make_workflow(journal_mgr, "wf-1")
+        export_file = tmp_path / "export.json"
+        journal_mgr.save_state(str(export_file))
+        plain = PipelineManager()
+        plain.restore_state(str(export_file))
+        assert "wf-1" in plain.ctx.workflows
+
+
+# ---------------------------------------------------------------------------
+# SQLite backend
+# ---------------------------------------------------------------------------
+
+class TestSqliteBackend:
+    def open_mgr(self, tmp_path):
+        mgr = PipelineManager()
+        mgr.state_backend = "sqlite"
+        mgr.restore_state(str(tmp_path / "state.json"))
+        return mgr
+
+    def test_round_trip(self, tmp_path):
+        mgr = self.open_mgr(tmp_path)
+        wf = make_workflow(mgr, "wf-1", "Sqlite")
+        inst = wf.spawn_instance()
+        inst.variables["counter"] = Integer(7)
+        mgr.ctx.variables["shared"] = Float(3.14)
+        mgr.save_state()
+
+        restored = self.open_mgr(tmp_path)
+        assert restored.ctx.workflows["wf-1"].name == "Sqlite"
+        assert restored.ctx.instances[inst.uuid].variables["counter"].value == 7
+        assert restored.ctx.variables["shared"].value == 3.14
+        assert (tmp_path / "state.sqlite3").exists()
+        assert not (tmp_path / "state.json").exists()
+
+    def test_uses_wal_mode(self, tmp_path):
+        mgr = self.open_mgr(tmp_path)
+        journal_mode = mgr._state_store._connection.execute("PRAGMA journal_mode").fetchone()[0]
+        assert journal_mode == "wal"
+
+    def test_only_changed_rows_are_written(self, tmp_path):
+        mgr = self.open_mgr(tmp_path)
+        wf = make_workflow(mgr, "wf-1")
+        wf.spawn_instance()
+        busy = wf.spawn_instance()
+        mgr.save_state()
+        busy.processing_step = ("start", 2)
+        statements = []
+        mgr._state_store._connection.set_trace_callback(statements.append)
+        mgr.save_state()
+        writes = [s for s in statements if s.startswith("INSERT")]
+        assert len(writes) == 1
+        assert busy.uuid in writes[0]
+
+    def test_deleted_instances_are_removed(self, tmp_path):
+        mgr = self.open_mgr(tmp_path)
+        wf = make_workflow(mgr, "wf-1")
+        inst = wf.spawn_instance()
+        mgr.save_state()
+        del mgr.ctx.instances[inst.uuid]
+        mgr.save_state()
+        assert inst.uuid not in self.open_mgr(tmp_path).ctx.instances
+
+    def test_query_instances_by_workflow_and_state(self, tmp_path):
+        mgr = self.open_mgr(tmp_path)
+        wf_a = make_workflow(mgr, "wf-a")
+        wf_b = make_workflow(mgr, "wf-b")
+        broken = wf_a.spawn_instance()
+        broken.state = RunStates.Error
+        wf_a.spawn_instance()
+        wf_b.spawn_instance().state = RunStates.Error
+        mgr.save_state()
+        assert set(mgr._state_store.query_instances("wf-a", "Error")) == {broken.uuid}
+
+    def test_imports_an_existing_json_state_file(self, tmp_path):
+        plain = PipelineManager()
+        make_workflow(plain, "wf-1", "From JSON")
+        plain.save_state(str(tmp_path / "state.json"))
+
+        mgr = self.open_mgr(tmp_path)
+        assert mgr.ctx.workflows["wf-1"].name == "From JSON"
+        mgr.save_state()
+        (tmp_path / "state.json").unlink()
+        assert self.open_mgr(tmp_path).ctx.workflows["wf-1"].name == "From JSON"
+
+    def test_json_state_file_is_imported_only_once(self, tmp_path):
+        plain = PipelineManager()
+        make_workflow(plain, "wf-1", "From JSON")
+        plain.save_state(str(tmp_path / "state.json"))
+
+        mgr = self.open_mgr(tmp_path)
+        mgr.save_state()
+        # Emptied on purpose, with the old JSON state file still lying next to it
+        del mgr.ctx.workflows["wf-1"]
+        mgr.save_state()
+        assert (tmp_path / "state.json").exists()
+        assert self.open_mgr(tmp_path).ctx.workflows == {}
+
+    def test_export_and_import_json(self, tmp_path):
+        mgr = self.open_mgr(tmp_path)
+        make_workflow(mgr, "wf-1", "Exported")
+        mgr.export_state(str(tmp_path / "export.json"))
+
+        other = PipelineManager()
+        other.state_backend = "sqlite"
+        other.restore_state(str(tmp_path / "other.json"))
+        other.import_state(str(tmp_path / "export.json"))
+        assert other.ctx.workflows["wf-1"].name == "Exported"
+        reopened = PipelineManager()
+        reopened.state_backend = "sqlite"
+        reopened.restore_state(str(tmp_path / "other.json"))
+        assert reopened.ctx.workflows["wf-1"].name == "Exported"
@@ -0,0 +1,168 @@
+"""Tests for compiling workflow procedures into the plans the ProcedureRunner executes."""
+import pytest
+
+from pipeline_backend.commands import Commands, CommandReturnStatus
+from pipeline_backend.instances import Instance
+from pipeline_backend.plans import WorkflowCompileError, compile_workflow
+from pipeline_backend.procedure_runner import ProcedureRunner
+from pipeline_backend.variables import String, Integer, VariablePath
+from pipeline_backend.workflows import Workflow, RunStates, ProcessingStep
+from pipeline_backend.manager import PipelineManager
+
+
+@pytest.fixture
+def workflow(mgr):
+    wf = Workflow(mgr.ctx)
+    wf.uuid = "wf-plan-test"
+    wf.name = "Plan Test"
+    mgr.ctx.workflows[wf.uuid] = wf
+    return wf
+
+
+class TestCompile:
+    def test_literals_and_paths_are_told_apart(self, workflow):
+        workflow.procedures["start"] = [
+            ProcessingStep("math_add", first=String("2"), second=VariablePath("counter"), output_variable=VariablePath("out")),
+        ]
+        step = compile_workflow(workflow).procedures["start"][0]
+        first, second, output = step.arguments
+        # Coerced once while compiling rather than on every run
+        assert type(first.literal) == Integer and first.literal.value == 2
+        assert second.literal is None and second.path.value == "counter"
+        # The command wants the VariablePath itself, so it is a literal
+        assert output.literal.value == "out" and output.path is None
+
+    def test_unknown_command_is_rejected(self, workflow):
+        workflow.procedures["start"] = [ProcessingStep("no_such_command_exists")]
+        with pytest.raises(WorkflowCompileError, match="no_such_command_exists"):
+            compile_workflow(workflow)
+
+    def test_wrong_arity_is_rejected(self, workflow):
+        workflow.procedures["start"] = [ProcessingStep("log")]
+        with pytest.raises(WorkflowCompileError, match="Inconsistent number of variables"):
+            compile_workflow(workflow)
+
+    def test_unconvertible_literal_is_rejected(self, workflow):
+        workflow.procedures["start"] = [
+            ProcessingStep("yield_for_seconds", num_seconds=String("soon")),
+        ]
+        with pytest.raises(WorkflowCompileError, match="Unable to convert argument num_seconds"):
+            compile_workflow(workflow)
+
+    def test_jump_to_missing_procedure_is_rejected(self, workflow):
+        workflow.procedures["start"] = [
+            ProcessingStep("jump_to_procedure", procedure_name=String("nowhere")),
+        ]
+        with pytest.raises(WorkflowCompileError, match="nowhere"):
+            compile_workflow(workflow)
+
+    def test_jump_through_a_variable_is_checked_at_run_time(self, workflow):
+        workflow.procedures["start"] = [
+            ProcessingStep("jump_to_procedure", procedure_name=VariablePath("target")),
+        ]
+        compile_workflow(workflow)
+
+
+    def test_step_timeout_overrides_the_commands(self, workflow):
+        @Commands.register_command(category="Test", timeout_seconds=60)
+        async def plan_test_timeout(instance: Instance) -> CommandReturnStatus:
+            return CommandReturnStatus.Success
+
+        step = ProcessingStep("plan_test_timeout")
+        workflow.procedures["start"] = [step]
+        try:
+            assert compile_workflow(workflow).procedures["start"][0].timeout_seconds == 60
+            step.timeout_seconds = 5
+            assert compile_workflow(workflow).procedures["start"][0].timeout_seconds == 5
+            # 0 turns it off for the step
+            step.timeout_seconds = 0
+            assert compile_workflow(workflow).procedures["start"][0].timeout_seconds is None
+        finally:
+            for registry in (Commands.commands, Commands.categories, Commands.descriptors):
+                registry.pop("plan_test_timeout")
+
+    def test_sync_step_cannot_have_a_timeout(self, workflow):
+        step = ProcessingStep("log", msg=String("hi"))
+        step.timeout_seconds = 5
+        workflow.procedures["start"] = [step]
+        with pytest.raises(WorkflowCompileError, match="cannot be given a timeout"):
+            compile_workflow(workflow)
+
+
+class TestPlanCache:
+    def test_plan_is_reused(self, workflow):
+        workflow.procedures["start"] = [ProcessingStep("log", msg=String("hi"))]
+        assert workflow.compiled_plan() is workflow.compiled_plan()
+
+    def test_changing_the_procedures_recompiles(self, workflow):
+        workflow.procedures["start"] = [ProcessingStep("log", msg=String("hi"))]
+        plan = workflow.compiled_plan()
+        workflow.procedures["start"] = [ProcessingStep("log", msg=String("bye"))]
+        assert workflow.compiled_plan() is not plan
+        assert workflow.compiled_plan().procedures["start"][0].arguments[0].literal.value == "bye"
+
+    def test_registering_a_command_recompiles(self, workflow):
+        workflow.procedures["start"] = [ProcessingStep("plan_test_late_command")]
+        with pytest.raises(WorkflowCompileError):
+            workflow.compiled_plan()
+
+        @Commands.register_command(category="Test")
+        def plan_test_late_command(instance: Instance) -> CommandReturnStatus:
+            return CommandReturnStatus.Success
+
+        try:
+            assert workflow.compiled_plan().procedures["start"][0].command.fn is plan_test_late_command
+        finally:
+            for registry in (Commands.commands, Commands.categories, Commands.descriptors):
+                registry.pop("plan_test_late_command")
+
+
+class TestRejection:
+    async def test_bad_step_anywhere_stops_the_workflow_before_running(self, workflow):
+        workflow.procedures["start"] = [ProcessingStep("log", msg=String("never logged"))]
+        workflow.procedures["unused"] = [ProcessingStep("no_such_command_exists")]
+        inst = workflow.spawn_instance()
+        result = await ProcedureRunner(inst).run_single_step()
+        assert CommandReturnStatus.Keep_Position in result
+        assert inst.state == RunStates.Running
+        assert workflow.state == RunStates.Running
+        assert inst.processing_step == ("start", 0)
+        assert "no_such_command_exists" in workflow.compile_error
+        assert not inst.is_allowed_to_run()
+        assert "never logged" not in inst.console_log
+
+    def test_invalid_workflow_is_held_back_on_load(self, mgr, workflow, tmp_path):
+        workflow.procedures["start"] = [ProcessingStep("no_such_command_exists")]
+        inst = workflow.spawn_instance()
+        state_file = str(tmp_path / "state.json")
+        mgr.save_state(state_file)
+        restored = PipelineManager()
+        restored.restore_state(state_file)
+        restored_workflow = restored.ctx.workflows["wf-plan-test"]
+        assert "no_such_command_exists" in restored_workflow.compile_error
+        assert not restored.ctx.instances[inst.uuid].is_allowed_to_run()
+
+    def test_workflow_runs_again_once_its_command_is_back(self, mgr, workflow, tmp_path):
+        workflow.procedures["start"] = [ProcessingStep("plan_test_addon_command")]
+        inst = workflow.spawn_instance()
+        state_file = str(tmp_path / "state.json")
+        mgr.save_state(state_file)
+        # The addon failed to load, and the state is saved again while it is missing
+        restored = PipelineManager()
+        restored.restore_state(state_file)
+        restored.save_state()
+
+        @Commands.register_command(category="Test")
+        def plan_test_addon_command(instance: Instance) -> CommandReturnStatus:
+            return CommandReturnStatus.Success
+
+        try:
+            reloaded = PipelineManager()
+            reloaded.restore_state(state_file)
+            reloaded_workflow = reloaded.ctx.workflows["wf-plan-test"]
+            assert reloaded_workflow.state == RunStates.Running
+            assert reloaded_workflow.compile_error is None
+            assert reloaded.ctx.instances[inst.uuid].is_allowed_to_run()
+        finally:
+            for registry in (Commands.commands, Commands.categories, Commands.descriptors):
+                registry.pop("plan_test_addon_command")
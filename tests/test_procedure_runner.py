@@ -1,6 +1,12 @@
+import asyncio
+import threading
+import time
 import pytest
-from pipeline_backend.procedure_runner import ProcedureRunner
-from pipeline_backend.commands import CommandReturnStatus
+from datetime import datetime, timedelta
+from unittest.mock import patch
+from pipeline_backend import procedure_runner
+from pipeline_backend.procedure_runner import ProcedureRunner, run_blocking
+from pipeline_backend.commands import Commands, CommandReturnStatus
 from pipeline_backend.workflows import Workflow, RunStates, ProcessingStep
 from pipeline_backend.instances import Instance
 from pipeline_backend.variables import String, Integer, Float, VariablePath
@@ -81,27 +87,31 @@ class TestErrorConditions:
         assert CommandReturnStatus.Error in result
         assert inst.state == RunStates.Error
 
-    async def test_unknown_command_marks_error(self, workflow):
+    async def test_unknown_command_holds_the_workflow_back(self, workflow):
         workflow.procedures["start"] = [
             ProcessingStep("no_such_command_exists"),
         ]
         inst = workflow.spawn_instance()
         runner = ProcedureRunner(inst)
         result = await runner.run_single_step()
-        assert CommandReturnStatus.Error in result
-        assert inst.state == RunStates.Error
+        assert CommandReturnStatus.Keep_Position in result
+        assert inst.state == RunStates.Running
+        assert workflow.compile_error
+        assert not inst.is_allowed_to_run()
 
-    async def test_empty_command_name_marks_error(self, workflow):
+    async def test_empty_command_name_holds_the_workflow_back(self, workflow):
         workflow.procedures["start"] = [
             ProcessingStep(),  # command_name defaults to ""
         ]
         inst = workflow.spawn_instance()
         runner = ProcedureRunner(inst)
         result = await runner.run_single_step()
-        assert CommandReturnStatus.Error in result
-        assert inst.state == RunStates.Error
+        assert CommandReturnStatus.Keep_Position in result
+        assert inst.state == RunStates.Running
+        assert workflow.compile_error
+        assert not inst.is_allowed_to_run()
 
-    async def test_wrong_arg_count_marks_error(self, workflow):
+    async def test_wrong_arg_count_holds_the_workflow_back(self, workflow):
         # log expects one arg (msg), passing none
         workflow.procedures["start"] = [
             ProcessingStep("log"),
@@ -109,8 +119,10 @@ class TestErrorConditions:
         inst = workflow.spawn_instance()
         runner = ProcedureRunner(inst)
         result = await runner.run_single_step()
-        assert CommandReturnStatus.Error in result
-        assert inst.state == RunStates.Error
+        assert CommandReturnStatus.Keep_Position in result
+        assert inst.state == RunStates.Running
+        assert workflow.compile_error
+        assert not inst.is_allowed_to_run()
 
     async def test_orphan_instance_marks_error(self, mgr):
         inst = Instance(mgr.ctx)
@@ -146,7 +158,7 @@ class TestMathEdgeCases:
         assert CommandReturnStatus.Error in result
         assert inst.state == RunStates.Error
 
-    async def test_string_arg_to_math_add_marks_error(self, workflow):
+    async def test_string_arg_to_math_add_holds_the_workflow_back(self, workflow):
         # String cannot be coerced to Integer|Float, runner should reject it
         workflow.procedures["start"] = [
             ProcessingStep("math_add",
@@ -157,8 +169,10 @@ class TestMathEdgeCases:
         inst = workflow.spawn_instance()
         runner = ProcedureRunner(inst)
         result = await runner.run_single_step()
-        assert CommandReturnStatus.Error in result
-        assert inst.state == RunStates.Error
+        assert CommandReturnStatus.Keep_Position in result
+        assert inst.state == RunStates.Running
+        assert workflow.compile_error
+        assert not inst.is_allowed_to_run()
 
 
 class TestVariableResolution:
@@ -205,7 +219,7 @@ class TestVariableResolution:
         assert CommandReturnStatus.Success in result
         assert "42" in inst.console_log
 
-    async def test_incompatible_type_marks_error(self, workflow):
+    async def test_incompatible_type_holds_the_workflow_back(self, workflow):
         # yield_for_seconds needs Integer|Float; String("abc") cannot be coerced
         workflow.procedures["start"] = [
             ProcessingStep("yield_for_seconds", num_seconds=String("not a number")),
@@ -213,8 +227,10 @@ class TestVariableResolution:
         inst = workflow.spawn_instance()
         runner = ProcedureRunner(inst)
         result = await runner.run_single_step()
-        assert CommandReturnStatus.Error in result
-        assert inst.state == RunStates.Error
+        assert CommandReturnStatus.Keep_Position in result
+        assert inst.state == RunStates.Running
+        assert workflow.compile_error
+        assert not inst.is_allowed_to_run()
 
     async def test_missing_variable_name_marks_error(self, workflow):
         # VariablePath pointing to a var that doesn't exist anywhere
@@ -226,3 +242,233 @@ class TestVariableResolution:
         result = await runner.run_single_step()
         assert CommandReturnStatus.Error in result
         assert inst.state == RunStates.Error
+
+
+class TestSlices:
+    @pytest.fixture
+    def looping(self, workflow):
+        workflow.procedures["start"] = [
+            ProcessingStep("log", msg=String("looping")),
+            ProcessingStep("jump_to_procedure", procedure_name=String("start")),
+        ]
+        return workflow
+
+    async def test_step_budget_ends_the_slice(self, looping):
+        inst = looping.spawn_instance()
+        inst.next_processing_time = datetime.now() - timedelta(hours=1)
+        finished = await ProcedureRunner(inst).run_instance_until_yield(max_steps=10, max_seconds=0)
+        assert finished is False
+        assert inst.console_log.count("looping") == 5
+        assert inst.state == RunStates.Running
+        # Left due, but behind anything that was already waiting
+        assert datetime.now() - timedelta(seconds=5) < inst.next_processing_time <= datetime.now()
+
+    async def test_one_pause_does_not_end_a_slice_at_the_default_budget(self, workflow):
+        @Commands.register_command(category="Test")
+        def runner_test_pause(instance: Instance) -> CommandReturnStatus:
+            # Standing in for a garbage collection pause that outlasts the whole budget
+            time.sleep(procedure_runner.SLICE_MAX_SECONDS * 2)
+            return CommandReturnStatus.Success
+
+        try:
+            workflow.procedures["start"] = [
+                ProcessingStep("log", msg=String("before")),
+                ProcessingStep("runner_test_pause"),
+                ProcessingStep("log", msg=String("after")),
+                ProcessingStep("yield_for_seconds", num_seconds=Integer(60)),
+            ]
+            inst = workflow.spawn_instance()
+            assert await ProcedureRunner(inst).run_instance_until_yield() is True
+            assert "after" in inst.console_log
+        finally:
+            for registry in (Commands.commands, Commands.categories, Commands.descriptors):
+                registry.pop("runner_test_pause")
+
+    async def test_time_budget_ends_the_slice(self, looping):
+        inst = looping.spawn_instance()
+        finished = await ProcedureRunner(inst).run_instance_until_yield(max_steps=0, max_seconds=0.01)
+        assert finished is False
+        assert inst.console_log_line_count > 0
+
+    async def test_yielding_within_the_budget_finishes(self, workflow):
+        workflow.procedures["start"] = [
+            ProcessingStep("log", msg=String("once")),
+            ProcessingStep("yield_for_seconds", num_seconds=Integer(60)),
+        ]
+        inst = workflow.spawn_instance()
+        assert await ProcedureRunner(inst).run_instance_until_yield(max_steps=10) is True
+        assert inst.next_processing_time > datetime.now()
+
+    async def test_sliced_instance_lets_a_waiting_one_run(self, mgr, looping):
+        mgr.max_running_instances = 1
+        poller = Workflow(mgr.ctx)
+        poller.uuid = "wf-poller"
+        poller.procedures["start"] = [ProcessingStep("pause_this_instance")]
+        mgr.ctx.workflows[poller.uuid] = poller
+        heavy = looping.spawn_instance()
+        heavy.next_processing_time = datetime.now() - timedelta(seconds=10)
+        waiting = poller.spawn_instance()
+        waiting.next_processing_time = datetime.now() - timedelta(seconds=5)
+
+        with patch("pipeline_backend.procedure_runner.SLICE_MAX_STEPS", 10), \
+             patch.object(mgr, 'request_save'), patch.object(mgr, 'notify_of_something_happening'):
+            await mgr.run_due_instances()
+            assert list(mgr._running_instance_tasks) == [heavy.uuid]
+            await asyncio.gather(*mgr._running_instance_tasks.values())
+            await mgr.run_due_instances()
+            assert list(mgr._running_instance_tasks) == [waiting.uuid]
+            await asyncio.gather(*mgr._running_instance_tasks.values())
+        assert waiting.state == RunStates.Paused
+
+
+class TestBlockingCommands:
+    @pytest.fixture
+    def blocking_command(self):
+        calls = []
+
+        def sleep(seconds: float) -> None:
+            calls.append(threading.current_thread().name)
+            time.sleep(seconds)
+
+        @Commands.register_command(category="Test")
+        async def runner_test_blocking(instance: Instance, seconds: Float) -> CommandReturnStatus:
+            await run_blocking(sleep, seconds.value)
+            return CommandReturnStatus.Success
+
+        yield calls
+        for registry in (Commands.commands, Commands.categories, Commands.descriptors):
+            registry.pop("runner_test_blocking")
+
+    async def test_runs_in_a_thread_without_stalling_the_loop(self, workflow, blocking_command):
+        workflow.procedures["start"] = [ProcessingStep("runner_test_blocking", seconds=Float(0.1))]
+        inst = workflow.spawn_instance()
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        ticking = asyncio.create_task(ticker())
+        result = await ProcedureRunner(inst).run_single_step()
+        ticking.cancel()
+        assert CommandReturnStatus.Success in result
+        assert blocking_command[0].startswith("blocking-command")
+        assert ticks >= 5
+
+    async def test_time_spent_is_recorded(self, workflow, blocking_command):
+        workflow.procedures["start"] = [ProcessingStep("runner_test_blocking", seconds=Float(0.02))]
+        inst = workflow.spawn_instance()
+        await ProcedureRunner(inst).run_single_step()
+        stats = Commands.get_command_descriptor("runner_test_blocking").stats
+        assert stats.calls == 1
+        assert stats.max_seconds >= 0.02
+
+    async def test_async_commands_hand_just_the_slow_call_to_a_thread(self, workflow):
+        threads = []
+
+        @Commands.register_command(category="Test")
+        async def runner_test_run_blocking(instance: Instance, seconds: Float) -> CommandReturnStatus:
+            await run_blocking(time.sleep, seconds.value)
+            threads.append(threading.current_thread().name)
+            instance.log_line("slept")
+            return CommandReturnStatus.Success
+
+        try:
+            workflow.procedures["start"] = [ProcessingStep("runner_test_run_blocking", seconds=Float(0.02))]
+            inst = workflow.spawn_instance()
+            await ProcedureRunner(inst).run_single_step()
+            stats = Commands.get_command_descriptor("runner_test_run_blocking").stats
+            assert threads == [threading.current_thread().name]
+            assert "slept" in inst.console_log
+            assert stats.calls == 1
+            assert stats.max_seconds >= 0.02
+        finally:
+            for registry in (Commands.commands, Commands.categories, Commands.descriptors):
+                registry.pop("runner_test_run_blocking")
+
+    async def test_sync_commands_on_the_loop_are_timed_too(self, workflow):
+        workflow.procedures["start"] = [ProcessingStep("log", msg=String("timed"))]
+        stats = Commands.get_command_descriptor("log").stats
+        calls = stats.calls
+        await ProcedureRunner(workflow.spawn_instance()).run_single_step()
+        assert stats.calls == calls + 1
+
+
+class TestTimeouts:
+    @pytest.fixture
+    def hanging_command(self):
+        @Commands.register_command(category="Test", timeout_seconds=0.05)
+        async def runner_test_hang(instance: Instance, seconds: Float) -> CommandReturnStatus:
+            await asyncio.sleep(seconds.value)
+            return CommandReturnStatus.Success
+
+        yield
+        for registry in (Commands.commands, Commands.categories, Commands.descriptors):
+            registry.pop("runner_test_hang")
+
+    async def test_timed_out_step_is_retried_after_a_backoff(self, workflow, hanging_command):
+        workflow.procedures["start"] = [ProcessingStep("runner_test_hang", seconds=Float(10))]
+        inst = workflow.spawn_instance()
+        before = datetime.now()
+        result = await ProcedureRunner(inst).run_single_step()
+        assert CommandReturnStatus.Yield in result and CommandReturnStatus.Keep_Position in result
+        assert inst.state == RunStates.Running
+        assert inst.processing_step == ("start", 0)
+        # 30 seconds give or take the jitter
+        assert before + timedelta(seconds=23) <= inst.next_processing_time <= datetime.now() + timedelta(seconds=37)
+        assert "did not finish within 0.05 seconds" in inst.console_log
+
+    async def test_backoff_doubles_then_gives_up(self, workflow, hanging_command):
+        workflow.procedures["start"] = [ProcessingStep("runner_test_hang", seconds=Float(10))]
+        inst = workflow.spawn_instance()
+        runner = ProcedureRunner(inst)
+        await runner.run_single_step()
+        first = inst.next_processing_time
+        await runner.run_single_step()
+        # Doubled to 60 seconds, which even at the far ends of the jitter is later than the first
+        assert inst.next_processing_time - first >= timedelta(seconds=10)
+        await runner.run_single_step()
+        assert inst.state == RunStates.Running
+        result = await runner.run_single_step()
+        assert result == CommandReturnStatus.Error
+        assert inst.state == RunStates.Error
+
+    async def test_a_finished_step_resets_the_count(self, workflow, hanging_command):
+        workflow.procedures["start"] = [ProcessingStep("runner_test_hang", seconds=Float(10))]
+        inst = workflow.spawn_instance()
+        await ProcedureRunner(inst).run_single_step()
+        assert inst.retry_attempts == 1
+        workflow.procedures["start"] = [ProcessingStep("runner_test_hang", seconds=Float(0))]
+        await ProcedureRunner(inst).run_single_step()
+        assert inst.retry_attempts == 0
+
+    async def test_step_can_lift_the_timeout(self, workflow, hanging_command):
+        step = ProcessingStep("runner_test_hang", seconds=Float(0.1))
+        step.timeout_seconds = 0
+        workflow.procedures["start"] = [step]
+        inst = workflow.spawn_instance()
+        assert CommandReturnStatus.Success in await ProcedureRunner(inst).run_single_step()
+
+    async def test_a_timeout_raised_by_the_command_is_an_error(self, workflow):
+        @Commands.register_command(category="Test", timeout_seconds=60)
+        async def runner_test_own_timeout(instance: Instance) -> CommandReturnStatus:
+            raise TimeoutError("the server said so")
+
+        try:
+            workflow.procedures["start"] = [ProcessingStep("runner_test_own_timeout")]
+            inst = workflow.spawn_instance()
+            assert await ProcedureRunner(inst).run_single_step() == CommandReturnStatus.Error
+            assert "the server said so" in inst.console_log
+        finally:
+            for registry in (Commands.commands, Commands.categories, Commands.descriptors):
+                registry.pop("runner_test_own_timeout")
+
+    def test_step_timeout_is_saved_only_when_set(self):
+        step = ProcessingStep("log", msg=String("hi"))
+        assert "timeout_seconds" not in step.json_savable()
+        step.timeout_seconds = 12.5
+        loaded = ProcessingStep()
+        loaded.json_loadable(step.json_savable())
+        assert loaded.timeout_seconds == 12.5
@@ -0,0 +1,173 @@
+"""Tests for the retry policies the ProcedureRunner applies when a command raises."""
+import sys
+import xmlrpc.client
+from datetime import datetime, timedelta
+import pytest
+
+from pipeline_backend.commands import Commands, CommandReturnStatus
+from pipeline_backend.instances import Instance
+from pipeline_backend.procedure_runner import ProcedureRunner
+from pipeline_backend.retries import RetryPolicy, register_exception
+from pipeline_backend.variables import String
+from pipeline_backend.workflows import Workflow, RunStates, ProcessingStep
+
+
+class RetryTestError(Exception):
+    pass
+
+
+@pytest.fixture
+def workflow(mgr):
+    wf = Workflow(mgr.ctx)
+    wf.uuid = "wf-retry-test"
+    wf.name = "Retry Test"
+    mgr.ctx.workflows[wf.uuid] = wf
+    return wf
+
+
+@pytest.fixture
+def flaky_command():
+    """A command that raises whatever is queued up in errors, and succeeds once they run out."""
+    errors = []
+
+    @Commands.register_command(category="Test", retry_policy=RetryPolicy(max_attempts=3, backoff_seconds=10, jitter=0, retry_on=(ConnectionError,)))
+    async def retry_test_flaky(instance: Instance) -> CommandReturnStatus:
+        if errors:
+            raise errors.pop(0)
+        return CommandReturnStatus.Success
+
+    yield errors
+    for registry in (Commands.commands, Commands.categories, Commands.descriptors):
+        registry.pop("retry_test_flaky")
+
+
+class TestPolicy:
+    def test_only_listed_exceptions_are_retried(self):
+        policy = RetryPolicy(retry_on=(OSError,))
+        assert policy.should_retry(ConnectionResetError(), 1)
+        assert not policy.should_retry(ValueError(), 1)
+
+    def test_attempts_run_out(self):
+        policy = RetryPolicy(max_attempts=3)
+        assert policy.should_retry(OSError(), 2)
+        assert not policy.should_retry(OSError(), 3)
+        assert RetryPolicy(max_attempts=0).should_retry(OSError(), 1000)
+
+    def test_backoff_grows_up_to_the_cap(self):
+        policy = RetryPolicy(backoff_seconds=10, multiplier=2, max_backoff_seconds=35, jitter=0)
+        assert [policy.backoff_for(n) for n in (1, 2, 3, 4)] == [10, 20, 35, 35]
+
+    def test_jitter_spreads_the_backoff(self):
+        policy = RetryPolicy(backoff_seconds=100, jitter=0.2)
+        backoffs = {policy.backoff_for(1) for _ in range(50)}
+        assert all(80 <= backoff <= 120 for backoff in backoffs)
+        assert len(backoffs) > 1
+
+    def test_json_round_trip(self):
+        register_exception(xmlrpc.client.ProtocolError)
+        policy = RetryPolicy(max_attempts=7, backoff_seconds=5, retry_on=(OSError, xmlrpc.client.ProtocolError))
+        data = policy.json_savable()
+        assert data["retry_on"] == ["OSError", "xmlrpc.client.ProtocolError"]
+        restored = RetryPolicy.from_json(data)
+        assert restored.max_attempts == 7 and restored.backoff_seconds == 5
+        assert restored.retry_on == (OSError, xmlrpc.client.ProtocolError)
+
+    def test_unknown_exception_names_are_kept_but_not_imported(self):
+        restored = RetryPolicy.from_json({"retry_on": ["OSError", "NoSuchError", "os.path", "this.Error", "print"]})
+        assert restored.retry_on == (OSError,)
+        assert restored.unknown_exceptions == ("NoSuchError", "os.path", "this.Error", "print")
+        assert "this" not in sys.modules
+        assert restored.json_savable()["retry_on"] == ["OSError", "NoSuchError", "os.path", "this.Error", "print"]
+
+    def test_command_policies_register_their_exceptions(self):
+        name = f"{__name__}.RetryTestError"
+        assert RetryPolicy.from_json({"retry_on": [name]}).unknown_exceptions == (name,)
+
+        @Commands.register_command(category="Test", retry_policy=RetryPolicy(retry_on=(RetryTestError,)))
+        async def retry_test_registering(instance: Instance) -> CommandReturnStatus:
+            return CommandReturnStatus.Success
+
+        try:
+            assert RetryPolicy.from_json({"retry_on": [name]}).retry_on == (RetryTestError,)
+        finally:
+            for registry in (Commands.commands, Commands.categories, Commands.descriptors):
+                registry.pop("retry_test_registering")
+
+    def test_unknown_exception_holds_the_workflow_back(self, workflow):
+        step = ProcessingStep("log", msg=String("hi"))
+        step.retry_policy = RetryPolicy.from_json({"retry_on": ["webautotender_addons.missing.Error"]})
+        workflow.procedures["start"] = [step]
+        assert not workflow.compile()
+        assert "webautotender_addons.missing.Error" in workflow.compile_error
+
+
+class TestRunner:
+    async def test_listed_exception_is_retried_after_the_backoff(self, workflow, flaky_command):
+        workflow.procedures["start"] = [ProcessingStep("retry_test_flaky")]
+        inst = workflow.spawn_instance()
+        flaky_command.append(ConnectionRefusedError("down"))
+        before = datetime.now()
+        result = await ProcedureRunner(inst).run_single_step()
+        assert result == CommandReturnStatus.Yield | CommandReturnStatus.Keep_Position
+        assert inst.retry_attempts == 1
+        assert inst.next_processing_time >= before + timedelta(seconds=10)
+        assert "Attempt 1 of 3 at retry_test_flaky failed - ConnectionRefusedError: down" in inst.console_log
+
+        result = await ProcedureRunner(inst).run_single_step()
+        assert CommandReturnStatus.Success in result
+        assert inst.retry_attempts == 0
+        assert inst.processing_step == ("start", 1)
+
+    async def test_gives_up_after_max_attempts(self, workflow, flaky_command):
+        workflow.procedures["start"] = [ProcessingStep("retry_test_flaky")]
+        inst = workflow.spawn_instance()
+        flaky_command.extend(ConnectionResetError() for _ in range(3))
+        runner = ProcedureRunner(inst)
+        await runner.run_single_step()
+        await runner.run_single_step()
+        assert inst.state == RunStates.Running
+        assert await runner.run_single_step() == CommandReturnStatus.Error
+        assert inst.state == RunStates.Error
+        assert "giving up after 3 attempt(s)" in inst.console_log
+        assert inst.retry_attempts == 0
+
+    async def test_other_exceptions_are_an_error_straight_away(self, workflow, flaky_command):
+        workflow.procedures["start"] = [ProcessingStep("retry_test_flaky")]
+        inst = workflow.spawn_instance()
+        flaky_command.append(ValueError("bad data"))
+        assert await ProcedureRunner(inst).run_single_step() == CommandReturnStatus.Error
+        assert "bad data" in inst.console_log
+
+    async def test_step_policy_overrides_the_commands(self, workflow, flaky_command):
+        step = ProcessingStep("retry_test_flaky")
+        step.retry_policy = RetryPolicy(max_attempts=2, jitter=0, retry_on=(ValueError,))
+        workflow.procedures["start"] = [step]
+        inst = workflow.spawn_instance()
+        flaky_command.append(ValueError())
+        assert CommandReturnStatus.Keep_Position in await ProcedureRunner(inst).run_single_step()
+        flaky_command.append(ConnectionResetError())
+        assert await ProcedureRunner(inst).run_single_step() == CommandReturnStatus.Error
+
+    async def test_retry_count_is_saved_with_the_instance(self, mgr, workflow, flaky_command):
+        workflow.procedures["start"] = [ProcessingStep("retry_test_flaky")]
+        inst = workflow.spawn_instance()
+        flaky_command.append(ConnectionResetError())
+        await ProcedureRunner(inst).run_single_step()
+        restored = Instance(mgr.ctx)
+        restored.json_loadable(inst.json_savable())
+        assert restored.retry_attempts == 1
+
+    def test_state_from_before_retries_loads(self, mgr, workflow):
+        data = workflow.spawn_instance().json_savable()
+        del data["retry_attempts"]
+        restored = Instance(mgr.ctx)
+        restored.json_loadable(data)
+        assert restored.retry_attempts == 0
+
+    def test_step_policy_is_saved_with_the_step(self):
+        step = ProcessingStep("retry_test_flaky")
+        assert "retry_policy" not in step.json_savable()
+        step.retry_policy = RetryPolicy(max_attempts=9)
+        restored = ProcessingStep()
+        restored.json_loadable(step.json_savable())
+        assert restored.retry_policy.max_attempts == 9
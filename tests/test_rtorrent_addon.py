@@ -2,34 +2,46 @@ import asyncio
 import threading
 import time
 import xmlrpc.client
+from datetime import datetime, timedelta
+import pytest
 
 from builtin_addons import rtorrent
 from pipeline_backend.commands import CommandReturnStatus
 from pipeline_backend.instances import Instance
 from pipeline_backend.manager import PipelineManager
+from pipeline_backend.procedure_runner import ProcedureRunner
 from pipeline_backend.variables import Dictionary, Float, String, VariablePath
+from pipeline_backend.workflows import Workflow, ProcessingStep, RunStates
 
 
 class FakeConnection:
-    def __init__(self, ratio=0, delay=0.0, tracker=None, filepaths=None, require_list_multicall=False):
-        self.d = FakeDownloadMethods(ratio, delay, tracker)
+    def __init__(self, torrents=None, delay=0.0, tracker=None, filepaths=None, require_list_multicall=False, error=None):
+        self.d = FakeDownloadMethods(torrents or {}, delay, tracker, error)
         self.f = FakeFileMethods(filepaths or [], require_list_multicall)
 
 
 class FakeDownloadMethods:
-    def __init__(self, ratio, delay, tracker):
-        self.ratio_value = ratio
+    def __init__(self, torrents, delay, tracker, error=None):
+        # infohash -> (complete, ratio), with the ratio as a float rather than rTorrent's thousandths
+        self.torrents = torrents
         self.delay = delay
         self.tracker = tracker
-
-    def ratio(self, infohash):
+        self.error = error
+        self.multicalls = 0
+
+    def multicall2(self, target, view, *fields):
+        assert fields == rtorrent.poller.MULTICALL_FIELDS
+        self.multicalls += 1
+        if self.error is not None:
+            raise self.error
         if self.tracker is not None:
             with self.tracker["lock"]:
                 self.tracker["active"] += 1
                 self.tracker["max_active"] = max(self.tracker["max_active"], self.tracker["active"])
         try:
             time.sleep(self.delay)
-            return self.ratio_value
+            return [[infohash, int(complete), int(ratio * 1000), f"{infohash} name", f"/downloads/{infohash}"]
+                    for infohash, (complete, ratio) in self.torrents.items()]
         finally:
             if self.tracker is not None:
                 with self.tracker["lock"]:
@@ -67,8 +79,16 @@ def patch_connection(monkeypatch, connection):
     )
 
 
+@pytest.fixture(autouse=True)
+def stop_pollers():
+    yield
+    for poller in rtorrent.status_pollers.values():
+        poller.stop()
+    rtorrent.status_pollers.clear()
+
+
 async def test_wait_until_ratio_does_not_block_event_loop(monkeypatch):
-    patch_connection(monkeypatch, FakeConnection(ratio=0, delay=0.05))
+    patch_connection(monkeypatch, FakeConnection({"HASH": (True, 0.0)}, delay=0.05))
 
     task = asyncio.create_task(rtorrent.rtorrent_wait_until_ratio(
         make_instance(),
@@ -85,12 +105,14 @@ async def test_wait_until_ratio_does_not_block_event_loop(monkeypatch):
 
 async def test_wait_until_ratio_serializes_calls_per_server(monkeypatch):
     tracker = {"active": 0, "max_active": 0, "lock": threading.Lock()}
-    patch_connection(monkeypatch, FakeConnection(ratio=0, delay=0.02, tracker=tracker))
+    connection = FakeConnection({"HASH-1": (True, 0.0), "HASH-2": (True, 0.0)}, delay=0.02, tracker=tracker)
+    patch_connection(monkeypatch, connection)
     server_info = make_server_info("https://serialized-test.invalid/xmlrpc")
+    ctx = PipelineManager().ctx
 
     results = await asyncio.gather(
-        rtorrent.rtorrent_wait_until_ratio(make_instance(), server_info, String("hash-1"), Float(5.0)),
-        rtorrent.rtorrent_wait_until_ratio(make_instance(), server_info, String("hash-2"), Float(5.0)),
+        rtorrent.rtorrent_wait_until_ratio(Instance(ctx), server_info, String("hash-1"), Float(5.0)),
+        rtorrent.rtorrent_wait_until_ratio(Instance(ctx), server_info, String("hash-2"), Float(5.0)),
     )
 
     assert results == [
@@ -98,6 +120,8 @@ async def test_wait_until_ratio_serializes_calls_per_server(monkeypatch):
         CommandReturnStatus.Yield | CommandReturnStatus.Keep_Position,
     ]
     assert tracker["max_active"] == 1
+    # Both read the one poll of the server
+    assert connection.d.multicalls == 1
 
 
 async def test_get_torrent_download_url_encodes_relative_file_path(monkeypatch):
@@ -150,3 +174,155 @@ async def test_get_torrent_download_url_falls_back_to_list_multicall(monkeypatch
 
     assert result == CommandReturnStatus.Success
     assert instance.variables["download_url"].value == "https://rtorrent.example/download/files/single.mkv"
+
+
+async def test_wait_until_ratio_keeps_retrying_while_the_server_is_down(mgr, monkeypatch):
+    patch_connection(monkeypatch, FakeConnection(error=ConnectionRefusedError("server down")))
+    wf = Workflow(mgr.ctx)
+    wf.uuid = "wf-rtorrent-retry"
+    wf.procedures["start"] = [ProcessingStep("rtorrent_wait_until_ratio",
+        serverInfo=make_server_info("https://retry-test.invalid/xmlrpc"), infohash=String("hash"), ratio=Float(1.0))]
+    mgr.ctx.workflows[wf.uuid] = wf
+    instance = wf.spawn_instance()
+
+    # Far past the attempts a policy would normally allow, it still is not an Error
+    for _ in range(8):
+        result = await ProcedureRunner(instance).run_single_step()
+        assert result == CommandReturnStatus.Yield | CommandReturnStatus.Keep_Position
+    assert instance.state == RunStates.Running
+    assert instance.retry_attempts == 8
+    assert "ConnectionRefusedError: server down" in instance.console_log
+
+
+@pytest.fixture
+def waiting_workflow(mgr):
+    wf = Workflow(mgr.ctx)
+    wf.uuid = "wf-rtorrent-poller"
+    mgr.ctx.workflows[wf.uuid] = wf
+    return wf
+
+
+def record_notifications(ctx) -> list:
+    calls = []
+
+    async def notify():
+        calls.append(True)
+
+    ctx.notify_of_something_happening = notify
+    return calls
+
+
+@pytest.fixture
+def notified(mgr):
+    return record_notifications(mgr.ctx)
+
+
+async def test_waits_on_one_server_share_one_poll(monkeypatch, waiting_workflow, notified):
+    connection = FakeConnection({f"HASH-{i}": (False, 0.0) for i in range(50)})
+    patch_connection(monkeypatch, connection)
+    server_info = make_server_info("https://shared-poll-test.invalid/xmlrpc")
+    results = await asyncio.gather(*(
+        rtorrent.rtorrent_wait_until_complete(waiting_workflow.spawn_instance(), server_info, String(f"hash-{i}"))
+        for i in range(50)
+    ))
+    assert set(results) == {CommandReturnStatus.Yield | CommandReturnStatus.Keep_Position}
+    assert connection.d.multicalls == 1
+
+
+async def test_poll_wakes_the_instance_once_its_torrent_completes(monkeypatch, waiting_workflow, notified):
+    connection = FakeConnection({"HASH": (False, 0.0), "OTHER": (False, 0.0)})
+    patch_connection(monkeypatch, connection)
+    server_info = make_server_info("https://wake-test.invalid/xmlrpc")
+    waiting, other = waiting_workflow.spawn_instance(), waiting_workflow.spawn_instance()
+    await rtorrent.rtorrent_wait_until_complete(waiting, server_info, String("HASH"))
+    await rtorrent.rtorrent_wait_until_complete(other, server_info, String("OTHER"))
+    assert waiting.next_processing_time > datetime.now() + timedelta(seconds=60)
+
+    connection.d.torrents["HASH"] = (True, 0.0)
+    poller = next(iter(rtorrent.status_pollers.values()))
+    await poller.refresh()
+    assert waiting.next_processing_time <= datetime.now()
+    assert other.next_processing_time > datetime.now() + timedelta(seconds=60)
+    assert notified == [True]
+    assert await rtorrent.rtorrent_wait_until_complete(waiting, server_info, String("HASH")) == CommandReturnStatus.Success
+
+
+async def test_ratio_wait_wakes_once_the_target_is_reached(monkeypatch, waiting_workflow, notified):
+    connection = FakeConnection({"HASH": (True, 0.4)})
+    patch_connection(monkeypatch, connection)
+    server_info = make_server_info("https://ratio-wake-test.invalid/xmlrpc")
+    instance = waiting_workflow.spawn_instance()
+    assert await rtorrent.rtorrent_wait_until_ratio(instance, server_info, String("HASH"), Float(1.0)) == CommandReturnStatus.Yield | CommandReturnStatus.Keep_Position
+    poller = next(iter(rtorrent.status_pollers.values()))
+    connection.d.torrents["HASH"] = (True, 0.9)
+    await poller.refresh()
+    assert notified == []
+    connection.d.torrents["HASH"] = (True, 1.2)
+    await poller.refresh()
+    assert notified == [True]
+    assert await rtorrent.rtorrent_wait_until_ratio(instance, server_info, String("HASH"), Float(1.0)) == CommandReturnStatus.Success
+
+
+async def test_malformed_row_is_skipped_and_polling_carries_on(monkeypatch, waiting_workflow, notified, capsys):
+    connection = FakeConnection({"HASH": (True, 0.0)})
+    good_rows = connection.d.multicall2
+    connection.d.multicall2 = lambda *args: [["BROKEN"], [None, 1, 0, "", ""]] + good_rows(*args)
+    patch_connection(monkeypatch, connection)
+    server_info = make_server_info("https://malformed-row-test.invalid/xmlrpc")
+    assert await rtorrent.rtorrent_wait_until_complete(waiting_workflow.spawn_instance(), server_info, String("HASH")) == CommandReturnStatus.Success
+    assert "Skipping a torrent status" in capsys.readouterr().out
+
+    poller = next(iter(rtorrent.status_pollers.values()))
+    connection.d.multicall2 = lambda *args: None
+    await poller.refresh()
+    assert isinstance(poller.error, TypeError)
+    connection.d.multicall2 = good_rows
+    await poller.refresh()
+    assert poller.error is None
+
+
+async def test_torrent_added_since_the_last_poll_is_fetched(monkeypatch, waiting_workflow, notified):
+    connection = FakeConnection({"HASH": (False, 0.0)})
+    patch_connection(monkeypatch, connection)
+    server_info = make_server_info("https://added-test.invalid/xmlrpc")
+    await rtorrent.rtorrent_wait_until_complete(waiting_workflow.spawn_instance(), server_info, String("HASH"))
+    connection.d.torrents["NEW"] = (True, 0.0)
+    assert await rtorrent.rtorrent_wait_until_complete(waiting_workflow.spawn_instance(), server_info, String("NEW")) == CommandReturnStatus.Success
+    assert connection.d.multicalls == 2
+
+
+async def test_torrent_missing_from_the_server_is_an_error(monkeypatch, waiting_workflow, notified):
+    patch_connection(monkeypatch, FakeConnection({"HASH": (False, 0.0)}))
+    instance = waiting_workflow.spawn_instance()
+    result = await rtorrent.rtorrent_wait_until_complete(instance, make_server_info("https://missing-test.invalid/xmlrpc"), String("GONE"))
+    assert result == CommandReturnStatus.Error
+    assert "Unable to find the torrent 'GONE'" in instance.console_log
+
+
+async def test_poll_interval_comes_from_the_server_info(monkeypatch, waiting_workflow, notified):
+    patch_connection(monkeypatch, FakeConnection({"HASH": (False, 0.0)}))
+    server_info = make_server_info("https://interval-test.invalid/xmlrpc")
+    server_info.value["poll interval seconds"] = Float(120.0)
+    await rtorrent.rtorrent_wait_until_complete(waiting_workflow.spawn_instance(), server_info, String("HASH"))
+    assert next(iter(rtorrent.status_pollers.values())).interval == 120.0
+
+
+async def test_each_pipeline_has_its_own_poller_and_is_woken_itself(monkeypatch, waiting_workflow, notified):
+    connection = FakeConnection({"HASH": (False, 0.0)})
+    patch_connection(monkeypatch, connection)
+    server_info = make_server_info("https://per-pipeline-test.invalid/xmlrpc")
+    other_mgr = PipelineManager()
+    other_workflow = Workflow(other_mgr.ctx)
+    other_workflow.uuid = "wf-rtorrent-other-pipeline"
+    other_mgr.ctx.workflows[other_workflow.uuid] = other_workflow
+    other_notified = record_notifications(other_mgr.ctx)
+
+    await rtorrent.rtorrent_wait_until_complete(waiting_workflow.spawn_instance(), server_info, String("HASH"))
+    await rtorrent.rtorrent_wait_until_complete(other_workflow.spawn_instance(), server_info, String("HASH"))
+    assert len(rtorrent.status_pollers) == 2
+
+    connection.d.torrents["HASH"] = (True, 0.0)
+    other_poller = next(poller for key, poller in rtorrent.status_pollers.items() if key[0] is other_mgr.ctx)
+    await other_poller.refresh()
+    assert other_notified == [True]
+    assert notified == []
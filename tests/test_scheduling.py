@@ -4,11 +4,13 @@ import pytest
 from datetime import datetime, timedelta
 from unittest.mock import patch
 
+from pipeline_backend.commands import Commands, CommandReturnStatus
 from pipeline_backend.procedure_runner import ProcedureRunner
 from pipeline_backend.workflows import Workflow, RunStates, ProcessingStep
 from pipeline_backend.instances import Instance
 from pipeline_backend.variables import String, Integer
 from pipeline_backend.manager import PipelineManager
+from pipeline_backend import metrics
 
 
 # ---------------------------------------------------------------------------
@@ -112,7 +114,7 @@ class TestRunDueInstances:
         wf = make_workflow(mgr)
         inst = wf.spawn_instance()
         inst.next_processing_time = datetime.now() - timedelta(seconds=1)
-        with patch.object(mgr, 'save_state'):
+        with patch.object(mgr, 'request_save'):
             await mgr.run_due_instances()
             assert inst.uuid in mgr._running_instance_tasks
             await wait_for_running_tasks(mgr)
@@ -122,7 +124,7 @@ class TestRunDueInstances:
         wf = make_workflow(mgr)
         inst = wf.spawn_instance()
         inst.next_processing_time = datetime.now() + timedelta(seconds=60)
-        with patch.object(mgr, 'save_state'):
+        with patch.object(mgr, 'request_save'):
             await mgr.run_due_instances()
         assert mgr._running_instance_tasks == {}
         assert inst.state == RunStates.Running  # untouched
@@ -132,7 +134,7 @@ class TestRunDueInstances:
         inst = wf.spawn_instance()
         inst.next_processing_time = datetime.now() - timedelta(seconds=1)
         inst.state = RunStates.Paused
-        with patch.object(mgr, 'save_state') as mock_save:
+        with patch.object(mgr, 'request_save') as mock_save:
             await mgr.run_due_instances()
         mock_save.assert_not_called()
         assert mgr._running_instance_tasks == {}
@@ -142,26 +144,26 @@ class TestRunDueInstances:
         inst = wf.spawn_instance()
         inst.next_processing_time = datetime.now() - timedelta(seconds=1)
         wf.state = RunStates.Paused
-        with patch.object(mgr, 'save_state') as mock_save:
+        with patch.object(mgr, 'request_save') as mock_save:
             await mgr.run_due_instances()
         mock_save.assert_not_called()
         assert mgr._running_instance_tasks == {}
         assert inst.state == RunStates.Running  # untouched
 
-    async def test_saves_state_when_instances_ran(self, mgr):
+    async def test_requests_a_save_when_instances_ran(self, mgr):
         wf = make_workflow(mgr)
         inst = wf.spawn_instance()
         inst.next_processing_time = datetime.now() - timedelta(seconds=1)
-        with patch.object(mgr, 'save_state') as mock_save:
+        with patch.object(mgr, 'request_save') as mock_save:
             await mgr.run_due_instances()
             await wait_for_running_tasks(mgr)
         mock_save.assert_called_once()
 
-    async def test_does_not_save_state_when_nothing_ran(self, mgr):
+    async def test_does_not_request_a_save_when_nothing_ran(self, mgr):
         wf = make_workflow(mgr)
         inst = wf.spawn_instance()
         inst.next_processing_time = datetime.now() + timedelta(seconds=60)
-        with patch.object(mgr, 'save_state') as mock_save:
+        with patch.object(mgr, 'request_save') as mock_save:
             await mgr.run_due_instances()
         mock_save.assert_not_called()
         assert mgr._running_instance_tasks == {}
@@ -173,7 +175,7 @@ class TestRunDueInstances:
         inst_b = wf.spawn_instance()
         inst_a.next_processing_time = past
         inst_b.next_processing_time = past
-        with patch.object(mgr, 'save_state'):
+        with patch.object(mgr, 'request_save'):
             await mgr.run_due_instances()
             assert set(mgr._running_instance_tasks) == {inst_a.uuid, inst_b.uuid}
             await wait_for_running_tasks(mgr)
@@ -181,6 +183,115 @@ class TestRunDueInstances:
         assert inst_b.state == RunStates.Paused
 
 
+# ---------------------------------------------------------------------------
+# Running instance limits
+# ---------------------------------------------------------------------------
+
+def spawn_due(wf, seconds_ago):
+    inst = wf.spawn_instance()
+    inst.next_processing_time = datetime.now() - timedelta(seconds=seconds_ago)
+    return inst
+
+
+class TestRunningLimits:
+    async def test_global_limit_starts_the_soonest_due(self, mgr):
+        mgr.max_running_instances = 2
+        wf = make_workflow(mgr)
+        insts = [spawn_due(wf, seconds_ago) for seconds_ago in (10, 40, 20, 30)]
+        with patch.object(mgr, 'request_save'), patch.object(mgr, 'notify_of_something_happening'):
+            await mgr.run_due_instances()
+            assert set(mgr._running_instance_tasks) == {insts[1].uuid, insts[3].uuid}
+            mgr.update_metrics()
+            assert metrics.due_backlog_gauge.value() == 2
+            # Nothing can start until one yields, so there is nothing to wake up for
+            assert mgr.get_next_due_time() is None
+            await wait_for_running_tasks(mgr)
+
+            await mgr.run_due_instances()
+            assert set(mgr._running_instance_tasks) == {insts[0].uuid, insts[2].uuid}
+            mgr.update_metrics()
+            assert metrics.due_backlog_gauge.value() == 0
+            await wait_for_running_tasks(mgr)
+        assert all(inst.state == RunStates.Paused for inst in insts)
+
+    async def test_workflow_limit_holds_back_only_that_workflow(self, mgr):
+        limited = make_workflow(mgr, uuid="wf-limited")
+        limited.max_running_instances = 1
+        other = make_workflow(mgr, uuid="wf-other")
+        first = spawn_due(limited, 20)
+        second = spawn_due(limited, 10)
+        unlimited = spawn_due(other, 5)
+        with patch.object(mgr, 'request_save'), patch.object(mgr, 'notify_of_something_happening'):
+            await mgr.run_due_instances()
+            assert set(mgr._running_instance_tasks) == {first.uuid, unlimited.uuid}
+            mgr.update_metrics()
+            assert metrics.held_back_instances_gauge.value() == 1
+            await wait_for_running_tasks(mgr)
+
+            await mgr.run_due_instances()
+            assert set(mgr._running_instance_tasks) == {second.uuid}
+            await wait_for_running_tasks(mgr)
+
+    async def test_held_back_instances_wait_for_a_slot_instead_of_polling(self, mgr):
+        wf = make_workflow(mgr)
+        wf.max_running_instances = 1
+        first = spawn_due(wf, 20)
+        second = spawn_due(wf, 10)
+        with patch.object(mgr, 'request_save'), patch.object(mgr, 'notify_of_something_happening'):
+            await mgr.run_due_instances()
+            assert set(mgr._running_instance_tasks) == {first.uuid}
+            # The held back one is out of the due queue, so there is nothing to wake up for
+            assert mgr.get_next_due_time() is None
+            await wait_for_running_tasks(mgr)
+            # Released when first finished running
+            assert mgr.get_next_due_time() is not None
+            await mgr.run_due_instances()
+            assert set(mgr._running_instance_tasks) == {second.uuid}
+            await wait_for_running_tasks(mgr)
+        assert second.state == RunStates.Paused
+
+    def test_workflow_limit_is_saved(self, mgr):
+        wf = make_workflow(mgr)
+        wf.max_running_instances = 3
+        data = wf.json_savable()
+        assert data["max_running_instances"] == 3
+        # State files from before the limit existed load without one
+        del data["max_running_instances"]
+        restored = Workflow(mgr.ctx)
+        restored.json_loadable(data)
+        assert restored.max_running_instances == 0
+
+
+# ---------------------------------------------------------------------------
+# PipelineManager.stop
+# ---------------------------------------------------------------------------
+
+class TestStop:
+    async def test_instances_still_running_after_the_grace_period_are_cancelled(self, mgr):
+        @Commands.register_command(category="Test")
+        async def sched_test_hang(instance: Instance) -> CommandReturnStatus:
+            await asyncio.sleep(60)
+            return CommandReturnStatus.Success
+
+        try:
+            wf = make_workflow(mgr)
+            wf.procedures["start"] = [ProcessingStep("sched_test_hang")]
+            inst = spawn_due(wf, 1)
+            mgr.stop_grace_seconds = 0.05
+            with patch.object(mgr, 'request_save'), patch.object(mgr, 'save_state'):
+                await mgr.run_due_instances()
+                await asyncio.sleep(0)
+                await asyncio.wait_for(mgr.stop(), 5)
+            assert not mgr._running_instance_tasks
+            # Left on the step it was running, so it runs again on the next start
+            assert inst.processing_step == ("start", 0)
+            assert inst.state == RunStates.Running
+            assert "Cancelled while running the command sched_test_hang" in inst.console_log
+        finally:
+            for registry in (Commands.commands, Commands.categories, Commands.descriptors):
+                registry.pop("sched_test_hang")
+
+
 # ---------------------------------------------------------------------------
 # PipelineManager.get_next_due_time
 # ---------------------------------------------------------------------------
@@ -252,3 +363,77 @@ class TestGetNextDueTime:
             assert mgr.get_next_due_time() is None
         finally:
             await task
+
+
+# ---------------------------------------------------------------------------
+# DueQueue - the heap behind run_due_instances / get_next_due_time
+# ---------------------------------------------------------------------------
+
+class TestDueQueue:
+    def test_pops_due_instances_soonest_first(self, mgr):
+        wf = make_workflow(mgr)
+        now = datetime.now()
+        later = wf.spawn_instance()
+        sooner = wf.spawn_instance()
+        later.next_processing_time = now - timedelta(seconds=1)
+        sooner.next_processing_time = now - timedelta(seconds=5)
+        assert mgr.ctx.due_queue.pop_due(now) is sooner
+        assert mgr.ctx.due_queue.pop_due(now) is later
+        assert mgr.ctx.due_queue.pop_due(now) is None
+
+    def test_rescheduling_replaces_the_old_entry(self, mgr):
+        wf = make_workflow(mgr)
+        inst = wf.spawn_instance()
+        inst.next_processing_time = datetime.now() - timedelta(seconds=5)
+        inst.next_processing_time = datetime.now() + timedelta(seconds=60)
+        assert mgr.ctx.due_queue.pop_due(datetime.now()) is None
+        assert mgr.get_next_due_time() == inst.next_processing_time
+
+    def test_deleted_instance_is_dropped(self, mgr):
+        wf = make_workflow(mgr)
+        inst = wf.spawn_instance()
+        inst.next_processing_time = datetime.now() - timedelta(seconds=1)
+        del mgr.ctx.instances[inst.uuid]
+        assert mgr.ctx.due_queue.pop_due(datetime.now()) is None
+        assert mgr.get_next_due_time() is None
+
+    def test_unpausing_an_instance_requeues_it(self, mgr):
+        wf = make_workflow(mgr)
+        inst = wf.spawn_instance()
+        inst.next_processing_time = datetime.now() + timedelta(seconds=30)
+        inst.state = RunStates.Paused
+        assert mgr.get_next_due_time() is None  # drops the paused entry
+        inst.state = RunStates.Running
+        assert mgr.get_next_due_time() == inst.next_processing_time
+
+    def test_resuming_a_workflow_requeues_its_instances(self, mgr):
+        wf = make_workflow(mgr)
+        inst = wf.spawn_instance()
+        inst.next_processing_time = datetime.now() + timedelta(seconds=30)
+        wf.state = RunStates.Paused
+        assert mgr.get_next_due_time() is None
+        wf.state = RunStates.Running
+        assert mgr.get_next_due_time() == inst.next_processing_time
+
+    def test_unregistered_instances_are_not_queued(self, mgr):
+        inst = Instance(mgr.ctx)
+        inst.uuid = "loose"
+        inst.next_processing_time = datetime.now() - timedelta(seconds=1)
+        assert len(mgr.ctx.due_queue) == 0
+
+    def test_stale_entries_are_compacted(self, mgr):
+        wf = make_workflow(mgr)
+        inst = wf.spawn_instance()
+        for seconds in range(1000):
+            inst.next_processing_time = datetime.now() + timedelta(seconds=seconds)
+        assert len(mgr.ctx.due_queue._heap) < 100
+
+    async def test_instance_is_requeued_after_it_yields(self, mgr):
+        wf = make_workflow(mgr)
+        wf.procedures["start"] = [ProcessingStep("yield_for_seconds", num_seconds=Integer(60))]
+        inst = wf.spawn_instance()
+        inst.next_processing_time = datetime.now() - timedelta(seconds=1)
+        with patch.object(mgr, 'request_save'), patch.object(mgr, 'notify_of_something_happening'):
+            await mgr.run_due_instances()
+            await wait_for_running_tasks(mgr)
+        assert mgr.get_next_due_time() == inst.next_processing_time
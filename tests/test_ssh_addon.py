@@ -0,0 +1,414 @@
+"""Tests for the ssh addon against a local SFTP server."""
+import asyncio
+import os
+import pytest
+import asyncssh
+
+from builtin_addons import ssh
+from builtin_addons.ssh.pool import SSHConnectionPool, pool_key
+from builtin_addons.ssh import transfers
+from builtin_addons.ssh.transfers import DownloadProgress, TransferSettings, SFTP_BLOCK_SIZE
+from pipeline_backend.commands import CommandReturnStatus
+from pipeline_backend.instances import Instance
+from pipeline_backend.variables import Dictionary, Integer, String, VariablePath
+
+
+class PasswordServer(asyncssh.SSHServer):
+    def begin_auth(self, username):
+        return True
+
+    def password_auth_supported(self):
+        return True
+
+    def validate_password(self, username, password):
+        return password == "secret"
+
+
+@pytest.fixture
+async def sftp_port():
+    server = await asyncssh.listen(
+        "127.0.0.1", 0,
+        server_host_keys=[asyncssh.generate_private_key("ssh-ed25519")],
+        server_factory=PasswordServer,
+        sftp_factory=True,
+        allow_scp=True,
+    )
+    yield server.sockets[0].getsockname()[1]
+    server.close()
+    await server.wait_closed()
+
+
+@pytest.fixture
+def connects(monkeypatch, sftp_port):
+    """Point the addon at the local server, counting every connection it opens."""
+    opened = []
+    real_connect = asyncssh.connect
+
+    async def connect_to_local_server(host, **kwargs):
+        opened.append(host)
+        return await real_connect("127.0.0.1", port=sftp_port, known_hosts=None, **kwargs)
+
+    monkeypatch.setattr(asyncssh, "connect", connect_to_local_server)
+    return opened
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    pool = SSHConnectionPool()
+    monkeypatch.setattr(ssh, "connection_pool", pool)
+    yield pool
+    pool.close_all()
+
+
+def server_info(username="user", password="secret"):
+    return Dictionary({"URL": String("seedbox.test"), "username": String(username), "password": String(password)})
+
+
+@pytest.fixture
+def instance(mgr):
+    return Instance(mgr.ctx)
+
+
+class TestPool:
+    async def test_commands_in_a_row_share_one_connection(self, instance, connects, pool, tmp_path):
+        (tmp_path / "a.txt").write_text("a")
+        (tmp_path / "b.txt").write_text("b")
+        result = await ssh.sftp_list_directory(instance, server_info(), String(str(tmp_path)), VariablePath("names"))
+        assert result == CommandReturnStatus.Success
+        assert {"a.txt", "b.txt"} <= set(instance.variables["names"].value)
+        assert await ssh.sftp_delete_file(instance, server_info(), String(str(tmp_path / "a.txt"))) == CommandReturnStatus.Success
+        assert not (tmp_path / "a.txt").exists()
+        assert len(connects) == 1
+        assert pool.reused == 1
+
+    async def test_other_credentials_get_their_own_connection(self, instance, connects, pool, tmp_path):
+        await ssh.sftp_list_directory(instance, server_info(username="one"), String(str(tmp_path)), VariablePath("names"))
+        await ssh.sftp_list_directory(instance, server_info(username="two"), String(str(tmp_path)), VariablePath("names"))
+        assert len(connects) == 2
+
+    async def test_an_sftp_error_hands_the_connection_back(self, instance, connects, pool, tmp_path):
+        result = await ssh.sftp_delete_file(instance, server_info(), String(str(tmp_path / "missing")))
+        assert result == CommandReturnStatus.Error
+        await ssh.sftp_list_directory(instance, server_info(), String(str(tmp_path)), VariablePath("names"))
+        assert len(connects) == 1
+
+    async def test_any_other_error_closes_the_connection(self, instance, connects, pool, tmp_path):
+        key = pool_key("seedbox.test", "user", "password:secret")
+        with pytest.raises(RuntimeError):
+            async with ssh.open_ssh_pipe(instance, server_info()) as pipe:
+                raise RuntimeError()
+        await asyncio.wait_for(pipe.connection.wait_closed(), 1)
+        assert pool.open_count(key) == 0
+
+    async def test_connections_per_key_are_capped(self, instance, connects, pool):
+        pool.max_connections_per_key = 1
+        active = 0
+        max_active = 0
+
+        async def hold():
+            nonlocal active, max_active
+            async with ssh.open_ssh_pipe(instance, server_info()):
+                active += 1
+                max_active = max(max_active, active)
+                await asyncio.sleep(0.02)
+                active -= 1
+
+        await asyncio.gather(hold(), hold(), hold())
+        assert max_active == 1
+        assert len(connects) == 1
+
+    async def test_idle_connections_are_closed(self, instance, connects, pool, tmp_path):
+        pool.idle_seconds = 0.02
+        async with ssh.open_ssh_pipe(instance, server_info()) as pipe:
+            pass
+        await asyncio.wait_for(pipe.connection.wait_closed(), 1)
+        assert pool.open_count(pool_key("seedbox.test", "user", "password:secret")) == 0
+
+    async def test_dead_connection_fails_the_health_check(self, instance, connects, pool, tmp_path):
+        pool.health_check_seconds = 0
+        async with ssh.open_ssh_pipe(instance, server_info()) as pipe:
+            await pipe.sftp_client()
+        # Dropped while idle, as a server restart or a NAT timeout would
+        pipe.connection.abort()
+        await asyncio.sleep(0.01)
+        result = await ssh.sftp_list_directory(instance, server_info(), String(str(tmp_path)), VariablePath("names"))
+        assert result == CommandReturnStatus.Success
+        assert len(connects) == 2
+
+    async def test_pool_is_usable_again_after_closing_all(self, instance, connects, pool, tmp_path):
+        key = pool_key("seedbox.test", "user", "password:secret")
+        async with ssh.open_ssh_pipe(instance, server_info()) as leased_out:
+            pool.close_all()
+        # Leased out when everything was closed, so it is not handed back
+        await asyncio.wait_for(leased_out.connection.wait_closed(), 1)
+        async with ssh.open_ssh_pipe(instance, server_info()):
+            pass
+        assert pool.idle_count(key) == 1
+        await ssh.sftp_list_directory(instance, server_info(), String(str(tmp_path)), VariablePath("names"))
+        assert len(connects) == 2
+
+    def test_key_does_not_hold_the_credential(self):
+        key = pool_key("seedbox.test", "user", "password:secret")
+        assert "secret" not in "".join(key)
+
+
+def make_tree(root):
+    (root / "season" / "extras").mkdir(parents=True)
+    (root / "season" / "e01.mkv").write_bytes(b"1" * 300_000)
+    (root / "season" / "e02.mkv").write_bytes(b"2" * 200_000)
+    (root / "season" / "extras" / "notes.txt").write_text("notes")
+    (root / "season" / "empty").mkdir()
+
+
+class TestDownloads:
+    async def test_file_download_uses_the_tuning_from_the_server_info(self, instance, connects, pool, tmp_path, monkeypatch):
+        (tmp_path / "remote.bin").write_bytes(bytes(range(256)) * 4000)
+        requested = []
+        real_copy_range = transfers._copy_range
+
+        async def copy_range(remote_file, local_file, offset, end, block_size, max_requests, report):
+            requested.append((block_size, max_requests))
+            return await real_copy_range(remote_file, local_file, offset, end, block_size, max_requests, report)
+
+        monkeypatch.setattr(transfers, "_copy_range", copy_range)
+        info = server_info()
+        info.value["sftp block size"] = Integer(32768)
+        result = await ssh.sftp_download_file(instance, info, String(str(tmp_path / "remote.bin")), String(str(tmp_path / "local.bin")))
+        assert result == CommandReturnStatus.Success
+        assert (tmp_path / "local.bin").read_bytes() == (tmp_path / "remote.bin").read_bytes()
+        assert not (tmp_path / "local.bin.part").exists()
+        assert requested == [(32768, TransferSettings().max_requests)]
+
+    async def test_folder_download_copies_the_whole_tree(self, instance, connects, pool, tmp_path):
+        make_tree(tmp_path / "remote")
+        local = tmp_path / "local"
+        result = await ssh.sftp_download_folder(instance, server_info(), String(str(tmp_path / "remote")), String(str(local)))
+        assert result == CommandReturnStatus.Success
+        assert (local / "season" / "e01.mkv").read_bytes() == b"1" * 300_000
+        assert (local / "season" / "e02.mkv").read_bytes() == b"2" * 200_000
+        assert (local / "season" / "extras" / "notes.txt").read_text() == "notes"
+        assert (local / "season" / "empty").is_dir()
+        assert "3 files" in instance.console_log
+        assert len(connects) == 1
+
+    async def test_folder_download_runs_files_in_parallel(self, instance, connects, pool, tmp_path, monkeypatch):
+        make_tree(tmp_path / "remote")
+        active = 0
+        max_active = 0
+        real_download_file = transfers.download_file
+
+        async def download_file(*args, **kwargs):
+            nonlocal active, max_active
+            active += 1
+            max_active = max(max_active, active)
+            await asyncio.sleep(0.02)
+            try:
+                return await real_download_file(*args, **kwargs)
+            finally:
+                active -= 1
+
+        monkeypatch.setattr(transfers, "download_file", download_file)
+        info = server_info()
+        info.value["sftp parallel files"] = Integer(2)
+        await ssh.sftp_download_folder(instance, info, String(str(tmp_path / "remote")), String(str(tmp_path / "local")))
+        assert max_active == 2
+
+    async def test_missing_folder_is_an_error(self, instance, connects, pool, tmp_path):
+        result = await ssh.sftp_download_folder(instance, server_info(), String(str(tmp_path / "missing")), String(str(tmp_path / "local")))
+        assert result == CommandReturnStatus.Error
+        assert "Unable to find remote folder" in instance.console_log
+
+    def test_bad_tuning_falls_back_to_the_default(self, instance):
+        info = server_info()
+        info.value["sftp block size"] = String("lots")
+        assert TransferSettings.from_server_info(instance, info).block_size == SFTP_BLOCK_SIZE
+        assert "Ignoring 'sftp block size'" in instance.console_log
+
+    def test_progress_adds_up_every_file(self):
+        reports = []
+        progress = DownloadProgress(lambda *args: reports.append(args), "/remote", "/local", 300)
+        progress.file_progress(b"/remote/a", b"/local/a", 100, 100)
+        progress.file_progress(b"/remote/b", b"/local/b", 50, 200)
+        progress.file_progress(b"/remote/b", b"/local/b", 200, 200)
+        assert reports[-1] == (b"/remote", b"/local", 300, 300)
+        assert [report[2] for report in reports] == [100, 150, 300]
+
+
+@pytest.fixture
+def remote_file(tmp_path):
+    path = tmp_path / "remote.bin"
+    path.write_bytes(bytes(range(256)) * 8000)
+    return path
+
+
+class TestResume:
+    async def test_sftp_carries_on_from_the_partial_file(self, instance, connects, pool, tmp_path, remote_file, monkeypatch):
+        local = tmp_path / "local.bin"
+        (tmp_path / "local.bin.part").write_bytes(remote_file.read_bytes()[:700_000])
+        reports = []
+        monkeypatch.setattr(ssh, "file_download_progress_callback", lambda instance, thresholds, src, dest, bytesdone, total: reports.append(bytesdone))
+        result = await ssh.sftp_download_file(instance, server_info(), String(str(remote_file)), String(str(local)))
+        assert result == CommandReturnStatus.Success
+        assert local.read_bytes() == remote_file.read_bytes()
+        assert not (tmp_path / "local.bin.part").exists()
+        assert "Resuming" in instance.console_log and "from byte 700,000 of 2,048,000" in instance.console_log
+        assert reports[0] > 700_000
+
+    async def test_a_tail_that_does_not_match_starts_again(self, instance, connects, pool, tmp_path, remote_file):
+        local = tmp_path / "local.bin"
+        (tmp_path / "local.bin.part").write_bytes(b"x" * 700_000)
+        result = await ssh.sftp_download_file(instance, server_info(), String(str(remote_file)), String(str(local)))
+        assert result == CommandReturnStatus.Success
+        assert local.read_bytes() == remote_file.read_bytes()
+        assert "does not match the remote file" in instance.console_log
+
+    async def test_a_partial_file_larger_than_the_remote_starts_again(self, instance, connects, pool, tmp_path, remote_file):
+        local = tmp_path / "local.bin"
+        (tmp_path / "local.bin.part").write_bytes(remote_file.read_bytes() + b"extra")
+        await ssh.sftp_download_file(instance, server_info(), String(str(remote_file)), String(str(local)))
+        assert local.read_bytes() == remote_file.read_bytes()
+        assert "larger than the remote file" in instance.console_log
+
+    async def test_without_the_check_only_the_size_is_trusted(self, instance, connects, pool, tmp_path, remote_file):
+        local = tmp_path / "local.bin"
+        (tmp_path / "local.bin.part").write_bytes(b"x" * 1000)
+        info = server_info()
+        info.value["resume check bytes"] = Integer(0)
+        await ssh.sftp_download_file(instance, info, String(str(remote_file)), String(str(local)))
+        assert local.read_bytes() == b"x" * 1000 + remote_file.read_bytes()[1000:]
+
+    async def test_an_interrupted_download_leaves_the_partial_file(self, instance, connects, pool, tmp_path, remote_file, monkeypatch):
+        local = tmp_path / "local.bin"
+
+        def fail_partway(path, data, bytesdone, total):
+            if bytesdone > 500_000:
+                raise ConnectionResetError()
+
+        monkeypatch.setattr(ssh, "file_download_progress_callback", lambda instance, thresholds, *args: fail_partway(*args))
+        with pytest.raises(ConnectionResetError):
+            await ssh.sftp_download_file(instance, server_info(), String(str(remote_file)), String(str(local)))
+        assert not local.exists()
+        assert 500_000 < (tmp_path / "local.bin.part").stat().st_size < remote_file.stat().st_size
+
+        monkeypatch.setattr(ssh, "file_download_progress_callback", lambda *args: None)
+        await ssh.sftp_download_file(instance, server_info(), String(str(remote_file)), String(str(local)))
+        assert local.read_bytes() == remote_file.read_bytes()
+        assert "Resuming" in instance.console_log
+
+    async def test_scp_downloads_by_way_of_the_partial_file(self, instance, connects, pool, tmp_path, remote_file):
+        local = tmp_path / "local.bin"
+        result = await ssh.scp_download_file(instance, server_info(), String(str(remote_file)), String(str(local)))
+        assert result == CommandReturnStatus.Success
+        assert local.read_bytes() == remote_file.read_bytes()
+        assert not (tmp_path / "local.bin.part").exists()
+
+    async def test_scp_resumes_over_sftp(self, instance, connects, pool, tmp_path, remote_file):
+        local = tmp_path / "local.bin"
+        (tmp_path / "local.bin.part").write_bytes(remote_file.read_bytes()[:1_000_000])
+        result = await ssh.scp_download_file(instance, server_info(), String(str(remote_file)), String(str(local)))
+        assert result == CommandReturnStatus.Success
+        assert local.read_bytes() == remote_file.read_bytes()
+        assert "from byte 1,000,000" in instance.console_log
+
+
+@pytest.fixture
+def downloads(monkeypatch):
+    """The remote paths of every file download."""
+    fetched = []
+    real_download_file = transfers.download_file
+
+    async def download_file(instance, sftp, remotepath, *args, **kwargs):
+        fetched.append(remotepath)
+        return await real_download_file(instance, sftp, remotepath, *args, **kwargs)
+
+    monkeypatch.setattr(transfers, "download_file", download_file)
+    return fetched
+
+
+class TestMirror:
+    async def mirror(self, instance, tmp_path, manifest="", info=None):
+        return await ssh.sftp_mirror_folder(instance, info or server_info(), String(str(tmp_path / "remote")), String(str(tmp_path / "local")), String(manifest))
+
+    async def test_second_run_downloads_nothing(self, instance, connects, pool, tmp_path, downloads):
+        make_tree(tmp_path / "remote")
+        assert await self.mirror(instance, tmp_path) == CommandReturnStatus.Success
+        assert len(downloads) == 3
+        assert (tmp_path / "local" / "season" / "extras" / "notes.txt").read_text() == "notes"
+        downloads.clear()
+        assert await self.mirror(instance, tmp_path) == CommandReturnStatus.Success
+        assert downloads == []
+        assert "0 of 3 files are new or changed" in instance.console_log
+
+    async def test_only_new_and_changed_files_are_downloaded(self, instance, connects, pool, tmp_path, downloads):
+        make_tree(tmp_path / "remote")
+        await self.mirror(instance, tmp_path)
+        downloads.clear()
+        (tmp_path / "remote" / "season" / "e03.mkv").write_bytes(b"3" * 1000)
+        (tmp_path / "remote" / "season" / "extras" / "notes.txt").write_text("more notes")
+        # Same size, only the modification time moves on
+        os.utime(tmp_path / "remote" / "season" / "e01.mkv", (2_000_000_000, 2_000_000_000))
+        await self.mirror(instance, tmp_path)
+        assert sorted(path.rsplit("/", 1)[1] for path in downloads) == ["e01.mkv", "e03.mkv", "notes.txt"]
+        assert (tmp_path / "local" / "season" / "extras" / "notes.txt").read_text() == "more notes"
+        assert int((tmp_path / "local" / "season" / "e01.mkv").stat().st_mtime) == 2_000_000_000
+
+    async def test_without_a_manifest_missing_local_files_come_back(self, instance, connects, pool, tmp_path, downloads):
+        make_tree(tmp_path / "remote")
+        await self.mirror(instance, tmp_path)
+        (tmp_path / "local" / "season" / "e02.mkv").unlink()
+        downloads.clear()
+        await self.mirror(instance, tmp_path)
+        assert [path.rsplit("/", 1)[1] for path in downloads] == ["e02.mkv"]
+
+    async def test_manifest_remembers_files_moved_away(self, instance, connects, pool, tmp_path, downloads):
+        make_tree(tmp_path / "remote")
+        manifest = str(tmp_path / "mirror.json")
+        await self.mirror(instance, tmp_path, manifest)
+        (tmp_path / "local" / "season" / "e02.mkv").unlink()
+        downloads.clear()
+        await self.mirror(instance, tmp_path, manifest)
+        assert downloads == []
+        restored = transfers.MirrorManifest.load(manifest)
+        assert restored.files["season/e02.mkv"][0] == 200_000
+
+    async def test_files_finished_before_a_failure_are_kept_in_the_manifest(self, instance, connects, pool, tmp_path, monkeypatch):
+        make_tree(tmp_path / "remote")
+        manifest = str(tmp_path / "mirror.json")
+        real_download_file = transfers.download_file
+
+        async def download_file(instance, sftp, remotepath, *args, **kwargs):
+            if remotepath.endswith("notes.txt"):
+                raise ConnectionResetError()
+            return await real_download_file(instance, sftp, remotepath, *args, **kwargs)
+
+        monkeypatch.setattr(transfers, "download_file", download_file)
+        info = server_info()
+        info.value["sftp parallel files"] = Integer(1)
+        with pytest.raises(ConnectionResetError):
+            await self.mirror(instance, tmp_path, manifest, info)
+        assert sorted(transfers.MirrorManifest.load(manifest).files) == ["season/e01.mkv", "season/e02.mkv"]
+
+    async def test_without_remote_times_only_the_size_is_compared(self, tmp_path):
+        (tmp_path / "local").mkdir()
+        (tmp_path / "local" / "same.bin").write_bytes(b"x" * 10)
+        (tmp_path / "local" / "grown.bin").write_bytes(b"x" * 10)
+        files = [("grown.bin", asyncssh.SFTPAttrs(size=20)), ("same.bin", asyncssh.SFTPAttrs(size=10))]
+        changed = transfers.changed_files(files, str(tmp_path / "local"))
+        assert [relpath for relpath, _ in changed] == ["grown.bin"]
+
+        manifest = transfers.MirrorManifest(str(tmp_path / "mirror.json"))
+        for relpath, attrs in files:
+            await transfers.mark_mirrored(str(tmp_path / "local"), relpath, attrs, manifest)
+        manifest.save()
+        restored = transfers.MirrorManifest.load(manifest.path)
+        assert restored.files == {"grown.bin": (20, None), "same.bin": (10, None)}
+        assert transfers.changed_files(files, str(tmp_path / "local"), restored) == []
+
+    async def test_scan_lists_every_level(self, instance, connects, pool, tmp_path):
+        for i in range(5):
+            (tmp_path / "remote" / f"d{i}" / "deeper").mkdir(parents=True)
+            (tmp_path / "remote" / f"d{i}" / "deeper" / "f.txt").write_text(str(i))
+        async with ssh.open_ssh_pipe(instance, server_info()) as pipe:
+            folders, files = await transfers.walk_remote_tree(await pipe.sftp_client(), str(tmp_path / "remote"), max_requests=2)
+        assert folders == sorted([f"d{i}" for i in range(5)] + [f"d{i}/deeper" for i in range(5)])
+        assert [relpath for relpath, _ in files] == [f"d{i}/deeper/f.txt" for i in range(5)]
@@ -30,6 +30,13 @@ class TestRegexMatchAll:
         assert result == CommandReturnStatus.Success
         assert inst["out"].value == ["12", "34"]
 
+    async def test_large_input_is_searched_in_the_cpu_pool(self, workflow, monkeypatch):
+        monkeypatch.setattr(builtin_addons.string_operations, "REGEX_POOL_MIN_CHARS", 0)
+        inst = workflow.spawn_instance()
+        result = await str_regex_matchAll(inst, String(r"id=(\d+)"), String("id=12 id=34"), VariablePath("out"))
+        assert result == CommandReturnStatus.Success
+        assert inst["out"].value == ["12", "34"]
+
     async def test_K_escape_still_works(self, workflow):
         # \K is the reason this addon depends on the regex module rather than re, and it
         # needs no capture group at all - the guard must not get in its way
@@ -1,4 +1,5 @@
 import pytest
+from copy import copy, deepcopy
 from pipeline_backend.variables import (
     WorkVariable, String, Integer, Float, URL,
     Boolean, StringList, VariableList, VariablePath, VariableNameList, Dictionary,
@@ -405,3 +406,99 @@ class TestConvertToPythonType:
         d = Dictionary({"k": Integer(1)})
         result = d.convert_to_python_type()
         assert result == {"k": 1}
+
+
+class TestCopyOnWrite:
+    def test_share_does_not_copy_until_read(self):
+        original = StringList(["a", "b"])
+        twin = original.share()
+        assert twin.read_value() is original.read_value()
+
+    def test_modifying_a_share_leaves_the_original_alone(self):
+        original = StringList(["a", "b"])
+        twin = original.share()
+        twin.value.append("c")
+        assert original.value == ["a", "b"]
+        assert twin.value == ["a", "b", "c"]
+
+    def test_modifying_the_original_leaves_the_share_alone(self):
+        original = StringList(["a", "b"])
+        twin = original.share()
+        original.value.append("c")
+        assert twin.value == ["a", "b"]
+
+    def test_nested_values_are_shared_not_copied(self):
+        inner = StringList(["x"] * 1000)
+        original = Dictionary({"inner": inner})
+        twin = deepcopy(original)
+        # Touching the outer dict copies it, but the list inside is still shared
+        assert twin.value["inner"].read_value() is inner.read_value()
+        twin.value["inner"].value.append("y")
+        assert len(original.value["inner"].value) == 1000
+
+    def test_deepcopy_and_copy_constructor_are_independent(self):
+        original = VariableList([Integer(1), String("two")])
+        for twin in (deepcopy(original), copy(original), VariableList(original)):
+            twin.value[0].value = 5
+            twin.value.append(Integer(3))
+        assert original.convert_to_python_type() == [1, "two"]
+
+    def test_coercion_does_not_touch_the_original(self):
+        original = String(" 7 ")
+        converted = original.coerce_into_type(Integer)
+        assert converted.value == 7
+        assert type(original) == String and original.value == " 7 "
+
+    def test_serializing_a_share_does_not_copy(self):
+        original = StringList(["a"])
+        twin = original.share()
+        assert twin.json_savable()["value"] is original.read_value()
+
+
+class TestSlots:
+    def test_variables_have_no_dict(self):
+        for var in (String("a"), Integer(1), Dictionary({"a": String("b")}), VariableList([])):
+            assert not hasattr(var, "__dict__")
+
+    def test_typename_cast_still_works(self):
+        var = WorkVariable()
+        var.json_loadable({"value": "5", "typename": "Integer"})
+        assert type(var) == Integer and var.value == 5
+
+    def test_subclass_of_a_subclass_is_slotted_and_castable(self):
+        class Shouting(String):
+            def normalize(self) -> None:
+                super().normalize()
+                self.value = self.value.upper()
+
+        assert Shouting.__slots__ == ()
+        var = String("hey").coerce_into_type(Shouting)
+        assert var.value == "HEY"
+
+    def test_subclass_cannot_add_slots(self):
+        with pytest.raises(TypeError):
+            class Extra(String):
+                __slots__ = ("extra",)
+
+
+class TestTypeRegistry:
+    def test_builtin_types_are_registered(self):
+        for cls in (String, Integer, Float, URL, Boolean, StringList, VariableList, VariablePath, VariableNameList, Dictionary):
+            assert WorkVariable.class_from_name(cls.__name__) is cls
+            assert cls.__name__ in WorkVariable.type_names()
+
+    def test_unknown_name_raises(self):
+        with pytest.raises(TypeError, match="NoSuchType"):
+            WorkVariable.class_from_name("NoSuchType")
+
+    def test_subclass_of_a_subclass_is_loadable_by_name(self):
+        class RegistryTestString(String):
+            pass
+
+        try:
+            assert WorkVariable.class_from_name("RegistryTestString") is RegistryTestString
+            var = WorkVariable()
+            var.json_loadable({"value": "hi", "typename": "RegistryTestString"})
+            assert type(var) == RegistryTestString and var.value == "hi"
+        finally:
+            WorkVariable._types_by_name.pop("RegistryTestString")